@@ -2,7 +2,18 @@ from django.contrib import admin
 
 from . models import Note
 from . models import File
+from . tagging import sync_tags
+
+
+class NoteAdmin(admin.ModelAdmin):
+    def save_related(self, request, form, formsets, change):
+        # Tags are synced by difference instead of being cleared and re-added
+        # by taggit.
+        tags = form.cleaned_data.pop("tags", None)
+        super(NoteAdmin, self).save_related(request, form, formsets, change)
+        if tags is not None:
+            sync_tags(form.instance, tags)
 
 
 admin.site.register(File)
-admin.site.register(Note)
+admin.site.register(Note, NoteAdmin)
@@ -5,3 +5,9 @@ from django.apps import AppConfig
 
 class NotesConfig(AppConfig):
     name = 'notes'
+
+    def ready(self):
+        # Connects the signal handlers
+        import notes.signals  # noqa
+        # Registers the system checks
+        import notes.checks  # noqa
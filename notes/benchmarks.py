@@ -0,0 +1,340 @@
+from __future__ import division, print_function, unicode_literals
+
+import json
+import math
+import random
+import timeit
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db import connection
+from django.utils import six
+from django.test.utils import CaptureQueriesContext
+
+from notes.cache import render_cache
+from notes.corpus import CorpusGenerator
+from notes.corpus import WORDS
+from notes.editing import save_note
+from notes.facets import tag_index
+from notes.markup import block_renderer
+from notes.markup import render_full
+from notes.models import Note
+from notes.models import get_default_owner
+from notes.models import get_tag_names
+from notes.prebuilt import prebuilt
+from notes.search import note_search
+
+# The metrics which are compared against a baseline
+COMPARED_METRICS = ("p50", "p90", "p99", "queries", "fetched_bytes")
+
+
+def percentile(values, percent):
+    """Returns the ``percent`` percentile of ``values`` (nearest rank).
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    index = int(math.ceil(percent / 100 * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+@contextmanager
+def session(values=None, user=None):
+    """Replaces the session helpers of CBA by a dict for the duration of the
+    block, so components can be used without a request. The block is a
+    request scope of ``user``, see ``notes.query.request_scope``.
+    """
+    from cba import utils
+    from notes.query import request_scope
+
+    data = dict(values or {})
+    get_from_session = utils.get_from_session
+    set_to_session = utils.set_to_session
+
+    utils.get_from_session = lambda key, *args: data.get(key)
+    utils.set_to_session = lambda key, value, *args: data.__setitem__(key, value)
+    try:
+        with request_scope(user):
+            yield data
+    finally:
+        utils.get_from_session = get_from_session
+        utils.set_to_session = set_to_session
+
+
+def get_size(value):
+    """Returns the approximate number of bytes of a value fetched from the
+    database.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, six.binary_type):
+        return len(value)
+    if isinstance(value, six.text_type):
+        return len(value.encode("utf-8"))
+    return 8
+
+
+@contextmanager
+def count_fetched_bytes():
+    """Counts the bytes of all rows fetched from the database within the
+    block. Yields a dict whose "bytes" are updated.
+    """
+    from django.db.backends.utils import CursorWrapper
+
+    counter = {"bytes": 0}
+
+    def count(rows):
+        for row in rows:
+            counter["bytes"] += sum(get_size(value) for value in row)
+        return rows
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            count([row])
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        return count(self.cursor.fetchmany(*args, **kwargs))
+
+    def fetchall(self):
+        return count(self.cursor.fetchall())
+
+    CursorWrapper.fetchone = fetchone
+    CursorWrapper.fetchmany = fetchmany
+    CursorWrapper.fetchall = fetchall
+    try:
+        yield counter
+    finally:
+        # The wrapper delegates to the cursor by __getattr__ again
+        del CursorWrapper.fetchone
+        del CursorWrapper.fetchmany
+        del CursorWrapper.fetchall
+
+
+class Benchmark(object):
+    """Runs callables repeatedly and reports their latency percentiles in
+    milliseconds together with the number and time of their SQL queries.
+
+    The bytes fetched from the database are measured by an additional run,
+    so counting them doesn't distort the timings.
+    """
+    def __init__(self, repeat=20, warmup=2):
+        self.repeat = repeat
+        self.warmup = warmup
+
+    def run(self, func):
+        for i in range(self.warmup):
+            func()
+
+        timings = []
+        queries = []
+        query_times = []
+        for i in range(self.repeat):
+            with CaptureQueriesContext(connection) as context:
+                start = timeit.default_timer()
+                func()
+                timings.append((timeit.default_timer() - start) * 1000)
+
+            queries.append(len(context.captured_queries))
+            query_times.append(sum(float(query["time"]) for query in context.captured_queries) * 1000)
+
+        with count_fetched_bytes() as counter:
+            func()
+
+        return OrderedDict([
+            ("p50", percentile(timings, 50)),
+            ("p90", percentile(timings, 90)),
+            ("p99", percentile(timings, 99)),
+            ("mean", sum(timings) / len(timings)),
+            ("max", max(timings)),
+            ("queries", percentile(queries, 50)),
+            ("query_time", percentile(query_times, 50)),
+            ("fetched_bytes", counter["bytes"]),
+        ])
+
+    def run_all(self, cases, stdout=None):
+        """Runs all ``cases`` (a dict name -> callable). Failing cases are
+        reported with their error instead of metrics.
+        """
+        results = OrderedDict()
+        for name, func in cases.items():
+            try:
+                results[name] = self.run(func)
+            except Exception as e:
+                results[name] = {"error": "{}: {}".format(type(e).__name__, e)}
+
+            if stdout is not None:
+                stdout.write(format_result(name, results[name]))
+
+        return results
+
+
+def get_runbook(size=500000, seed=None):
+    """Returns a markdown document of about ``size`` characters, like a large
+    runbook note.
+    """
+    generator = CorpusGenerator(seed=seed)
+    texts = []
+    length = 0
+    while length < size:
+        texts.append(generator.random_text())
+        length += len(texts[-1])
+    return "\n\n".join(texts)
+
+
+def get_cases(seed=None, user=None):
+    """Returns the benchmarked hot paths as dict name -> callable.
+
+    Every call works on another random note or search term of the current
+    database. If ``user`` is given the components see only the notes of the
+    user.
+    """
+    from notes.components.note_display import NoteDisplay
+    from notes.components.note_display import NotesTableDataProvider
+    from notes.components.tag_explorer import TagExplorer
+    from notes.views import get_root_components
+
+    randomizer = random.Random(seed)
+    with session(user=user):
+        note_ids = list(Note.objects.order_by("?").values_list("id", flat=True)[:200])
+
+    def random_note_id():
+        return randomizer.choice(note_ids)
+
+    def random_search():
+        word = randomizer.choice(WORDS)
+        return word[:randomizer.randint(2, len(word))]
+
+    def render_note():
+        Note.objects.prefetch_related("tags", "file_set").get(pk=random_note_id()).render()
+
+    def cached_render_note():
+        render_cache.render(random_note_id())
+
+    def get_rows():
+        with session(user=user):
+            NotesTableDataProvider(paging="keyset").get_rows(0, 50)
+
+    def total_rows():
+        with session(user=user):
+            NotesTableDataProvider(paging="keyset").total_rows()
+
+    def load_current_note():
+        with session({"current-note-id": random_note_id()}, user):
+            NoteDisplay(id="note-view").load_current_note()
+
+    def handle_search():
+        with session(user=user):
+            note_display = NoteDisplay(id="note-view")
+            note_display.search.value = random_search()
+            note_display.handle_search()
+
+    def search_burst():
+        # Types a word keystroke by keystroke within one search session
+        with session(user=user):
+            note_display = NoteDisplay(id="note-view")
+            word = randomizer.choice(WORDS)
+            for length in range(1, len(word) + 1):
+                note_display.search.value = word[:length]
+                note_display.handle_search()
+
+    def init_tag_explorer():
+        with session(user=user):
+            TagExplorer(id="tag-explorer").init_components()
+
+    # The root is built for the user, or for the owner of the notes which
+    # existed before notes had owners, see migration 0015.
+    root_user = user or get_default_owner()
+
+    def init_root():
+        with session(user=root_user):
+            get_root_components(root_user)
+
+    def init_root_cold():
+        # Like the first request of a new worker process
+        for cache in (prebuilt, tag_index, note_search.sessions, render_cache, block_renderer):
+            cache.clear()
+        init_root()
+
+    runbook = get_runbook(seed=seed)
+    block_renderer.render("markdown", runbook)
+
+    def render_runbook():
+        render_full("markdown", runbook)
+
+    def render_edited_runbook():
+        # Changes one paragraph of the runbook like a typical edit
+        position = randomizer.randint(0, len(runbook))
+        edited = runbook[:position] + " " + randomizer.choice(WORDS) + runbook[position:]
+        block_renderer.render("markdown", edited)
+
+    def save_unchanged_note():
+        note = Note.objects.get(pk=random_note_id())
+        save_note(note.id, note.title, note.text.raw, get_tag_names([note.id]).get(note.id, []))
+
+    cases = OrderedDict([
+        ("NotesTableDataProvider.get_rows", get_rows),
+        ("NotesTableDataProvider.total_rows", total_rows),
+        ("NoteDisplay.load_current_note", load_current_note),
+        ("NoteDisplay.handle_search", handle_search),
+        ("NoteDisplay.handle_search (burst)", search_burst),
+        ("TagExplorer.init_components", init_tag_explorer),
+        ("Note.render", render_note),
+        ("render_cache.render", cached_render_note),
+        ("markdown (500KB, full)", render_runbook),
+        ("markdown (500KB, edited blocks)", render_edited_runbook),
+        ("NoteEdit.handle_save_note", save_unchanged_note),
+    ])
+
+    if root_user is not None:
+        cases["NotesRoot.init_components (cold)"] = init_root_cold
+        cases["NotesRoot.init_components (warm)"] = init_root
+
+    return cases
+
+
+def format_result(name, result):
+    if "error" in result:
+        return "{:<40} ERROR {}".format(name, result["error"])
+    return "{:<40} p50 {:>9.2f}ms  p90 {:>9.2f}ms  p99 {:>9.2f}ms  {:>4} queries  {:>8.1f}KB fetched".format(
+        name, result["p50"], result["p90"], result["p99"], result["queries"],
+        result.get("fetched_bytes", 0) / 1024.0,
+    )
+
+
+def save_results(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results, baseline):
+    """Compares ``results`` with the ``baseline`` results of a previous run.
+
+    Returns a list of (size, case, metric, baseline value, value, relative
+    change) for all metrics within both runs.
+    """
+    changes = []
+    for size, cases in results.items():
+        for name, result in cases.items():
+            old = baseline.get(size, {}).get(name)
+            if old is None or "error" in old or "error" in result:
+                continue
+
+            for metric in COMPARED_METRICS:
+                if old.get(metric) is None or result.get(metric) is None:
+                    continue
+
+                if old[metric]:
+                    change = (result[metric] - old[metric]) / old[metric]
+                else:
+                    change = 0.0 if not result[metric] else float("inf")
+
+                changes.append((size, name, metric, old[metric], result[metric], change))
+
+    return changes
@@ -0,0 +1,149 @@
+from __future__ import print_function, unicode_literals
+
+from collections import Counter
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from taggit.models import Tag
+from taggit.models import TaggedItem
+
+from notes.cache import notes_changed
+from notes.facets import tag_index
+from notes.jobs import enqueue
+from notes.models import File
+from notes.models import Note
+from notes.models import TagStat
+from notes.models import delete_rows
+from notes.models import get_tagged_items
+from notes.scoping import get_partition
+from notes.search import note_search
+from notes.signals import update_tag_counts
+from notes.tagging import get_or_create_tags
+from notes.tagging import tag_completer
+
+
+def get_partitions(note_ids):
+    """Returns the partitions of the passed notes within the current scope
+    as dict note id -> partition. Notes outside of the scope are left out.
+    """
+    notes = Note.objects.filter(pk__in=note_ids).values_list("id", "owner_id", "team_id")
+    return dict((note_id, get_partition(owner_id, team_id)) for note_id, owner_id, team_id in notes)
+
+
+@transaction.atomic
+def delete_notes(note_ids):
+    """Deletes the notes with ``note_ids`` within the current scope together
+    with their tags. Returns the ids of the deleted notes.
+
+    Takes a constant number of queries, as the notes are deleted without
+    sending signals: tag stats and indexes are updated once for all notes.
+    The files of the notes are detached and deleted by a background job.
+    """
+    partitions = get_partitions(note_ids)
+    if not partitions:
+        return []
+
+    note_ids = list(partitions)
+    items = get_tagged_items().filter(object_id__in=note_ids)
+    pairs = list(items.values_list("object_id", "tag_id"))
+    items.delete()
+
+    files = File.objects.filter(note_id__in=note_ids)
+    file_ids = list(files.values_list("id", flat=True))
+    if file_ids:
+        files.update(note=None)
+        enqueue("notes.delete_files", file_ids=file_ids)
+
+    delete_rows(Note, note_ids)
+
+    counts = Counter((partitions[note_id], tag_id) for note_id, tag_id in pairs)
+    update_tag_counts(dict((key, -count) for key, count in counts.items()))
+
+    if note_search.backend.shared:
+        enqueue("notes.remove_notes", note_ids=note_ids)
+
+    notes_changed(note_ids, set(partitions.values()))
+    return note_ids
+
+
+@transaction.atomic
+def tag_notes(note_ids, tag_names):
+    """Adds the tags named ``tag_names`` to the notes with ``note_ids``
+    within the current scope. Missing tags are created.
+
+    Returns the added (note id, tag id) pairs.
+    """
+    partitions = get_partitions(note_ids)
+    if not partitions:
+        return []
+
+    tag_ids = [tag.id for tag in get_or_create_tags(tag_names)]
+    existing = set(
+        get_tagged_items().filter(object_id__in=list(partitions), tag_id__in=tag_ids).values_list("object_id", "tag_id")
+    )
+    pairs = [
+        (note_id, tag_id) for note_id in sorted(partitions) for tag_id in tag_ids
+        if (note_id, tag_id) not in existing
+    ]
+
+    content_type = ContentType.objects.get_for_model(Note)
+    TaggedItem.objects.bulk_create([
+        TaggedItem(tag_id=tag_id, content_type=content_type, object_id=note_id) for note_id, tag_id in pairs
+    ])
+
+    tags_changed(pairs, partitions, 1)
+    return pairs
+
+
+@transaction.atomic
+def untag_notes(note_ids, tag_names):
+    """Removes the tags named ``tag_names`` from the notes with ``note_ids``
+    within the current scope.
+
+    Returns the removed (note id, tag id) pairs.
+    """
+    partitions = get_partitions(note_ids)
+    if not partitions:
+        return []
+
+    items = get_tagged_items().filter(
+        object_id__in=list(partitions), tag__in=Tag.objects.filter(name__in=set(tag_names)),
+    )
+    pairs = list(items.values_list("object_id", "tag_id"))
+    items.delete()
+
+    tags_changed(pairs, partitions, -1)
+    return pairs
+
+
+def tags_changed(pairs, partitions, amount):
+    """Updates the tag stats, indexes and caches after the (note id, tag id)
+    ``pairs`` have been added (``amount=1``) or removed (``amount=-1``).
+    """
+    if not pairs:
+        return
+
+    counts = Counter((partitions[note_id], tag_id) for note_id, tag_id in pairs)
+    update_tag_counts(dict((key, count * amount) for key, count in counts.items()))
+
+    # The tags are part of the indexed text
+    note_ids = sorted(set(note_id for note_id, tag_id in pairs))
+    if note_search.backend.shared:
+        enqueue("notes.index_notes", note_ids=note_ids)
+
+    notes_changed(note_ids, set(partitions[note_id] for note_id in note_ids))
+
+
+def rebuild_indexes():
+    """Rebuilds the tag stats and the indexes of the notes after rows have
+    been inserted or deleted in bulk, which doesn't send signals.
+    """
+    partitions = TagStat.objects.rebuild()
+    notes = Note.objects.unscoped().values_list("owner_id", "team_id").distinct().order_by()
+    partitions.update(get_partition(owner_id, team_id) for owner_id, team_id in notes)
+
+    tag_index.clear()
+    tag_completer.clear()
+    note_search.rebuild()
+    notes_changed(partitions=partitions)
@@ -0,0 +1,386 @@
+from __future__ import print_function, unicode_literals
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from notes.models import Note
+from notes.routers import primary
+from notes.scoping import get_current_scope
+
+
+def get_cache():
+    """Returns the Django cache used by the notes app, which is configured by
+    the ``NOTES_CACHE`` setting.
+    """
+    return caches[getattr(settings, "NOTES_CACHE", "default")]
+
+
+def get_version(name):
+    """Returns the current version of ``name``.
+
+    Versions are part of cache keys, so bumping a version invalidates all
+    entries built upon it. A version starts with the current time, so it
+    doesn't reuse old values if it has been evicted from the cache.
+    """
+    cache = get_cache()
+    key = "notes:version:{}".format(name)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _initial_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(name):
+    """Increments the version of ``name``.
+    """
+    cache = get_cache()
+    key = "notes:version:{}".format(name)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = _initial_version()
+        cache.set(key, version, None)
+        return version
+
+
+def bump_versions(names):
+    """Increments the versions of ``names`` by one read and one write of the
+    cache. A version is moved at least to the current time, so it doesn't
+    return to a value it had before.
+
+    Returns the changed versions as dict name -> (old version, new version).
+    The old version is None if there was none.
+    """
+    cache = get_cache()
+    keys = dict(("notes:version:{}".format(name), name) for name in names)
+    if not keys:
+        return {}
+
+    versions = cache.get_many(list(keys))
+    initial = _initial_version()
+    bumped = dict((key, max(versions.get(key, 0) + 1, initial)) for key in keys)
+    cache.set_many(bumped, None)
+    return dict((keys[key], (versions.get(key), version)) for key, version in bumped.items())
+
+
+def get_versions(names):
+    """Returns the current versions of ``names`` as dict name -> version by
+    one read of the cache (and one write per missing version).
+    """
+    cache = get_cache()
+    keys = dict(("notes:version:{}".format(name), name) for name in names)
+    versions = cache.get_many(list(keys))
+    for key in set(keys) - set(versions):
+        versions[key] = get_version(keys[key])
+    return dict((keys[key], version) for key, version in versions.items())
+
+
+def _initial_version():
+    return int(time.time() * 1000)
+
+
+def get_partition_version_name(partition):
+    return "notes:{}".format(partition)
+
+
+def get_notes_version(scope=None):
+    """Returns the version of the notes within ``scope`` (a
+    ``notes.scoping.Scope``) as string, to be used within cache keys. It
+    changes whenever a note of one of the partitions of the scope changes.
+    Without scope the version of all notes is returned.
+    """
+    if scope is None:
+        return "{}".format(get_version("notes"))
+
+    names = [get_partition_version_name(partition) for partition in scope.partitions]
+    versions = get_versions(names)
+    return ".".join("{}".format(versions[name]) for name in names)
+
+
+_indexes = []
+_local = threading.local()
+
+
+class Changes(object):
+    """The changes of notes and tags within a transaction, see
+    ``notes_changed``.
+    """
+    def __init__(self):
+        self.note_ids = set()
+        self.partitions = set()
+        self.tag_ids = set()
+
+
+def notes_changed(note_ids=(), partitions=(), tag_ids=()):
+    """Records that the notes with ``note_ids`` (or their tags or files),
+    the notes within ``partitions`` or the tags with ``tag_ids`` have been
+    changed. The partitions of changed notes must be passed, too.
+
+    Once the current transaction has been committed the ``VersionedIndex``
+    objects of this process refresh the changed notes and tags from the
+    database, the HTML of the notes is invalidated and the versions of the
+    partitions are bumped, once for all changes of the transaction, so
+    other processes reload them. Nothing of a rolled back change reaches the
+    indexes or other processes.
+    """
+    changes = getattr(_local, "changes", None)
+    if changes is None:
+        changes = _local.changes = Changes()
+
+    changes.note_ids.update(note_ids)
+    changes.partitions.update(partitions)
+    changes.tag_ids.update(tag_ids)
+
+    # The first hook which runs applies all changes. A hook is registered
+    # per change, as the ones within a rolled back savepoint are dropped;
+    # changes left by a rolled back transaction are applied with the next
+    # one, which only refreshes them again.
+    transaction.on_commit(_apply_changes)
+
+
+def _apply_changes():
+    changes = getattr(_local, "changes", None)
+    if changes is None:
+        return
+    _local.changes = None
+
+    with primary():
+        for index in _indexes:
+            index.refresh(changes.note_ids, changes.partitions, changes.tag_ids)
+    render_cache.invalidate_many(changes.note_ids)
+
+    versions = bump_versions(
+        ["notes"] + [get_partition_version_name(partition) for partition in changes.partitions]
+    )
+    for index in _indexes:
+        index.advance(versions)
+
+
+class VersionedIndex(object):
+    """Base class of the indexes which are built from the notes within the
+    memory of a process.
+
+    Changes of this process are applied by ``refresh`` once they have been
+    committed, see ``notes_changed``. Changes of other processes are noticed
+    by the versions of the partitions (see ``notes.scoping``) within
+    ``NOTES_CACHE``, if it is shared between the processes: within a scope
+    ``ensure_current`` reloads the partitions of the scope which have been
+    changed since they were loaded, without scope the whole index is
+    reloaded if any note has been changed.
+
+    Subclasses implement ``load``, ``load_partitions`` and ``refresh``.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        # The version of all notes and of the partitions the index has been
+        # loaded at.
+        self._version = None
+        self._versions = {}
+        # Set while the index holds data read within a transaction which
+        # hasn't been committed yet.
+        self._uncommitted = None
+        _indexes.append(self)
+
+    def load(self):
+        """Loads the whole index.
+        """
+        raise NotImplementedError
+
+    def load_partitions(self, partitions):
+        """Reloads the notes and tags of ``partitions``.
+        """
+        raise NotImplementedError
+
+    def refresh(self, note_ids, partitions, tag_ids):
+        """Updates the passed notes and tags, which have been changed by a
+        committed transaction of this process, see ``notes_changed``.
+        """
+        raise NotImplementedError
+
+    def ensure_current(self):
+        """Loads the index unless it is current within the current scope.
+        """
+        scope = get_current_scope()
+        connection = transaction.get_connection()
+        with self._lock:
+            if self._uncommitted is not None and not connection.in_atomic_block:
+                # Loaded within a transaction which has been rolled back
+                self._loaded = False
+                self._uncommitted = None
+
+            # The versions are read first, so changes made while loading
+            # cause another load on next use.
+            names = [get_partition_version_name(partition) for partition in scope.partitions] if scope else []
+            versions = get_versions(["notes"] + names)
+            version = versions.pop("notes")
+
+            if not self._loaded or (scope is None and self._version != version):
+                with primary():
+                    self.load()
+                self._version = version
+                self._versions = versions
+            else:
+                stale = [
+                    partition for partition, name in zip(scope.partitions, names)
+                    if self._versions.get(name) != versions[name]
+                ] if scope else []
+                if not stale:
+                    return
+                with primary():
+                    self.load_partitions(stale)
+                self._versions.update(versions)
+
+            if connection.in_atomic_block:
+                self._uncommitted = token = object()
+                transaction.on_commit(lambda: self._committed(token))
+
+    def advance(self, versions):
+        """Moves the index to the new versions of ``versions`` (as returned
+        by ``bump_versions``), which contain only changes of this process.
+        """
+        with self._lock:
+            if not self._loaded:
+                return
+            for name, (previous, version) in versions.items():
+                if name == "notes":
+                    if self._version == previous:
+                        self._version = version
+                elif self._versions.get(name) == previous:
+                    self._versions[name] = version
+
+    def _committed(self, token):
+        with self._lock:
+            if self._uncommitted is token:
+                self._uncommitted = None
+
+
+class RenderCache(object):
+    """Caches the rendered HTML of notes, see ``Note.render``.
+
+    An entry is valid as long as the version of its note hasn't changed. The
+    version is bumped (by ``invalidate``) whenever the note is saved or its
+    tags or files change, so it stands for the modification date as well as
+    for the state of the tags and files. As the version itself is kept within
+    the Django cache, a cache hit doesn't need any SQL.
+
+    There are two tiers: an LRU cache within the process, which holds
+    ``NOTES_RENDER_CACHE_SIZE`` notes, and optionally the Django cache named
+    by ``NOTES_RENDER_CACHE_BACKEND``, which is shared between processes.
+
+    Other processes only notice an invalidation if ``NOTES_CACHE`` is shared
+    between them, otherwise they keep serving the old HTML (see the
+    ``notes.W001`` check).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @property
+    def size(self):
+        return getattr(settings, "NOTES_RENDER_CACHE_SIZE", 500)
+
+    @property
+    def backend(self):
+        name = getattr(settings, "NOTES_RENDER_CACHE_BACKEND", None)
+        if name is None:
+            return None
+        return caches[name]
+
+    def version(self, note_id):
+        """Returns the version of the HTML of the note with ``note_id``.
+        """
+        return get_version("note:{}".format(int(note_id)))
+
+    def render(self, note_id, note=None):
+        """Returns the HTML of the note with ``note_id`` or None if it doesn't
+        exist.
+
+        The note is only loaded on a cache miss, unless it is passed.
+        """
+        note_id = int(note_id)
+        version = self.version(note_id)
+
+        with self._lock:
+            entry = self._entries.get(note_id)
+            if entry is not None and entry[0] == version:
+                self._entries[note_id] = self._entries.pop(note_id)
+                self.hits += 1
+                return entry[1]
+
+        html = None
+        backend = self.backend
+        key = "notes:render:{}:{}".format(note_id, version)
+        if backend is not None:
+            html = backend.get(key)
+
+        if html is not None:
+            with self._lock:
+                self.shared_hits += 1
+        else:
+            if note is None:
+                try:
+                    with primary():
+                        note = Note.objects.prefetch_related("tags", "file_set").get(pk=note_id)
+                except Note.DoesNotExist:
+                    return None
+
+            html = note.render()
+            if backend is not None:
+                backend.set(key, html)
+
+            with self._lock:
+                self.misses += 1
+
+        with self._lock:
+            self._entries.pop(note_id, None)
+            self._entries[note_id] = (version, html)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+        return html
+
+    def invalidate(self, note_id):
+        """Invalidates the HTML of the note with ``note_id`` by bumping its
+        version within ``NOTES_CACHE``.
+        """
+        bump_version("note:{}".format(note_id))
+        with self._lock:
+            self._entries.pop(int(note_id), None)
+
+    def invalidate_many(self, note_ids):
+        """Invalidates the HTML of the notes with ``note_ids`` by a constant
+        number of cache calls.
+        """
+        note_ids = [int(note_id) for note_id in note_ids]
+        bump_versions("note:{}".format(note_id) for note_id in note_ids)
+        with self._lock:
+            for note_id in note_ids:
+                self._entries.pop(note_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the hit and miss counters.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+            }
+
+
+render_cache = RenderCache()
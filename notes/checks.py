@@ -0,0 +1,29 @@
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core import checks
+
+# Cache backends which keep their values within the current process
+LOCAL_CACHE_BACKENDS = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+@checks.register(checks.Tags.caches)
+def check_notes_cache(app_configs, **kwargs):
+    """Warns if ``NOTES_CACHE`` isn't shared between processes, as the
+    render cache, the tag index and the search index of a process then miss
+    the changes made by other ones.
+    """
+    name = getattr(settings, "NOTES_CACHE", "default")
+    backend = settings.CACHES.get(name, {}).get("BACKEND")
+    if backend not in LOCAL_CACHE_BACKENDS:
+        return []
+
+    return [checks.Warning(
+        "NOTES_CACHE '{}' uses {}, which isn't shared between processes.".format(name, backend),
+        hint="Use a shared cache like memcached or Redis if more than one process serves the notes, "
+             "or add notes.W001 to SILENCED_SYSTEM_CHECKS if there is only one.",
+        id="notes.W001",
+    )]
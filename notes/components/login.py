@@ -6,15 +6,21 @@ from django.utils.translation import ugettext_lazy as _
 
 from cba import components
 
+from notes.instrumentation import instrument_handlers
+from notes.prebuilt import StaticComponent
 
-class Login(components.Group):
+
+@instrument_handlers()
+class Login(StaticComponent, components.Group):
     def init_components(self):
         self.initial_components = [
             components.Group(
+                id="login-container",
                 css_class="ui container form",
                 attributes={"style": "margin-top: 200px; width: 400px"},
                 initial_components=[
                     components.HTML(
+                        id="login-header",
                         tag="h2",
                         attributes={"style": "text-align:center"},
                         content=_("Please log in!"),
@@ -45,6 +51,10 @@ class Login(components.Group):
             ),
         ]
 
+    def is_static(self):
+        # The fields keep their input if the login failed
+        return not (self.get_component("username").value or self.get_component("password").value)
+
     def handle_login(self):
         username = self.get_component("username").value
         password = self.get_component("password").value
@@ -6,13 +6,16 @@ from django.utils.translation import ugettext_lazy as _
 from cba import components
 
 from notes.components.note_edit import NoteEdit
+from notes.instrumentation import instrument_handlers
+from notes.prebuilt import StaticComponent
 
 
-class MainMenu(components.Menu):
+@instrument_handlers()
+class MainMenu(StaticComponent, components.Menu):
     def init_components(self):
         self.initial_components = [
-            components.MenuItem(name="Add Note", handler={"click": "server:handle_add_note"}),
-            components.MenuItem(name="Logout", handler={"click": "server:handle_logout"}),
+            components.MenuItem(id="add-note", name="Add Note", handler={"click": "server:handle_add_note"}),
+            components.MenuItem(id="logout", name="Logout", handler={"click": "server:handle_logout"}),
         ]
 
     def handle_about_us(self):
@@ -1,4 +1,7 @@
-from django.db.models import Q
+import uuid
+
+from django.conf import settings
+from django.utils.html import format_html
 from django.utils.translation import ugettext_lazy as _
 
 from cba import components
@@ -6,60 +9,232 @@ from cba import utils
 
 # Circular import
 import notes.components.note_edit
+from notes import pagination
+from notes.bulk import delete_notes
+from notes.bulk import tag_notes
+from notes.bulk import untag_notes
+from notes.cache import bump_version
+from notes.cache import get_version
+from notes.cache import render_cache
+from notes.instrumentation import instrument_handlers
 from notes.models import Note
+from notes.query import get_note_query
+from notes.query import get_request_cache
+from notes.query import get_search_session_key
+from notes.search import note_search
+
+
+# The number of notes tables (i.e. pages or tabs) per session whose state is
+# kept, see ``get_sent_rows``
+TABLE_STATES = 10
+
+
+def get_sent_rows(token):
+    """Returns the state of the notes table with ``token`` the client got by
+    the last response, see ``NotesTableDataProvider.get_rows``.
+
+    Every page gets its own token, so the tabs of a session don't mix up
+    their states.
+    """
+    if not token:
+        return None
+
+    cache = get_request_cache()
+    if cache is None:
+        return dict(utils.get_from_session("notes-table-states") or []).get(token)
+
+    # Rows loaded within this request replace the state in the session, so
+    # it is read once per request.
+    key = "notes-table-rows:{}".format(token)
+    if key not in cache:
+        cache[key] = dict(utils.get_from_session("notes-table-states") or []).get(token)
+    return cache[key]
+
+
+def set_sent_rows(token, state):
+    """Stores ``state`` as state of the notes table with ``token``. Only the
+    states of the last ``TABLE_STATES`` used tables are kept.
+    """
+    _set_token_state("notes-table-states", token, state)
+
+
+def get_detail(note_id):
+    """Returns what the detail pane shows for the note with ``note_id``: the
+    note id and the version of its HTML, see ``RenderCache.version``.
+    """
+    if not note_id:
+        return None
+    return "{}:{}".format(note_id, render_cache.version(note_id))
+
+
+def get_sent_detail(token):
+    """Returns the detail (see ``get_detail``) the detail pane of the page
+    with ``token`` got by the last response.
+    """
+    if not token:
+        return None
+    return dict(utils.get_from_session("notes-detail-states") or []).get(token)
+
+
+def set_sent_detail(token, detail):
+    """Stores ``detail`` as the detail the pane of the page with ``token``
+    shows.
+    """
+    if token:
+        _set_token_state("notes-detail-states", token, detail)
+
+
+def _set_token_state(name, token, state):
+    states = [item for item in utils.get_from_session(name) or [] if item[0] != token]
+    states.append([token, state])
+    utils.set_to_session(name, states[-TABLE_STATES:])
+
+
+def get_page_count(state):
+    size = state["end"] - state["start"]
+    return -(-state["total"] // size) if size > 0 else 0
+
+
+def count_tags_and_notes(pairs):
+    """Returns the number of distinct tags and notes of (note id, tag id)
+    ``pairs``, as returned by ``tag_notes`` and ``untag_notes``.
+    """
+    return len(set(tag_id for note_id, tag_id in pairs)), len(set(note_id for note_id, tag_id in pairs))
+
+
+def get_selected_note_ids():
+    """Returns the ids of the notes selected by the checkboxes of the notes
+    table.
+    """
+    return [int(note_id) for note_id in utils.get_from_session("selected-note-ids") or []]
+
+
+class SelectNoteCell(object):
+    """The checkbox of a table row, which selects the note for the bulk
+    actions. Like ``DeleteNoteCell`` it holds only the note id and whether
+    it is checked.
+    """
+    __slots__ = ("note_id", "checked")
+
+    template = "<input type='checkbox' id='select-note-{}' {}/>"
+
+    def __init__(self, note_id, checked=False):
+        self.note_id = note_id
+        self.checked = checked
+
+    def __html__(self):
+        return format_html(self.template, self.note_id, "checked " if self.checked else "")
+
+    __str__ = __html__
+
+
+class DeleteNoteCell(object):
+    """The delete icon of a table row.
+
+    Unlike a component it holds only the note id, the markup is shared by
+    all rows. Clicks on it are handled by the click handler of the table,
+    see ``NoteDisplay.handle_table_click``.
+    """
+    __slots__ = ("note_id", )
+
+    template = "<i id='delete-note-{}' class='red large remove icon'></i>"
+
+    def __init__(self, note_id):
+        self.note_id = note_id
+
+    def __html__(self):
+        return format_html(self.template, self.note_id)
+
+    __str__ = __html__
+
+
+class TableRow(object):
+    """A row of the notes table as passed to the table.
+
+    It can be used like the dict of a row (``Row(**row)``).
+    """
+    __slots__ = ("component_value", "selected", "data")
+
+    css_class = "clickable"
+    fields = ("css_class", "component_value", "selected", "data")
+
+    def __init__(self, component_value, selected, data):
+        self.component_value = component_value
+        self.selected = selected
+        self.data = data
+
+    def keys(self):
+        return self.fields
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.fields]
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.fields else default
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
 
 
 class NotesTableDataProvider(components.TableDataProvider):
-    def total_rows(self):
-        return Note.objects.count()
+    """Provides the rows of the notes table.
 
-    def get_rows(self, start, end):
-        selected_tag_id = utils.get_from_session("selected-tag-id")
-        search = utils.get_from_session("search")
+    The rows are taken from the ``NoteQuery`` of the current request. With
+    ``paging="keyset"`` pages are fetched by a (modified, id) cursor instead
+    of OFFSET, see ``notes.pagination.KeysetPaginator``.
 
-        if selected_tag_id:
-            query = Note.objects.filter(tags__id=selected_tag_id)
-        else:
-            query = Note.objects.all()
+    The provider keeps the state of the delivered rows (their note ids and
+    signatures) within the session under the ``token`` of the page, so
+    ``NoteDisplay.refresh_table`` can send only the rows which have changed.
+    Without a token nothing is kept.
+    """
+    def __init__(self, paging="offset", token=None, *args, **kwargs):
+        super(NotesTableDataProvider, self).__init__(*args, **kwargs)
+        self.paging = paging
+        self.token = token
+        self.sent_state = None
+        self.state = None
 
-        if search:
-            query = query.filter(
-                Q(title__contains=search) |
-                Q(text__contains=search) |
-                Q(tags__name__contains=search)
-            )
+    def total_rows(self):
+        return get_note_query().count()
 
+    def get_rows(self, start, end):
+        note_query = get_note_query()
         current_note_id = utils.get_from_session("current-note-id")
+        selected_note_ids = set(get_selected_note_ids())
         notes = []
-        for note in query[start:end]:
-            if note.id == current_note_id:
-                selected = True
-            else:
-                selected = False
-
-            notes.append({
-                "css_class": "clickable",
-                "component_value": note.id,
-                "selected": selected,
-                "data": [
-                    note.title,
-                    ", ".join([tag.name for tag in note.tags.all()]),
-                    note.modified,
-                    components.HTML(
-                        tag="i",
-                        id="delete-note-{}".format(note.id),
-                        handler={"click": "server:handle_delete_note"},
-                        css_class="red large remove icon"
-                    ),
-                ]
-            })
+        signatures = []
+        for note in note_query.get_page(start, end, keyset=self.paging == "keyset"):
+            signatures.append([note.id, pagination.get_signature(note.title, note.tags, note.modified, note.file_count)])
+            notes.append(TableRow(note.id, note.id == current_note_id, [
+                SelectNoteCell(note.id, note.id in selected_note_ids),
+                note.title,
+                ", ".join(note.tags),
+                note.modified,
+                note.file_count,
+                DeleteNoteCell(note.id),
+            ]))
+
+        self.sent_state = get_sent_rows(self.token)
+        self.state = {
+            "start": start,
+            "end": end,
+            "total": note_query.count(),
+            "rows": signatures,
+            "selected": current_note_id,
+        }
+        if self.token:
+            set_sent_rows(self.token, self.state)
 
         return notes
 
     def get_headers(self):
-        return [_("Title"), _("Tags"), _("Modified"), _("Delete")]
+        return ["", _("Title"), _("Tags"), _("Modified"), _("Files"), _("Delete")]
 
 
+@instrument_handlers("delete_note", "delete_selected_notes")
 class NoteDisplay(components.Group):
     """Display the list of notes and the current note.
     """
@@ -70,13 +245,46 @@ class NoteDisplay(components.Group):
             icon="search",
             icon_position="right",
             placeholder=_("Search"),
-            handler={"keyup": "server:handle_search"},
+            # The client waits for a pause of typing before it sends the
+            # keystroke, so a word takes one request instead of one per key.
+            handler={"keyup": "server:handle_search", "delay": getattr(settings, "NOTES_SEARCH_DELAY_MS", 250)},
         )
 
+        self.data_provider = NotesTableDataProvider(paging="keyset")
+        # Identifies the notes table of this page, see ``get_sent_rows``. The
+        # token is set once the table has been loaded, so the state of this
+        # response is only kept for the requests of the page.
+        self.table_token = components.HiddenInput(id="table-token")
+        self.bulk_tags = components.TextInput(
+            id="bulk-tags",
+            icon="tags",
+            icon_position="right",
+            placeholder=_("Tags of the selected notes"),
+        )
+
+        self.bulk_actions = components.Group(
+            id="bulk-actions",
+            css_class="padding-bottom",
+            initial_components=[
+                self.bulk_tags,
+                components.Button(id="bulk-tag", value=_("Add tags"), handler={"click": "server:handle_bulk_tag"}),
+                components.Button(id="bulk-untag", value=_("Remove tags"), handler={"click": "server:handle_bulk_untag"}),
+                components.Button(
+                    id="bulk-delete",
+                    value=_("Delete selected"),
+                    css_class="red",
+                    handler={"click": "server:handle_bulk_delete"},
+                ),
+            ],
+        )
+
+        # One handler for the clicks on all rows, their checkboxes and delete
+        # icons
         self.notes_table = components.Table(
             id="notes-table",
             label=_("Notes"),
-            data_provider=NotesTableDataProvider(),
+            data_provider=self.data_provider,
+            handler={"click": "server:handle_table_click"},
         )
 
         self.note_detail = components.HTML(
@@ -90,12 +298,32 @@ class NoteDisplay(components.Group):
 
         self.initial_components = [
             self.search,
+            self.bulk_actions,
             self.notes_table,
             self.note_detail,
             self.images,
+            self.table_token,
         ]
 
+        self.detail = None
         self.load_current_note()
+        self.table_token.value = uuid.uuid4().hex
+
+    def refresh(self):
+        # The group contains the detail pane
+        super(NoteDisplay, self).refresh()
+        set_sent_detail(self.table_token.value, self.detail)
+
+    def refresh_note_detail(self):
+        """Sends the detail pane, unless the client already shows the current
+        note in its current version.
+        """
+        token = self.table_token.value
+        if self.detail is not None and get_sent_detail(token) == self.detail:
+            return
+
+        self.note_detail.refresh()
+        set_sent_detail(token, self.detail)
 
     def delete_note(self):
         """Deletes a note.
@@ -104,12 +332,10 @@ class NoteDisplay(components.Group):
         """
         if self.component_value:
             note_id = self.component_value.split("-")[-1]
-            try:
-                Note.objects.get(pk=note_id).delete()
-            except Note.DoesNotExist:
-                self.add_message(_("Note doesn't exist!"), type="error")
-            else:
+            if delete_notes([note_id]):
                 self.add_message(_("Note has been deleted!"), type="success")
+            else:
+                self.add_message(_("Note doesn't exist!"), type="error")
 
             self.load_current_note()
 
@@ -119,6 +345,84 @@ class NoteDisplay(components.Group):
         tag_explorer = self.get_component("tag-explorer")
         tag_explorer.refresh_all()
 
+    def delete_selected_notes(self):
+        """Deletes the selected notes.
+        """
+        deleted = delete_notes(get_selected_note_ids())
+        utils.set_to_session("selected-note-ids", [])
+        self.add_message(_("{} notes have been deleted!").format(len(deleted)), type="success")
+        self.remove_component(self.component_id)
+        self._bulk_changed()
+
+    def handle_bulk_delete(self):
+        """Handles click on the button which deletes the selected notes.
+        """
+        note_ids = get_selected_note_ids()
+        if not note_ids:
+            self.add_message(_("No notes are selected!"), type="error")
+            return
+
+        modal = components.ConfirmModal(
+            id="modal",
+            handler="delete_selected_notes",
+            header=_("Delete Notes!"),
+            text=_("Do you really want to delete {} notes?").format(len(note_ids)),
+        )
+
+        self.add_component(modal)
+        self.refresh()
+
+    def handle_bulk_tag(self):
+        """Adds the tags of the bulk tags field to the selected notes.
+        """
+        tag_names = self._get_bulk_tag_names()
+        if tag_names:
+            added = tag_notes(get_selected_note_ids(), tag_names)
+            self.add_message(
+                _("{} tags have been added to {} notes!").format(*count_tags_and_notes(added)), type="success",
+            )
+            self._bulk_changed()
+
+    def handle_bulk_untag(self):
+        """Removes the tags of the bulk tags field from the selected notes.
+        """
+        tag_names = self._get_bulk_tag_names()
+        if tag_names:
+            removed = untag_notes(get_selected_note_ids(), tag_names)
+            self.add_message(
+                _("{} tags have been removed from {} notes!").format(*count_tags_and_notes(removed)), type="success",
+            )
+            self._bulk_changed()
+
+    def handle_select_note(self):
+        """Handles click on the checkbox of a note.
+        """
+        note_id = int(self.component_value.split("-")[-1])
+        note_ids = get_selected_note_ids()
+        if note_id in note_ids:
+            note_ids.remove(note_id)
+        else:
+            note_ids.append(note_id)
+        utils.set_to_session("selected-note-ids", note_ids)
+
+    def _get_bulk_tag_names(self):
+        if not get_selected_note_ids():
+            self.add_message(_("No notes are selected!"), type="error")
+            return []
+
+        tag_names = [name.strip() for name in (self.bulk_tags.value or "").split(",") if name.strip()]
+        if not tag_names:
+            self.add_message(_("Please enter the tags!"), type="error")
+        return tag_names
+
+    def _bulk_changed(self):
+        # Refreshes the notes and tags once for all changed notes
+        self.load_current_note()
+        self.refresh()
+
+        tag_explorer = self.get_component("tag-explorer")
+        tag_explorer.refresh_all()
+
     def handle_delete_note(self):
         """Handles click on the delete link of a note.
         """
@@ -151,7 +455,7 @@ class NoteDisplay(components.Group):
             note_edit.get_component("note-id").value = note.id
             note_edit.get_component("title").value = note.title
             note_edit.get_component("text").value = note.text.raw
-            note_edit.get_component("tags").value = [tag.name for tag in note.tags.all()]
+            note_edit.set_tags([tag.name for tag in note.tags.all()])
             note_edit.get_component("files").existing_files = note.file_set.all()
 
             main = self.get_component("main")
@@ -159,68 +463,151 @@ class NoteDisplay(components.Group):
             main.refresh()
 
     def handle_search(self):
-        utils.set_to_session("search", self.search.value)
+        """Handles a keystroke within the search field.
+
+        Keystrokes which don't change the query are ignored, as well as the
+        ones which have been overtaken by a later keystroke of the session,
+        whose results would be overwritten. If the search found more notes
+        than ``NOTES_SEARCH_LIMIT`` the user is told so.
+        """
+        query = self.search.value or ""
+        if query == (utils.get_from_session("search") or ""):
+            return
+
+        utils.set_to_session("search", query)
+
+        # The sequence number of the keystroke within the session
+        sequence_name = "search:{}".format(get_search_session_key())
+        sequence = bump_version(sequence_name)
+
+        if get_version(sequence_name) != sequence:
+            return
         self.load_current_note()
+        if get_version(sequence_name) != sequence:
+            return
 
-        self.note_detail.refresh()
-        self.notes_table.refresh()
+        self.refresh_note_detail()
+        self.refresh_table()
 
-    def handle_show_note(self):
-        """Handles click to a table row of a note.
-        """
-        for row in self.get_component("notes-table").components:
-            row.selected = False
+        if get_note_query().truncated:
+            self.add_message(
+                _("Only the {} best matches are shown, please refine the search!").format(note_search.limit),
+                type="info",
+            )
 
-        self.get_component(self.component_id).selected = True
+    def handle_table_click(self):
+        """Handles a click into the notes table.
 
-        note_id = self.component_value
-        try:
-            note = Note.objects.get(pk=note_id)
-        except Note.DoesNotExist:
-            pass
+        The value is the id of the clicked checkbox ("select-note-<id>") or
+        delete icon ("delete-note-<id>") or the note id of the clicked row.
+        """
+        value = "{}".format(self.component_value)
+        if value.startswith("select-note-"):
+            self.handle_select_note()
+        elif value.startswith("delete-note-"):
+            self.handle_delete_note()
         else:
-            utils.set_to_session("current-note-id", note_id)
-            note_detail = self.get_component("note-detail")
-            note_detail.content = note.render()
-            note_detail.refresh()
+            self.handle_show_note()
+
+    def handle_show_note(self):
+        """Handles click to a table row of a note.
+
+        Only the rows whose selection flips are sent. The note isn't even
+        rendered if the client shows it already in its current version.
+        """
+        note_id = int(self.component_value)
+
+        # The render cache doesn't know about owners
+        if not get_note_query().contains(note_id):
+            return
+
+        self.detail = get_detail(note_id)
+        if self.detail != get_sent_detail(self.table_token.value):
+            html = render_cache.render(note_id)
+            if html is None:
+                return
+            self.note_detail.content = html
+            self.refresh_note_detail()
+
+        utils.set_to_session("current-note-id", note_id)
+
+        for row in self.notes_table.components:
+            selected = int(row.component_value) == note_id
+            if row.selected != selected:
+                row.selected = selected
+                row.refresh()
+
+        token = self.table_token.value
+        state = get_sent_rows(token)
+        if state:
+            state["selected"] = note_id
+            set_sent_rows(token, state)
+
+    def refresh_table(self):
+        """Sends the changes of the notes table to the client.
+
+        Rows are compared by position: a row which shows another note, whose
+        content has changed or whose selection flips is refreshed. Hence an
+        inserted or removed note refreshes only the rows from its position
+        on. The whole table is refreshed if the page, the number of its rows
+        or the number of pages has changed.
+        """
+        sent = self.data_provider.sent_state
+        state = self.data_provider.state
+        if (
+            not sent or not state or
+            any(sent.get(key) != state[key] for key in ("start", "end")) or
+            len(sent["rows"]) != len(state["rows"]) or
+            get_page_count(sent) != get_page_count(state)
+        ):
+            self.notes_table.refresh()
+            return
+
+        changed = set(
+            position for position, (old, new) in enumerate(zip(sent["rows"], state["rows"]))
+            if list(old) != list(new) or (old[0] == sent["selected"]) != (new[0] == state["selected"])
+        )
+        for position, row in enumerate(self.notes_table.components):
+            if position in changed:
+                row.refresh()
 
     def load_current_note(self):
         """Loads the current note.
 
-        Loads the current note into the table and detail view.
+        Loads the current note into the table and detail view. Both read
+        from the ``NoteQuery`` of the request, so the first page is loaded
+        only once.
         """
-        selected_tag_id = utils.get_from_session("selected-tag-id")
+        note_query = get_note_query()
         current_note_id = utils.get_from_session("current-note-id")
-        search = utils.get_from_session("search")
-
-        if selected_tag_id:
-            notes = Note.objects.filter(tags__id=selected_tag_id)
-        else:
-            notes = Note.objects.all()
 
-        if search:
-            notes = notes.filter(
-                Q(title__contains=search) |
-                Q(text__contains=search) |
-                Q(tags__name__contains=search)
-            )
+        current_note_text = None
+        if current_note_id and note_query.contains(current_note_id):
+            current_note_id = int(current_note_id)
+            current_note_text = self._render_note(current_note_id)
 
-        if notes.filter(pk=current_note_id).exists():
-            current_note = Note.objects.get(pk=current_note_id)
-            current_note_id = current_note.id
-            current_note_text = current_note.render()
-        else:
-            current_note = notes.first()
+        if current_note_text is None:
+            # The rows of the table don't contain the text, so the note is
+            # loaded only if it isn't cached.
+            current_note = note_query.first()
             if current_note:
                 current_note_id = current_note.id
-                current_note_text = current_note.render()
+                current_note_text = self._render_note(current_note.id)
             else:
                 current_note_id = None
                 current_note_text = ""
+                self.detail = None
 
         self.note_detail.content = current_note_text
 
-        if current_note:
-            utils.set_to_session("current-note-id", current_note.id)
+        if current_note_id:
+            utils.set_to_session("current-note-id", current_note_id)
 
+        self.data_provider.token = self.table_token.value or None
         self.notes_table.load_data()
+
+    def _render_note(self, note_id):
+        # The version is read before the HTML, so a change in between makes
+        # the detail older than the HTML, which is sent again then.
+        self.detail = get_detail(note_id)
+        return render_cache.render(note_id)
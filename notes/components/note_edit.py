@@ -1,5 +1,6 @@
 from __future__ import print_function, unicode_literals
 
+from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 
 from taggit.models import Tag
@@ -8,12 +9,18 @@ from cba import components
 from cba import utils
 
 from notes.components.note_display import NoteDisplay
-from notes.models import File
-from notes.models import Note
+from notes.editing import save_note
+from notes.instrumentation import instrument_handlers
+from notes.tagging import tag_completer
 
 
+@instrument_handlers()
 class NoteEdit(components.Group):
     """A component which renders the Note add/edit form.
+
+    The tag selector only contains the tags of the note. Further tags are
+    added by the autocompletion below it, which suggests the most used tags
+    starting with the typed text, see ``notes.tagging.TagCompleter``.
     """
     def init_components(self):
         tags = components.Select(id="tags", label="Tags", multiple=True)
@@ -29,11 +36,19 @@ class NoteEdit(components.Group):
                 multiple=True,
             ),
             tags,
+            components.TextInput(
+                id="tag-search",
+                icon="tags",
+                icon_position="right",
+                placeholder=_("Add tag"),
+                handler={"keyup": "server:handle_search_tags"},
+            ),
+            self._get_suggestions(""),
             components.Button(id="save-note", value=_("Save"), css_class="primary", handler={"click": "server:handle_save_note"}),
             components.Button(id="cancel", value=_("Cancel"), handler={"click": "server:handle_cancel"}),
         ]
 
-        self._load_tags(tags)
+        tags.options = []
 
     def handle_cancel(self):
         """Handles click on the cancel button.
@@ -74,35 +89,15 @@ class NoteEdit(components.Group):
             text.refresh()
 
         if title.value != "" and text.value != "":
-            if note_id.value:
-                # Edit an existing note
-                note = Note.objects.get(pk=note_id.value)
-                note.title = title.value
-                note.text = text.value
-                note.save()
-
-                # Create files
-                for file_value in files.value:
-                    File.objects.create(note=note, file=file_value)
-
-                # Delete files
-                for to_delete_id in files.to_delete:
-                    try:
-                        File.objects.get(pk=to_delete_id).delete()
-                    except File.DoesNotExist:
-                        pass
+            note, created = save_note(
+                note_id.value, title.value, text.value, tags.value or [],
+                uploads=files.value, delete_file_ids=files.to_delete,
+            )
 
-                self.add_message(_("Note has been modified!"), type="success")
-            else:
-                # Add a new note
-                note = Note.objects.create(title=title.value, text=text.value)
+            if created:
                 self.add_message(_("Note has been added!"), type="success")
-
-            # Refresh tags
-            note.tags.clear()
-            if tags.value:
-                for value in tags.value:
-                    note.tags.add(value)
+            else:
+                self.add_message(_("Note has been modified!"), type="success")
 
             # Replace edit view with note display view and select the current
             # added / edited note
@@ -119,10 +114,72 @@ class NoteEdit(components.Group):
             tag_explorer = self.get_component("tag-explorer")
             tag_explorer.refresh_all()
 
-    def _load_tags(self, select):
-        select.options = []
-        for tag in Tag.objects.all().order_by("name"):
-            select.options.append({
-                "name": tag.name,
-                "value": tag.name,
-            })
+    def handle_search_tags(self):
+        """Handles a keystroke within the tag search field.
+        """
+        suggestions = self._get_suggestions(self.get_component("tag-search").value or "")
+        self.replace_component("tag-suggestions", suggestions)
+        suggestions.refresh()
+
+    def handle_add_tag(self):
+        """Handles click on a suggested tag.
+        """
+        tag_search = self.get_component("tag-search")
+        tag_id = self.component_value.split("-")[-1]
+        if tag_id == "new":
+            name = (tag_search.value or "").strip()
+        else:
+            name = Tag.objects.filter(pk=tag_id).values_list("name", flat=True).first()
+
+        tags = self.get_component("tags")
+        if name and name not in (tags.value or []):
+            self.set_tags((tags.value or []) + [name])
+            tags.refresh()
+
+        tag_search.value = ""
+        tag_search.refresh()
+
+        suggestions = self._get_suggestions("")
+        self.replace_component("tag-suggestions", suggestions)
+        suggestions.refresh()
+
+    def set_tags(self, names):
+        """Sets the tags of the note. Only these are sent as options.
+        """
+        select = self.get_component("tags")
+        select.value = list(names)
+        select.options = [{"name": name, "value": name} for name in names]
+
+    def _get_suggestions(self, query):
+        items = []
+
+        query = query.strip()
+        if query:
+            selected = set(self.get_component("tags").value or [])
+            limit = getattr(settings, "NOTES_TAG_COMPLETIONS", 10)
+            for tag_id, name, count in tag_completer.complete(query, limit):
+                if name not in selected:
+                    items.append(
+                        components.MenuItem(
+                            id="tag-suggestion-{}".format(tag_id),
+                            name=name,
+                            label=count,
+                            handler={"click": "server:handle_add_tag"},
+                        )
+                    )
+
+            if not tag_completer.exists(query):
+                items.append(
+                    components.MenuItem(
+                        id="tag-suggestion-new",
+                        name=_("Add \"{}\"").format(query),
+                        handler={"click": "server:handle_add_tag"},
+                    )
+                )
+
+        return components.HTML(
+            id="tag-suggestions",
+            tag="div",
+            css_class="ui vertical menu",
+            initial_components=items,
+        )
@@ -1,18 +1,36 @@
-from django.db.models import Count
 from django.utils.translation import ugettext_lazy as _
 
-from taggit.models import Tag
-
 from cba import components
 from cba import utils
 
+from notes.facets import tag_index
+from notes.instrumentation import instrument_handlers
+from notes.models import TagStat
+from notes.query import get_note_query
+from notes.query import get_selected_tags
+
 
+@instrument_handlers()
 class TagExplorer(components.Menu):
+    """Displays the tags with their note counts and allows to select several
+    of them.
+
+    Notes are filtered by all (AND) or any (OR) of the selected tags. In AND
+    mode the count of a tag is the number of notes within the current
+    selection which also have this tag.
+    """
     def __init__(self, *args, **kwargs):
         super(TagExplorer, self).__init__(*args, **kwargs)
         self.direction = "vertical"
 
     def init_components(self):
+        tag_ids, mode = get_selected_tags()
+
+        if mode == "and":
+            mode_name = _("Match all tags")
+        else:
+            mode_name = _("Match any tag")
+
         self.initial_components = [
             components.HTML(
                 tag="div",
@@ -21,32 +39,61 @@ class TagExplorer(components.Menu):
                         attributes={"style": "color:red"},
                         id="reset-tags",
                         name=_("Reset"),
-                        handler={"click": "server:handle_reset_tags"})
+                        handler={"click": "server:handle_reset_tags"}),
+                    components.MenuItem(
+                        id="tag-mode",
+                        name=mode_name,
+                        handler={"click": "server:handle_toggle_tag_mode"}),
                 ]
             )
         ]
 
-        for tag in Tag.objects.annotate(note_count=Count("note")).filter(note_count__gt=0).order_by("-note_count"):
+        # The tags of the notes of the current user only
+        tags = TagStat.objects.get_counts()
+
+        if tag_ids and mode == "and":
+            counts = tag_index.counts(get_note_query().selection)
+            tags = [(tag_id, name, counts.get(tag_id, 0)) for tag_id, name, note_count in tags]
+            tags = [(tag_id, name, count) for tag_id, name, count in tags if count or tag_id in tag_ids]
+            tags.sort(key=lambda item: -item[2])
+
+        for tag_id, name, count in tags:
             self.initial_components.append(
                 components.MenuItem(
-                    id="tag-{}".format(tag.id),
-                    name="{}".format(tag.name),
-                    label=tag.note_count,
+                    id="tag-{}".format(tag_id),
+                    name="{}".format(name),
+                    label=count,
+                    css_class="active" if tag_id in tag_ids else "",
                     handler={"click": "server:handle_select_tag"})
             )
 
     def handle_reset_tags(self):
-        utils.set_to_session("selected-tag-id", None)
-        notes_view = self.get_component("note-view")
-        notes_view.load_current_note()
-        notes_view.refresh()
+        utils.set_to_session("selected-tag-ids", [])
+        self._load_notes()
 
     def handle_select_tag(self):
-        tag_id = self.component_value.split("-")[1]
-        utils.set_to_session("selected-tag-id", tag_id)
-        notes_view = self.get_component("note-view")
-        notes_view.load_current_note()
-        notes_view.refresh()
+        tag_id = int(self.component_value.split("-")[1])
+        tag_ids, mode = get_selected_tags()
+
+        if tag_id in tag_ids:
+            tag_ids.remove(tag_id)
+        else:
+            tag_ids.append(tag_id)
+
+        utils.set_to_session("selected-tag-ids", tag_ids)
+        self._load_notes()
+
+    def handle_toggle_tag_mode(self):
+        tag_ids, mode = get_selected_tags()
+        utils.set_to_session("tag-mode", "or" if mode == "and" else "and")
+        self._load_notes()
 
     def clear(self):
         self._components.clear()
+
+    def _load_notes(self):
+        notes_view = self.get_component("note-view")
+        notes_view.load_current_note()
+        notes_view.refresh_note_detail()
+        notes_view.refresh_table()
+        self.refresh_all()
@@ -0,0 +1,144 @@
+from __future__ import print_function, unicode_literals
+
+import bisect
+import random
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import transaction
+
+from taggit.models import TaggedItem
+
+from notes.bulk import rebuild_indexes
+from notes.models import File
+from notes.models import Note
+from notes.models import bulk_create_notes
+from notes.models import delete_rows
+from notes.models import get_tagged_items
+from notes.storage import attach_files
+from notes.storage import delete_files
+from notes.tagging import get_or_create_tags
+
+WORDS = (
+    "alpha beta gamma delta server client deploy backup restore database index query cache "
+    "python django release branch merge review ticket meeting budget invoice customer report "
+    "network firewall proxy certificate password rotate monitor alert disk memory cpu latency "
+    "kernel upgrade rollback migration schema table column backlog sprint roadmap design "
+    "draft idea recipe travel book movie garden music health family project note todo"
+).split()
+
+
+class CorpusGenerator(object):
+    """Generates a synthetic notes corpus for benchmarks.
+
+    Note sizes are log-normally distributed around ``text_size`` characters
+    of markdown, tags are drawn from a vocabulary of ``tag_count`` tags with
+    Zipfian frequencies (exponent ``zipf``) and ``attachment_ratio`` of the
+    notes get a small attachment. The notes are spread evenly over the users
+    with ``owner_ids``, if given.
+    """
+    def __init__(self, tag_count=1000, zipf=1.1, tags_per_note=3, text_size=2000,
+                 attachment_ratio=0.05, owner_ids=None, seed=None):
+        self.random = random.Random(seed)
+        self.owner_ids = list(owner_ids or [])
+        self.tag_names = ["tag{}".format(i) for i in range(tag_count)]
+        self.tags_per_note = tags_per_note
+        self.text_size = text_size
+        self.attachment_ratio = attachment_ratio
+
+        self._cumulative = []
+        total = 0.0
+        for rank in range(1, tag_count + 1):
+            total += 1.0 / rank ** zipf
+            self._cumulative.append(total)
+
+    def generate(self, count, batch_size=1000, stdout=None):
+        """Creates ``count`` notes in batches and returns the number of
+        created notes.
+        """
+        tags = dict((tag.name, tag) for tag in get_or_create_tags(self.tag_names))
+        content_type = ContentType.objects.get_for_model(Note)
+
+        created = 0
+        while created < count:
+            size = min(batch_size, count - created)
+            with transaction.atomic():
+                notes = self._create_notes(size)
+                TaggedItem.objects.bulk_create([
+                    TaggedItem(tag=tags[name], content_type=content_type, object_id=note.id)
+                    for note in notes for name in self.random_tags()
+                ])
+                for note in notes:
+                    if self.random.random() < self.attachment_ratio:
+                        attach_files(note, [self.random_attachment()])
+
+            created += size
+            if stdout is not None:
+                stdout.write("{} / {} notes".format(created, count))
+
+        rebuild_indexes()
+
+        return created
+
+    def random_tags(self):
+        count = max(1, int(self.random.expovariate(1.0 / self.tags_per_note)))
+        names = set()
+        for i in range(count):
+            position = bisect.bisect_left(self._cumulative, self.random.random() * self._cumulative[-1])
+            names.add(self.tag_names[min(position, len(self.tag_names) - 1)])
+        return names
+
+    def random_text(self):
+        size = int(self.random.lognormvariate(0, 1) * self.text_size)
+        blocks = []
+        length = 0
+        while length < size:
+            kind = self.random.random()
+            if kind < 0.15:
+                block = "## " + self._sentence(3)
+            elif kind < 0.35:
+                block = "\n".join("* " + self._sentence(6) for i in range(self.random.randint(2, 6)))
+            elif kind < 0.45:
+                block = "\n".join("    " + self._sentence(5) for i in range(self.random.randint(2, 8)))
+            else:
+                block = " ".join(self._sentence(12) + "." for i in range(self.random.randint(2, 6)))
+            blocks.append(block)
+            length += len(block)
+        return "\n\n".join(blocks)
+
+    def random_owner_id(self):
+        if not self.owner_ids:
+            return None
+        return self.random.choice(self.owner_ids)
+
+    def random_attachment(self):
+        number = self.random.randint(0, 99)
+        content = "attachment {}\n".format(number).encode("utf-8") * 100
+        return SimpleUploadedFile("attachment-{}.txt".format(number), content)
+
+    def _create_notes(self, size):
+        return bulk_create_notes([
+            Note(title=self._sentence(4)[:50], text=self.random_text(), owner_id=self.random_owner_id())
+            for i in range(size)
+        ])
+
+    def _sentence(self, words):
+        return " ".join(self.random.choice(WORDS) for i in range(words)).capitalize()
+
+
+def clear_notes():
+    """Deletes all notes including their tags and files.
+
+    The rows are deleted set-based without signals, which would be sent per
+    note and file. The indexes are rebuilt once afterwards.
+    """
+    with transaction.atomic():
+        get_tagged_items().delete()
+
+        file_ids = list(File.objects.values_list("id", flat=True))
+        for i in range(0, len(file_ids), 500):
+            delete_files(file_ids[i:i + 500])
+
+        delete_rows(Note, Note.objects.unscoped().values_list("id", flat=True))
+
+    rebuild_indexes()
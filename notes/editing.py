@@ -0,0 +1,38 @@
+from __future__ import print_function, unicode_literals
+
+from django.db import transaction
+
+from notes.models import File
+from notes.models import Note
+from notes.scoping import get_current_scope
+from notes.storage import attach_files
+from notes.tagging import sync_tags
+
+
+@transaction.atomic
+def save_note(note_id, title, text, tag_names, uploads=(), delete_file_ids=()):
+    """Adds a note or, if ``note_id`` is given, modifies the existing one.
+    Added notes belong to the user of the current scope.
+
+    ``uploads`` are attached to the note and the files with
+    ``delete_file_ids`` are removed from it. Returns the note and whether it
+    has been added.
+    """
+    if note_id:
+        # Read from the primary, see notes.routers
+        note = Note.objects.select_for_update().get(pk=note_id)
+        note.title = title
+        note.text = text
+        note.save()
+
+        attach_files(note, uploads)
+        File.objects.filter(pk__in=delete_file_ids, note=note).delete()
+        created = False
+    else:
+        scope = get_current_scope()
+        note = Note.objects.create(title=title, text=text, owner_id=scope.user_id if scope is not None else None)
+        created = True
+
+    sync_tags(note, tag_names)
+
+    return note, created
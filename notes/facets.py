@@ -0,0 +1,292 @@
+from __future__ import print_function, unicode_literals
+
+from notes.cache import VersionedIndex
+from notes.models import Note
+from notes.models import get_tagged_items
+from notes.scoping import filter_partitions
+from notes.scoping import get_partition
+
+# Bitmaps are split into chunks of 2 ** CHUNK_BITS note ids, so a tag only
+# takes memory for the id ranges it is used within.
+CHUNK_BITS = 12
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+
+def popcount(value):
+    return bin(value).count("1")
+
+
+class Bitmap(object):
+    """A compressed set of note ids.
+
+    The ids are stored in chunks: a dict which maps the high bits of an id to
+    an int whose bits are the low bits of the ids within the chunk. Empty
+    chunks are dropped.
+    """
+    __slots__ = ("chunks", )
+
+    def __init__(self, chunks=None):
+        self.chunks = chunks or {}
+
+    def add(self, note_id):
+        key = note_id >> CHUNK_BITS
+        self.chunks[key] = self.chunks.get(key, 0) | (1 << (note_id & CHUNK_MASK))
+
+    def discard(self, note_id):
+        key = note_id >> CHUNK_BITS
+        value = self.chunks.get(key, 0) & ~(1 << (note_id & CHUNK_MASK))
+        if value:
+            self.chunks[key] = value
+        else:
+            self.chunks.pop(key, None)
+
+    def __and__(self, other):
+        if len(other.chunks) < len(self.chunks):
+            self, other = other, self
+
+        chunks = {}
+        for key, value in self.chunks.items():
+            value &= other.chunks.get(key, 0)
+            if value:
+                chunks[key] = value
+        return Bitmap(chunks)
+
+    def __or__(self, other):
+        chunks = dict(self.chunks)
+        for key, value in other.chunks.items():
+            chunks[key] = chunks.get(key, 0) | value
+        return Bitmap(chunks)
+
+    def __contains__(self, note_id):
+        return bool(self.chunks.get(note_id >> CHUNK_BITS, 0) >> (note_id & CHUNK_MASK) & 1)
+
+    def __len__(self):
+        return sum(popcount(value) for value in self.chunks.values())
+
+    def __bool__(self):
+        return bool(self.chunks)
+
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        for key in sorted(self.chunks):
+            value = self.chunks[key]
+            offset = key << CHUNK_BITS
+            while value:
+                low = value & -value
+                yield offset + low.bit_length() - 1
+                value ^= low
+
+    def intersection_count(self, other):
+        """Returns the number of ids within both bitmaps without building the
+        intersection.
+        """
+        if len(other.chunks) < len(self.chunks):
+            self, other = other, self
+
+        total = 0
+        for key, value in self.chunks.items():
+            other_value = other.chunks.get(key)
+            if other_value:
+                total += popcount(value & other_value)
+        return total
+
+
+class TagIndex(VersionedIndex):
+    """In-memory index of the notes per tag.
+
+    Holds a ``Bitmap`` of note ids per tag and, for small selections, the tag
+    ids per note. It is loaded lazily with two queries and afterwards
+    updated incrementally, by the notes changed within committed
+    transactions (see ``notes.cache.notes_changed``). It serves multi-tag AND/OR selections and the co-occurrence counts of
+    the tags within a selection without querying the database.
+
+    The notes of every partition (see ``notes.scoping.get_partition``) are
+    kept as bitmap, too, so selections are restricted to the notes of a
+    scope by ``visible``.
+
+    Changes of other processes are picked up by reloading the changed
+    partitions, see ``notes.cache.VersionedIndex``.
+    """
+    def __init__(self):
+        super(TagIndex, self).__init__()
+        self._bitmaps = {}
+        self._note_tags = {}
+        self._postings = 0
+        self._partitions = {}
+        self._note_partitions = {}
+
+    def load(self):
+        with self._lock:
+            self._bitmaps = {}
+            self._note_tags = {}
+            self._postings = 0
+            self._partitions = {}
+            self._note_partitions = {}
+            self._loaded = True
+
+            notes = Note.objects.unscoped()
+            for note_id, owner_id, team_id in notes.values_list("id", "owner_id", "team_id").iterator():
+                self.set_partition(note_id, get_partition(owner_id, team_id))
+
+            note_tags = {}
+            items = get_tagged_items().filter(object_id__in=notes.values("id"))
+            for tag_id, note_id in items.values_list("tag_id", "object_id").iterator():
+                note_tags.setdefault(note_id, []).append(tag_id)
+
+            for note_id, tag_ids in note_tags.items():
+                self.add(note_id, tag_ids)
+
+    def load_partitions(self, partitions):
+        with self._lock:
+            note_ids = set()
+            for partition in partitions:
+                note_ids.update(self._partitions.get(partition, ()))
+            self._reload_notes(note_ids, filter_partitions(Note.objects.unscoped(), partitions))
+
+    def refresh(self, note_ids, partitions, tag_ids):
+        with self._lock:
+            if self._loaded:
+                note_ids = sorted(note_ids)
+                for i in range(0, len(note_ids), 500):
+                    chunk = note_ids[i:i + 500]
+                    self._reload_notes(chunk, Note.objects.unscoped().filter(pk__in=chunk))
+
+    def _reload_notes(self, note_ids, notes):
+        # Replaces the partitions and tags of the notes with ``note_ids`` by
+        # the ones of the queryset ``notes``. Must be called with the lock
+        # held.
+        partitions = dict(
+            (note_id, get_partition(owner_id, team_id))
+            for note_id, owner_id, team_id in notes.values_list("id", "owner_id", "team_id")
+        )
+        note_tags = {}
+        items = get_tagged_items().filter(object_id__in=notes.values("id"))
+        for tag_id, note_id in items.values_list("tag_id", "object_id"):
+            note_tags.setdefault(note_id, []).append(tag_id)
+
+        for note_id in set(note_ids) | set(partitions):
+            self.remove(note_id, self._note_tags.get(note_id, ()))
+            self.discard_note(note_id)
+        for note_id, partition in partitions.items():
+            self.set_partition(note_id, partition)
+        for note_id, tag_ids in note_tags.items():
+            self.add(note_id, tag_ids)
+
+    def clear(self):
+        """Drops the index. It is loaded again on next use.
+        """
+        with self._lock:
+            self._loaded = False
+            self._bitmaps = {}
+            self._note_tags = {}
+            self._postings = 0
+            self._partitions = {}
+            self._note_partitions = {}
+
+    def set_partition(self, note_id, partition):
+        """Moves the note with ``note_id`` into ``partition``.
+        """
+        with self._lock:
+            if self._loaded and self._note_partitions.get(note_id) != partition:
+                self.discard_note(note_id)
+                self._partitions.setdefault(partition, Bitmap()).add(note_id)
+                self._note_partitions[note_id] = partition
+
+    def discard_note(self, note_id):
+        """Removes the note with ``note_id`` from its partition. Its tags are
+        removed by ``remove``.
+        """
+        with self._lock:
+            partition = self._note_partitions.pop(note_id, None)
+            if partition is not None:
+                bitmap = self._partitions[partition]
+                bitmap.discard(note_id)
+                if not bitmap:
+                    del self._partitions[partition]
+
+    def visible(self, partitions):
+        """Returns the bitmap of the notes within the passed partitions.
+        """
+        with self._lock:
+            self.ensure_current()
+
+            result = Bitmap()
+            for partition in partitions:
+                result = result | self._partitions.get(partition, Bitmap())
+            return result
+
+    def add(self, note_id, tag_ids):
+        with self._lock:
+            if self._loaded:
+                current = set(self._note_tags.get(note_id, ()))
+                for tag_id in set(tag_ids) - current:
+                    self._bitmaps.setdefault(tag_id, Bitmap()).add(note_id)
+                    current.add(tag_id)
+                    self._postings += 1
+                self._note_tags[note_id] = tuple(current)
+
+    def remove(self, note_id, tag_ids):
+        with self._lock:
+            if self._loaded:
+                current = set(self._note_tags.get(note_id, ()))
+                for tag_id in current & set(tag_ids):
+                    bitmap = self._bitmaps[tag_id]
+                    bitmap.discard(note_id)
+                    if not bitmap:
+                        del self._bitmaps[tag_id]
+                    current.discard(tag_id)
+                    self._postings -= 1
+
+                if current:
+                    self._note_tags[note_id] = tuple(current)
+                else:
+                    self._note_tags.pop(note_id, None)
+
+    def select(self, tag_ids, mode="and"):
+        """Returns the bitmap of the notes with all (``mode="and"``) or any
+        (``mode="or"``) of the passed tags.
+        """
+        with self._lock:
+            self.ensure_current()
+
+            bitmaps = [self._bitmaps.get(int(tag_id), Bitmap()) for tag_id in tag_ids]
+            if not bitmaps:
+                return Bitmap()
+
+            result = Bitmap(dict(bitmaps[0].chunks))
+            for bitmap in bitmaps[1:]:
+                if mode == "and":
+                    result = result & bitmap
+                else:
+                    result = result | bitmap
+            return result
+
+    def counts(self, selection):
+        """Returns the number of notes of every tag within ``selection`` as
+        dict tag id -> count. Tags without any note within the selection are
+        left out.
+        """
+        with self._lock:
+            self.ensure_current()
+
+            # Either walk the tags of the selected notes or intersect the
+            # bitmaps of all tags, whatever touches fewer entries.
+            size = len(selection)
+            tags_per_note = self._postings / float(len(self._note_tags) or 1)
+            chunks = sum(len(bitmap.chunks) for bitmap in self._bitmaps.values())
+
+            counts = {}
+            if size * tags_per_note < chunks:
+                for note_id in selection:
+                    for tag_id in self._note_tags.get(note_id, ()):
+                        counts[tag_id] = counts.get(tag_id, 0) + 1
+            else:
+                for tag_id, bitmap in self._bitmaps.items():
+                    count = bitmap.intersection_count(selection)
+                    if count:
+                        counts[tag_id] = count
+            return counts
+
+
+tag_index = TagIndex()
@@ -0,0 +1,182 @@
+from __future__ import division, print_function, unicode_literals
+
+import bisect
+import functools
+import logging
+import threading
+import timeit
+from collections import Counter
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+logger = logging.getLogger("notes.slow_handlers")
+
+# Upper bounds of the histogram buckets
+TIME_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def is_enabled():
+    return getattr(settings, "NOTES_INSTRUMENTATION", False)
+
+
+class Histogram(object):
+    """A histogram with fixed buckets.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket which contains the
+        ``percent`` percentile.
+        """
+        if not self.count:
+            return None
+
+        rank = percent / 100 * self.count
+        total = 0
+        for i, count in enumerate(self.counts):
+            total += count
+            if total >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def as_dict(self):
+        return OrderedDict([
+            ("count", self.count),
+            ("mean", self.sum / self.count if self.count else None),
+            ("p50", self.percentile(50)),
+            ("p90", self.percentile(90)),
+            ("p99", self.percentile(99)),
+            ("max", self.max),
+            ("buckets", OrderedDict(
+                [("<={}".format(bound), count) for bound, count in zip(self.buckets, self.counts)] +
+                [("inf", self.counts[-1])]
+            )),
+        ])
+
+
+class HandlerStats(object):
+    def __init__(self):
+        self.wall_time = Histogram(TIME_BUCKETS)
+        self.sql_time = Histogram(TIME_BUCKETS)
+        self.queries = Histogram(COUNT_BUCKETS)
+        self.duplicated_queries = Histogram(COUNT_BUCKETS)
+        self.response_size = Histogram(SIZE_BUCKETS)
+
+    def as_dict(self):
+        return OrderedDict([
+            ("wall_time_ms", self.wall_time.as_dict()),
+            ("sql_time_ms", self.sql_time.as_dict()),
+            ("queries", self.queries.as_dict()),
+            ("duplicated_queries", self.duplicated_queries.as_dict()),
+            ("response_bytes", self.response_size.as_dict()),
+        ])
+
+
+class MetricsRegistry(object):
+    """Collects the metrics of the server handlers within the process.
+
+    Handlers record their wall time and SQL queries by ``instrument``. The
+    size of the response is recorded by ``NotesView`` for all handlers which
+    ran within the request.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {}
+
+    def record(self, name, wall_time, queries):
+        sql = [query["sql"] for query in queries]
+        sql_time = sum(float(query["time"]) for query in queries) * 1000
+        duplicated = sum(count - 1 for count in Counter(sql).values())
+
+        with self._lock:
+            stats = self._stats.setdefault(name, HandlerStats())
+            stats.wall_time.add(wall_time)
+            stats.sql_time.add(sql_time)
+            stats.queries.add(len(sql))
+            stats.duplicated_queries.add(duplicated)
+
+        handlers = getattr(self._local, "handlers", None)
+        if handlers is not None:
+            handlers.append(name)
+
+        threshold = getattr(settings, "NOTES_SLOW_HANDLER_MS", None)
+        if threshold is not None and wall_time > threshold:
+            logger.warning(
+                "Slow handler %s: %.1fms, %d queries (%d duplicated) in %.1fms\n%s",
+                name, wall_time, len(sql), duplicated, sql_time, "\n".join(sql),
+            )
+
+    def start_request(self):
+        self._local.handlers = []
+
+    def finish_request(self, response_size):
+        handlers = getattr(self._local, "handlers", None) or []
+        self._local.handlers = None
+
+        with self._lock:
+            for name in handlers:
+                self._stats[name].response_size.add(response_size)
+
+    def snapshot(self):
+        with self._lock:
+            return OrderedDict(
+                (name, self._stats[name].as_dict()) for name in sorted(self._stats)
+            )
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+
+registry = MetricsRegistry()
+
+
+def instrument(name):
+    """Decorates a handler, so that its wall time and SQL queries are
+    recorded as ``name`` if ``NOTES_INSTRUMENTATION`` is enabled.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return func(*args, **kwargs)
+
+            context = CaptureQueriesContext(connection)
+            start = timeit.default_timer()
+            try:
+                with context:
+                    return func(*args, **kwargs)
+            finally:
+                wall_time = (timeit.default_timer() - start) * 1000
+                registry.record(name, wall_time, context.captured_queries)
+        return wrapper
+    return decorator
+
+
+def instrument_handlers(*names):
+    """Class decorator which instruments all server handlers (``handle_*``)
+    of a component and the additionally passed method ``names``.
+    """
+    def decorator(cls):
+        for attr, value in list(vars(cls).items()):
+            if callable(value) and (attr.startswith("handle_") or attr in names):
+                setattr(cls, attr, instrument("{}.{}".format(cls.__name__, attr))(value))
+        return cls
+    return decorator
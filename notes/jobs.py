@@ -0,0 +1,139 @@
+from __future__ import print_function, unicode_literals
+
+import json
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+from django.db import transaction
+from django.db.models import F
+
+from notes.models import Job
+
+logger = logging.getLogger("notes.jobs")
+
+_registry = {}
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def register(name):
+    """Registers the decorated function as job ``name``. Its arguments must
+    be JSON serializable.
+    """
+    def decorator(func):
+        _registry[name] = func
+        return func
+    return decorator
+
+
+def is_sync():
+    return getattr(settings, "NOTES_JOBS_SYNC", False)
+
+
+def get_executor():
+    """Returns the worker pool which runs the jobs. Its size is taken from the
+    ``NOTES_JOB_WORKERS`` setting.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, "NOTES_JOB_WORKERS", 2))
+    return _executor
+
+
+def enqueue(name, **kwargs):
+    """Runs the job ``name`` with ``kwargs`` in the background.
+
+    The job is stored within the current transaction and handed to the
+    worker pool once it is committed, so it is neither lost if the process
+    stops (see the ``run_jobs`` management command) nor run for a rolled back
+    change. With ``NOTES_JOBS_SYNC`` the job is run immediately instead.
+
+    Returns the stored job, or None if it has been run synchronously.
+    """
+    if name not in _registry:
+        raise ValueError("Unknown job: {}".format(name))
+
+    if is_sync():
+        _registry[name](**kwargs)
+        return None
+
+    job = Job.objects.create(name=name, payload=json.dumps(kwargs))
+    transaction.on_commit(lambda: get_executor().submit(_run_job_in_worker, job.id))
+    return job
+
+
+def run_job(job_id):
+    """Runs the pending job with ``job_id`` unless another worker has claimed
+    it already. Returns True if the job has been run successfully.
+    """
+    claimed = Job.objects.filter(pk=job_id, status=Job.PENDING).update(
+        status=Job.RUNNING, attempts=F("attempts") + 1,
+    )
+    if not claimed:
+        return False
+
+    job = Job.objects.get(pk=job_id)
+    try:
+        _registry[job.name](**json.loads(job.payload))
+    except Exception:
+        logger.exception("Job %s (%s) failed", job.id, job.name)
+        if job.attempts >= getattr(settings, "NOTES_JOB_MAX_ATTEMPTS", 3):
+            status = Job.FAILED
+        else:
+            status = Job.PENDING
+        Job.objects.filter(pk=job.id).update(status=status, error=traceback.format_exc())
+        return False
+
+    job.delete()
+    return True
+
+
+def run_pending(limit=None):
+    """Runs the pending jobs, oldest first, within the current thread.
+    Returns the number of jobs which have been run successfully.
+    """
+    done = tried = 0
+    last_id = 0
+    while True:
+        job_ids = list(
+            Job.objects.filter(status=Job.PENDING, id__gt=last_id).order_by("id").values_list("id", flat=True)[:100]
+        )
+        if not job_ids:
+            return done
+
+        for job_id in job_ids:
+            if limit is not None and tried >= limit:
+                return done
+
+            last_id = job_id
+            tried += 1
+            if run_job(job_id):
+                done += 1
+
+
+def _run_job_in_worker(job_id):
+    try:
+        if not run_job(job_id):
+            _schedule_retry(job_id)
+    finally:
+        connections.close_all()
+
+
+def _schedule_retry(job_id):
+    """Hands the job with ``job_id`` to the worker pool again if it failed
+    and has attempts left. The delay starts at ``NOTES_JOB_RETRY_DELAY``
+    seconds and doubles with each attempt.
+    """
+    job = Job.objects.filter(pk=job_id, status=Job.PENDING).first()
+    if job is None:
+        return
+
+    delay = getattr(settings, "NOTES_JOB_RETRY_DELAY", 1) * 2 ** max(job.attempts - 1, 0)
+    timer = threading.Timer(delay, lambda: get_executor().submit(_run_job_in_worker, job_id))
+    timer.daemon = True
+    timer.start()
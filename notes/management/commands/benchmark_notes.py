@@ -0,0 +1,65 @@
+from __future__ import print_function, unicode_literals
+
+from collections import OrderedDict
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from notes import benchmarks
+from notes.corpus import CorpusGenerator
+from notes.corpus import clear_notes
+from notes.models import Note
+from notes.models import get_default_owner
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the hot paths of the notes app."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default=None,
+            help="Comma separated corpus sizes, e.g. 1000,100000,1000000. For every size all notes are "
+                 "DELETED and a synthetic corpus is generated. Without it the current notes are used.",
+        )
+        parser.add_argument("--user", default=None, help="Run the hot paths as this user, i.e. on the notes of the user.")
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--output", default=None, help="Save the results as JSON to this file.")
+        parser.add_argument("--baseline", default=None, help="Compare with the JSON results of a previous run.")
+
+    def handle(self, *args, **options):
+        benchmark = benchmarks.Benchmark(repeat=options["repeat"])
+
+        self.user = None
+        if options["user"]:
+            try:
+                self.user = get_user_model().objects.get_by_natural_key(options["user"])
+            except get_user_model().DoesNotExist:
+                raise CommandError("User {} doesn't exist.".format(options["user"]))
+
+        results = OrderedDict()
+        if options["sizes"]:
+            for size in [int(size) for size in options["sizes"].split(",")]:
+                self.stdout.write("Generating {} notes".format(size))
+                clear_notes()
+                owner = self.user or get_default_owner()
+                CorpusGenerator(owner_ids=[owner.pk] if owner else None, seed=options["seed"]).generate(size)
+                results[str(size)] = self._run(benchmark, options["seed"])
+        else:
+            results[str(Note.objects.count())] = self._run(benchmark, options["seed"])
+
+        if options["output"]:
+            benchmarks.save_results(results, options["output"])
+
+        if options["baseline"]:
+            self.stdout.write("Compared with {}:".format(options["baseline"]))
+            changes = benchmarks.compare(results, benchmarks.load_results(options["baseline"]))
+            for size, name, metric, old, new, change in changes:
+                self.stdout.write("{:>8} {:<40} {:<8} {:>10.2f} -> {:>10.2f} ({:+.1%})".format(
+                    size, name, metric, old, new, change))
+
+    def _run(self, benchmark, seed):
+        self.stdout.write("{} notes:".format(Note.objects.count()))
+        return benchmark.run_all(benchmarks.get_cases(seed, self.user), stdout=self.stdout)
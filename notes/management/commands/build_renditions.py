@@ -0,0 +1,52 @@
+from __future__ import print_function, unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import transaction
+
+from notes.jobs import enqueue
+from notes.models import File
+from notes.models import Job
+from notes.renditions import Image
+
+
+class Command(BaseCommand):
+    help = "Creates the thumbnail and medium renditions of existing files by background jobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            dest="all",
+            help="Recreate the renditions of all files, not only missing ones.",
+        )
+        parser.add_argument("--batch-size", type=int, default=100, help="The number of files per job.")
+
+    def handle(self, *args, **options):
+        if Image is None:
+            raise CommandError("Pillow is required to create renditions.")
+
+        files = File.objects.all()
+        if not options["all"]:
+            files = files.filter(thumbnail__isnull=True) | files.filter(thumbnail="")
+
+        file_ids = list(files.values_list("id", flat=True))
+        batch_size = options["batch_size"]
+        with transaction.atomic():
+            jobs = [
+                enqueue("notes.create_renditions", file_ids=file_ids[i:i + batch_size])
+                for i in range(0, len(file_ids), batch_size)
+            ]
+
+        # The jobs are run by the worker pool (or have been run already with
+        # NOTES_JOBS_SYNC). Successful jobs are deleted, failed ones are kept.
+        job_ids = [job.id for job in jobs if job is not None]
+        while Job.objects.filter(id__in=job_ids).exclude(status=Job.FAILED).exists():
+            time.sleep(0.5)
+
+        failed = Job.objects.filter(id__in=job_ids, status=Job.FAILED).count()
+        self.stdout.write("Processed {} file(s) by {} job(s)".format(len(file_ids), len(jobs)))
+        if failed:
+            self.stdout.write("{} job(s) failed, see the error of the jobs and the run_jobs command".format(failed))
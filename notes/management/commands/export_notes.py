@@ -0,0 +1,26 @@
+from __future__ import print_function, unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from notes.transfer import FORMATS
+from notes.transfer import NoteExporter
+
+
+class Command(BaseCommand):
+    help = "Exports all notes as JSONL file or as directory of markdown files."
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="The JSONL file or the directory to write.")
+        parser.add_argument("--format", choices=FORMATS, default="jsonl")
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            dest="resume",
+            help="Continue an interrupted export into the same output.",
+        )
+
+    def handle(self, *args, **options):
+        exporter = NoteExporter(options["output"], format=options["format"], chunk_size=options["chunk_size"])
+        exported = exporter.run(resume=options["resume"], stdout=self.stdout)
+        self.stdout.write("Exported {} notes".format(exported))
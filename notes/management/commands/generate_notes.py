@@ -0,0 +1,66 @@
+from __future__ import print_function, unicode_literals
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from notes.corpus import CorpusGenerator
+from notes.corpus import clear_notes
+from notes.markup import parallel_rendering
+from notes.models import get_default_owner
+
+
+class Command(BaseCommand):
+    help = "Generates a synthetic notes corpus for benchmarks."
+
+    def add_arguments(self, parser):
+        parser.add_argument("count", type=int, help="The number of notes to create.")
+        parser.add_argument("--tags", type=int, default=1000, help="The size of the tag vocabulary.")
+        parser.add_argument("--zipf", type=float, default=1.1, help="The exponent of the tag distribution.")
+        parser.add_argument("--text-size", type=int, default=2000, help="The median note size in characters.")
+        parser.add_argument("--attachments", type=float, default=0.05, help="The ratio of notes with a file.")
+        parser.add_argument(
+            "--owners",
+            default=None,
+            help="Comma separated usernames. The notes are spread over these users. Default: the first superuser.",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--seed", type=int, default=None)
+        parser.add_argument(
+            "--clear",
+            action="store_true",
+            dest="clear",
+            help="Delete all existing notes first.",
+        )
+
+    def handle(self, *args, **options):
+        if options["clear"]:
+            clear_notes()
+
+        generator = CorpusGenerator(
+            tag_count=options["tags"],
+            zipf=options["zipf"],
+            text_size=options["text_size"],
+            attachment_ratio=options["attachments"],
+            owner_ids=self._get_owner_ids(options["owners"]),
+            seed=options["seed"],
+        )
+        with parallel_rendering():
+            generator.generate(options["count"], batch_size=options["batch_size"], stdout=self.stdout)
+
+    def _get_owner_ids(self, owners):
+        if not owners:
+            # Notes without owner and team would be visible to no one
+            owner = get_default_owner()
+            if owner is None:
+                raise CommandError("There is no superuser, pass the owners of the notes with --owners.")
+            return [owner.pk]
+        User = get_user_model()
+        usernames = set(username.strip() for username in owners.split(","))
+        users = dict(
+            User.objects.filter(**{User.USERNAME_FIELD + "__in": usernames}).values_list(User.USERNAME_FIELD, "pk")
+        )
+        missing = usernames - set(users)
+        if missing:
+            raise CommandError("Unknown users: {}".format(", ".join(sorted(missing))))
+        return list(users.values())
@@ -0,0 +1,60 @@
+from __future__ import print_function, unicode_literals
+
+import os
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from notes.markup import parallel_rendering
+from notes.models import get_default_owner
+from notes.transfer import NoteImporter
+from notes.transfer import read_jsonl
+from notes.transfer import read_markdown
+
+
+class Command(BaseCommand):
+    help = "Imports notes from a JSONL file or a directory of markdown files."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "source",
+            help="A JSONL file or a directory, which is searched for .md files recursively.",
+        )
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="The number of processes which render markdown. Default: the number of CPUs.",
+        )
+        parser.add_argument(
+            "--owner",
+            default=None,
+            help="The username of the owner of the imported notes. Default: the first superuser.",
+        )
+
+    def handle(self, *args, **options):
+        source = options["source"]
+        if os.path.isdir(source):
+            documents = read_markdown(source)
+        elif os.path.isfile(source):
+            documents = read_jsonl(source)
+        else:
+            raise CommandError("{} doesn't exist.".format(source))
+
+        if options["owner"]:
+            try:
+                owner_id = get_user_model().objects.get_by_natural_key(options["owner"]).pk
+            except get_user_model().DoesNotExist:
+                raise CommandError("User {} doesn't exist.".format(options["owner"]))
+        else:
+            # Notes without owner and team would be visible to no one
+            owner = get_default_owner()
+            if owner is None:
+                raise CommandError("There is no superuser, pass the owner of the notes with --owner.")
+            owner_id = owner.pk
+
+        importer = NoteImporter(batch_size=options["batch_size"], workers=options["workers"], owner_id=owner_id)
+        with parallel_rendering():
+            importer.run(documents, stdout=self.stdout)
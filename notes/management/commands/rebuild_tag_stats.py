@@ -0,0 +1,34 @@
+from __future__ import print_function, unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from notes.cache import notes_changed
+from notes.models import TagStat
+from notes.tagging import tag_completer
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the note counts per tag shown by the tag explorer."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            dest="check",
+            help="Only report the tags whose stats are inconsistent.",
+        )
+
+    def handle(self, *args, **options):
+        if options["check"]:
+            mismatches = TagStat.objects.check_consistency()
+            for tag_id, partition, stored, actual in mismatches:
+                self.stdout.write("Tag {} ({}): stored {}, actual {}".format(tag_id, partition or "-", stored, actual))
+
+            if mismatches:
+                self.stdout.write("{} inconsistent tag(s)".format(len(mismatches)))
+            else:
+                self.stdout.write("Tag stats are consistent")
+        else:
+            notes_changed(partitions=TagStat.objects.rebuild())
+            tag_completer.clear()
+            self.stdout.write("Tag stats have been rebuilt")
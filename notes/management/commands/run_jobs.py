@@ -0,0 +1,58 @@
+from __future__ import print_function, unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from notes.jobs import run_pending
+from notes.models import Job
+
+
+class Command(BaseCommand):
+    help = "Runs the pending background jobs, e.g. the ones left by a stopped process."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit",
+            type=int,
+            dest="limit",
+            help="Run at most this number of jobs.",
+        )
+        parser.add_argument(
+            "--retry-failed",
+            action="store_true",
+            dest="retry_failed",
+            help="Run the jobs which have failed too often as well.",
+        )
+        parser.add_argument(
+            "--requeue-running",
+            action="store_true",
+            dest="requeue_running",
+            help="Run the jobs marked as running again. Only use this if no other process runs jobs.",
+        )
+        parser.add_argument(
+            "--loop",
+            type=float,
+            dest="loop",
+            metavar="SECONDS",
+            help="Keep running and look for new jobs every SECONDS.",
+        )
+
+    def handle(self, *args, **options):
+        if options["retry_failed"]:
+            Job.objects.filter(status=Job.FAILED).update(status=Job.PENDING, attempts=0)
+        if options["requeue_running"]:
+            Job.objects.filter(status=Job.RUNNING).update(status=Job.PENDING)
+
+        while True:
+            done = run_pending(options["limit"])
+            if done or not options["loop"]:
+                self.stdout.write("Ran {} job(s)".format(done))
+
+            if not options["loop"]:
+                break
+            time.sleep(options["loop"])
+
+        failed = Job.objects.filter(status=Job.FAILED).count()
+        if failed:
+            self.stdout.write("{} job(s) failed, see the error of the jobs".format(failed))
@@ -0,0 +1,249 @@
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import logging
+import multiprocessing
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from markupfield.markup import DEFAULT_MARKUP_TYPES
+
+logger = logging.getLogger("notes.markup")
+
+# The markup types whose documents are rendered block by block
+BLOCK_MARKUP_TYPES = ("markdown",)
+
+# Lines which make a document unsafe to split: reference definitions apply
+# to the whole document and raw HTML blocks may span blank lines.
+UNSPLITTABLE = re.compile(r"^(?: {0,3}\[[^\]]+\]:|<)", re.MULTILINE)
+
+# Lines which may continue the previous block after a blank line: indented
+# lines (list items, code), block quotes and list items.
+CONTINUATION = re.compile(r"^(?:\s|>|[*+-]\s|\d+\.\s)")
+
+FENCE = re.compile(r"^(?:```|~~~)")
+
+_executor = None
+_executor_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_base_renderers():
+    """Returns the renderers of markupfield as dict markup type -> function.
+    """
+    markup_types = getattr(settings, "MARKUP_FIELD_TYPES", DEFAULT_MARKUP_TYPES)
+    return dict((markup_type[0], markup_type[1]) for markup_type in markup_types)
+
+
+def render_full(markup_type, raw):
+    """Renders the whole document ``raw`` at once.
+    """
+    return get_base_renderers()[markup_type](raw)
+
+
+def split_blocks(raw):
+    """Splits a markdown document into its top-level blocks, which render to
+    the same HTML separately as together.
+
+    Blocks are separated by blank lines, unless the following line may
+    continue the previous block or is within a code fence. Returns a list
+    with the whole document if it can't be split safely.
+    """
+    raw = raw.replace("\r\n", "\n").replace("\r", "\n")
+    if UNSPLITTABLE.search(raw):
+        return [raw]
+
+    blocks = []
+    lines = []
+    blank = False
+    fenced = False
+    for line in raw.split("\n"):
+        if not line.strip() and not fenced:
+            blank = True
+            if lines:
+                lines.append(line)
+            continue
+
+        if blank and lines and not CONTINUATION.match(line):
+            blocks.append("\n".join(lines).rstrip("\n"))
+            lines = []
+
+        if FENCE.match(line):
+            fenced = not fenced
+
+        lines.append(line)
+        blank = False
+
+    if lines:
+        blocks.append("\n".join(lines).rstrip("\n"))
+
+    return blocks
+
+
+@contextmanager
+def parallel_rendering():
+    """Lets the block renderer use its process pool within the current
+    thread, see ``BlockRenderer``.
+
+    Only meant for management commands: forking a pool within a threaded
+    web server risks deadlocks and starts a pool per server process.
+    """
+    previous = getattr(_local, "parallel", False)
+    _local.parallel = True
+    try:
+        yield
+    finally:
+        _local.parallel = previous
+
+
+def get_executor():
+    """Returns the process pool which renders the blocks of large documents.
+    Its size is taken from the ``NOTES_MARKUP_WORKERS`` setting.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=get_workers())
+    return _executor
+
+
+def get_workers():
+    return getattr(settings, "NOTES_MARKUP_WORKERS", None) or multiprocessing.cpu_count()
+
+
+def _render_blocks(markup_type, blocks):
+    render = get_base_renderers()[markup_type]
+    return [render(block) for block in blocks]
+
+
+class BlockRenderer(object):
+    """Renders documents block by block and caches the HTML of every block by
+    the hash of its source.
+
+    Editing a large note changes only a few of its blocks, so saving it
+    renders only these. Within ``parallel_rendering`` blocks which are larger
+    than ``NOTES_MARKUP_PARALLEL_SIZE`` characters are rendered by a pool of
+    ``NOTES_MARKUP_WORKERS`` processes, otherwise within the current one.
+    ``NOTES_MARKUP_CACHE_SIZE`` blocks are kept per process.
+
+    With ``NOTES_MARKUP_VERIFY`` every document is rendered as a whole, too,
+    and the whole rendering is used if they differ.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.mismatches = 0
+
+    @property
+    def size(self):
+        return getattr(settings, "NOTES_MARKUP_CACHE_SIZE", 5000)
+
+    def render(self, markup_type, raw):
+        """Returns the HTML of ``raw``, which is the same as
+        ``render_full(markup_type, raw)``.
+        """
+        if markup_type not in BLOCK_MARKUP_TYPES:
+            return render_full(markup_type, raw)
+
+        blocks = split_blocks(raw)
+        keys = [self._get_key(markup_type, block) for block in blocks]
+
+        html = {}
+        with self._lock:
+            for key in keys:
+                if key in self._blocks:
+                    html[key] = self._blocks[key] = self._blocks.pop(key)
+                    self.hits += 1
+
+        missing = OrderedDict()
+        for key, block in zip(keys, blocks):
+            if key not in html:
+                missing[key] = block
+
+        if missing:
+            rendered = self._render_blocks(markup_type, list(missing.values()))
+            html.update(zip(missing.keys(), rendered))
+            with self._lock:
+                self.misses += len(missing)
+                for key in missing:
+                    self._blocks.pop(key, None)
+                    self._blocks[key] = html[key]
+                while len(self._blocks) > self.size:
+                    self._blocks.popitem(last=False)
+
+        result = "\n".join(html[key] for key in keys if html[key])
+
+        if getattr(settings, "NOTES_MARKUP_VERIFY", False):
+            full = render_full(markup_type, raw)
+            if full != result:
+                logger.warning("Block rendering differs from the full rendering")
+                with self._lock:
+                    self.mismatches += 1
+                return full
+
+        return result
+
+    def get_renderer(self, markup_type):
+        """Returns a function which renders documents of ``markup_type``, as
+        expected by the ``markup_choices`` of a ``MarkupField``.
+        """
+        return lambda raw: self.render(markup_type, raw)
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+
+    def stats(self):
+        """Returns the hit and miss counters.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "mismatches": self.mismatches,
+                "blocks": len(self._blocks),
+            }
+
+    def _get_key(self, markup_type, block):
+        return hashlib.sha1("{}:{}".format(markup_type, block).encode("utf-8")).hexdigest()
+
+    def _render_blocks(self, markup_type, blocks):
+        workers = get_workers()
+        size = sum(len(block) for block in blocks)
+        parallel = (
+            getattr(_local, "parallel", False) and workers > 1 and len(blocks) > 1 and
+            size >= getattr(settings, "NOTES_MARKUP_PARALLEL_SIZE", 100000) and
+            # Worker processes can't start processes on their own
+            not multiprocessing.current_process().daemon
+        )
+        if not parallel:
+            return _render_blocks(markup_type, blocks)
+
+        # One chunk of consecutive blocks per worker keeps the overhead low
+        chunk_size = -(-len(blocks) // workers)
+        chunks = [blocks[i:i + chunk_size] for i in range(0, len(blocks), chunk_size)]
+        futures = [get_executor().submit(_render_blocks, markup_type, chunk) for chunk in chunks]
+        return [html for future in futures for html in future.result()]
+
+
+block_renderer = BlockRenderer()
+
+
+def get_markup_choices():
+    """Returns the ``markup_choices`` of markupfield with the markdown
+    renderer replaced by ``block_renderer``.
+    """
+    markup_types = getattr(settings, "MARKUP_FIELD_TYPES", DEFAULT_MARKUP_TYPES)
+    choices = []
+    for markup_type in markup_types:
+        if markup_type[0] in BLOCK_MARKUP_TYPES:
+            markup_type = (markup_type[0], block_renderer.get_renderer(markup_type[0])) + tuple(markup_type[2:])
+        choices.append(markup_type)
+    return choices
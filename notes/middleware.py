@@ -0,0 +1,33 @@
+from __future__ import print_function, unicode_literals
+
+import time
+
+from django.conf import settings
+
+from notes.routers import request_routing
+
+# The session key of the time until which the session reads from the primary
+PIN_KEY = "notes-primary-until"
+
+
+class PrimaryPinMiddleware(object):
+    """Sends the reads of the notes app to the replicas, see
+    ``notes.routers.NotesRouter``.
+
+    After a request has written (e.g. saved or deleted a note) its session
+    reads from the primary for ``NOTES_PRIMARY_PIN_SECONDS``, so the user
+    sees the own changes although the replicas may lag behind. Must be placed
+    after ``SessionMiddleware``.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        pinned = request.session.get(PIN_KEY, 0) > time.time()
+        with request_routing(pinned) as state:
+            response = self.get_response(request)
+
+        if state.wrote:
+            request.session[PIN_KEY] = time.time() + getattr(settings, "NOTES_PRIMARY_PIN_SECONDS", 5)
+
+        return response
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def create_tag_stats(apps, schema_editor):
+    ContentType = apps.get_model("contenttypes", "ContentType")
+    Note = apps.get_model("notes", "Note")
+    TaggedItem = apps.get_model("taggit", "TaggedItem")
+    TagStat = apps.get_model("notes", "TagStat")
+
+    content_type = ContentType.objects.filter(app_label="notes", model="note").first()
+    if content_type is None:
+        return
+
+    counts = (
+        TaggedItem.objects
+        .filter(content_type=content_type, object_id__in=Note.objects.values("id"))
+        .values_list("tag_id")
+        .annotate(note_count=Count("id"))
+        .order_by()
+    )
+    TagStat.objects.bulk_create([
+        TagStat(tag_id=tag_id, note_count=note_count) for tag_id, note_count in counts
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('taggit', '0002_auto_20150616_2121'),
+        ('notes', '0010_note_modified_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('note_count', models.PositiveIntegerField(db_index=True, default=0)),
+                ('tag', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='note_stat', to='taggit.Tag')),
+            ],
+        ),
+        migrations.RunPython(create_tag_stats, migrations.RunPython.noop),
+    ]
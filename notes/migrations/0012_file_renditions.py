@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0011_tagstat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='medium',
+            field=models.FileField(blank=True, editable=False, null=True, upload_to=''),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='thumbnail',
+            field=models.FileField(blank=True, editable=False, null=True, upload_to=''),
+        ),
+    ]
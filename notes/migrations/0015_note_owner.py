@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def assign_notes(apps, schema_editor):
+    # Existing notes are given to the first superuser, as notes without owner
+    # aren't visible to anyone.
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split("."))
+    Note = apps.get_model("notes", "Note")
+    TagStat = apps.get_model("notes", "TagStat")
+
+    owner = User.objects.filter(is_superuser=True).order_by("id").first()
+    if owner is None:
+        return
+
+    Note.objects.filter(owner__isnull=True, team__isnull=True).update(owner=owner)
+    TagStat.objects.filter(partition="").update(partition="user:{}".format(owner.id))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('auth', '0008_alter_user_username_max_length'),
+        ('notes', '0014_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='owner',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='notes', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='note',
+            name='team',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='notes', to='auth.Group'),
+        ),
+        migrations.AlterIndexTogether(
+            name='note',
+            index_together=set([('modified', 'id'), ('owner', 'modified', 'id'), ('team', 'modified', 'id')]),
+        ),
+        migrations.AlterField(
+            model_name='tagstat',
+            name='tag',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='note_stats', to='taggit.Tag'),
+        ),
+        migrations.AddField(
+            model_name='tagstat',
+            name='partition',
+            field=models.CharField(blank=True, default='', max_length=30),
+        ),
+        migrations.AlterUniqueTogether(
+            name='tagstat',
+            unique_together=set([('partition', 'tag')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='tagstat',
+            index_together=set([('partition', 'note_count')]),
+        ),
+        migrations.RunPython(assign_notes, migrations.RunPython.noop),
+    ]
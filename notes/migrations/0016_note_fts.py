@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def has_fts5(connection):
+    if connection.vendor != "sqlite":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def create_fts_table(apps, schema_editor):
+    # The table of the FTS5 search backend (see notes.search), filled with
+    # the existing notes. Other databases use the Python backend.
+    if not has_fts5(schema_editor.connection):
+        return
+
+    ContentType = apps.get_model("contenttypes", "ContentType")
+    content_type = ContentType.objects.using(schema_editor.connection.alias).filter(
+        app_label="notes", model="note",
+    ).first()
+
+    # The table may have been created by a rebuild of the search index
+    schema_editor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS notes_note_fts USING fts5(title, text, tags)")
+    schema_editor.execute("DELETE FROM notes_note_fts")
+    schema_editor.execute(
+        "INSERT INTO notes_note_fts (rowid, title, text, tags) "
+        "SELECT note.id, note.title, COALESCE(note.text, ''), COALESCE(("
+        "    SELECT group_concat(tag.name, ' ') FROM taggit_taggeditem item "
+        "    JOIN taggit_tag tag ON tag.id = item.tag_id "
+        "    WHERE item.object_id = note.id AND item.content_type_id = %s"
+        "), '') FROM notes_note note",
+        [content_type.id if content_type is not None else None],
+    )
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        schema_editor.execute("DROP TABLE IF EXISTS notes_note_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('taggit', '0002_auto_20150616_2121'),
+        ('notes', '0015_note_owner'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
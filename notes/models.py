@@ -1,10 +1,51 @@
 from __future__ import unicode_literals, print_function
 
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError
+from django.db import connections
 from django.db import models
+from django.db import router
+from django.db import transaction
+from django.db.models import Case
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import IntegerField
+from django.db.models import Sum
+from django.db.models import Value
+from django.db.models import When
+from django.db.models.functions import Greatest
+from django.urls import NoReverseMatch
+from django.urls import reverse
 from django.utils.translation import ugettext_lazy as _
 
 from markupfield.fields import MarkupField
 from taggit.managers import TaggableManager
+from taggit.models import Tag
+from taggit.models import TaggedItem
+
+from notes.markup import get_markup_choices
+from notes.scoping import get_current_scope
+from notes.scoping import get_partition
+
+
+class Blob(models.Model):
+    """The content of uploaded files, stored once per distinct content.
+
+    Files with identical content share a blob, ``ref_count`` is the number of
+    them. See ``notes.storage``.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField()
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return "{} - {}".format(self.sha256, self.ref_count)
 
 
 class File(models.Model):
@@ -12,28 +53,376 @@ class File(models.Model):
     """
     note = models.ForeignKey("Note", blank=True, null=True)
     file = models.FileField()
+    blob = models.ForeignKey(Blob, blank=True, null=True, editable=False, related_name="files")
+
+    # Downsized renditions of images, see notes.renditions
+    thumbnail = models.FileField(blank=True, null=True, editable=False)
+    medium = models.FileField(blank=True, null=True, editable=False)
+
+    def get_url(self, rendition=None):
+        """Returns the URL of the file or of its ``rendition``.
+
+        Files are served by the ``notes_file`` view if ``notes.urls`` are
+        included, which supports conditional and range requests, otherwise
+        by the storage.
+        """
+        try:
+            if rendition is None:
+                return reverse("notes_file", args=[self.id])
+            return reverse("notes_file_rendition", args=[self.id, rendition])
+        except NoReverseMatch:
+            return getattr(self, rendition or "file").url
+
+    def render(self):
+        """Returns the file as responsive image. The browser chooses the
+        smallest rendition which fits.
+        """
+        url = self.get_url()
+        if not self.thumbnail:
+            return "<img src='{}' width='100px' loading='lazy' /> ".format(url)
+
+        return (
+            "<a href='{url}'><img src='{thumbnail}' srcset='{thumbnail} 200w, {medium} 800w' "
+            "sizes='100px' width='100px' loading='lazy' /></a> "
+        ).format(url=url, thumbnail=self.get_url("thumbnail"), medium=self.get_url("medium"))
+
+
+class NoteManager(models.Manager):
+    """Restricts the notes to the current scope, if there is one (see
+    ``notes.scoping``), so every query of a request only touches the notes of
+    its user. Use ``unscoped`` for maintenance tasks which work on all notes.
+    """
+    def get_queryset(self):
+        queryset = super(NoteManager, self).get_queryset()
+        scope = get_current_scope()
+        if scope is not None:
+            queryset = scope.filter(queryset)
+        return queryset
+
+    def unscoped(self):
+        return super(NoteManager, self).get_queryset()
 
 
 class Note(models.Model):
     """A note.
+
+    A note belongs to its owner or, if it is shared with a team, to the
+    members of the team.
     """
     def __unicode__(self):
         return "{} - {}".format(self.id, self.title)
 
     title = models.CharField(_("Title"), max_length=50)
-    text = MarkupField(_("Text"), markup_type='markdown')
+    text = MarkupField(_("Text"), markup_type='markdown', markup_choices=get_markup_choices())
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True, related_name="notes")
+    team = models.ForeignKey(Group, blank=True, null=True, related_name="notes")
     tags = TaggableManager()
 
+    objects = NoteManager()
+
+    class Meta:
+        index_together = [
+            ["modified", "id"],
+            ["owner", "modified", "id"],
+            ["team", "modified", "id"],
+        ]
+
+    @property
+    def partition(self):
+        return get_partition(self.owner_id, self.team_id)
+
     def render(self):
+        """Returns the note as HTML.
+
+        Uses prefetched tags and files if there are any. Use
+        ``notes.cache.render_cache`` to get the cached HTML of a note.
+        """
         html = "<h1>{}</h1>".format(self.title)
-        html += "<p>{}</p>".format(", ".join(self.tags.names()))
+        html += "<p>{}</p>".format(", ".join([tag.name for tag in self.tags.all()]))
         html += "<p>{}</p>".format(self.text)
 
-        if self.file_set.all():
+        files = self.file_set.all()
+        if files:
             html += "<h2>Images</h2>"
-            for file in self.file_set.all():
-                html += "<img src='{}' width='100px' /> ".format(file.file.url)
+            for file in files:
+                html += file.render()
 
         return html
+
+
+class Job(models.Model):
+    """A unit of deferred work, see ``notes.jobs``.
+
+    Jobs are deleted once they have been run successfully. Failed jobs are
+    retried by the ``run_jobs`` management command until they have been
+    tried ``NOTES_JOB_MAX_ATTEMPTS`` times.
+    """
+    PENDING = "pending"
+    RUNNING = "running"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (PENDING, _("Pending")),
+        (RUNNING, _("Running")),
+        (FAILED, _("Failed")),
+    )
+
+    name = models.CharField(max_length=100)
+    payload = models.TextField(default="{}")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        index_together = [
+            ["status", "id"],
+        ]
+
+    def __unicode__(self):
+        return "{} - {} ({})".format(self.id, self.name, self.status)
+
+
+def clamp_count(expression):
+    """Returns ``expression`` limited to zero or more, which keeps
+    concurrent or repeated removals from violating the positive note count.
+    """
+    return Greatest(expression, Value(0), output_field=IntegerField())
+
+
+class TagStatManager(models.Manager):
+    def add(self, tag_ids, amount=1, partition=""):
+        """Adds ``amount`` (which might be negative) to the note count of the
+        passed tags within ``partition``. Counts don't drop below zero.
+        """
+        tag_ids = set(tag_ids)
+        if not tag_ids:
+            return
+
+        stats = self.filter(partition=partition, tag_id__in=tag_ids)
+        missing = tag_ids - set(stats.values_list("tag_id", flat=True))
+        if missing:
+            try:
+                with transaction.atomic():
+                    self.bulk_create([TagStat(tag_id=tag_id, partition=partition) for tag_id in missing])
+            except IntegrityError:
+                # Created concurrently
+                for tag_id in missing:
+                    self.get_or_create(tag_id=tag_id, partition=partition)
+
+        stats.update(note_count=clamp_count(F("note_count") + amount))
+
+    def add_counts(self, counts, batch_size=200):
+        """Adds the amounts of ``counts``, a dict (partition, tag id) ->
+        amount, to the note counts. Takes one update per ``batch_size``
+        stats. Counts don't drop below zero.
+        """
+        counts = dict((key, amount) for key, amount in counts.items() if amount)
+        if not counts:
+            return
+
+        stats = self.filter(
+            partition__in=set(partition for partition, tag_id in counts),
+            tag_id__in=set(tag_id for partition, tag_id in counts),
+        )
+        missing = set(counts) - set(stats.values_list("partition", "tag_id"))
+        if missing:
+            try:
+                with transaction.atomic():
+                    self.bulk_create([TagStat(tag_id=tag_id, partition=partition) for partition, tag_id in missing])
+            except IntegrityError:
+                # Created concurrently
+                for partition, tag_id in missing:
+                    self.get_or_create(tag_id=tag_id, partition=partition)
+
+        keys = sorted(counts)
+        for i in range(0, len(keys), batch_size):
+            amount = Case(
+                *[When(partition=partition, tag_id=tag_id, then=Value(counts[(partition, tag_id)]))
+                  for partition, tag_id in keys[i:i + batch_size]],
+                default=Value(0), output_field=IntegerField()
+            )
+            stats.update(note_count=clamp_count(F("note_count") + amount))
+
+    def get_counts(self):
+        """Returns the used tags of the current scope (see ``notes.scoping``)
+        as list of (tag id, name, note count), most used first.
+        """
+        stats = self.filter(note_count__gt=0)
+        scope = get_current_scope()
+        if scope is not None:
+            stats = stats.filter(partition__in=scope.partitions)
+
+        return list(
+            stats.values_list("tag_id", "tag__name").annotate(count=Sum("note_count")).order_by("-count")
+        )
+
+    def aggregate_counts(self):
+        """Returns the actual note count per partition and tag id as dict
+        (partition, tag id) -> count, computed from the tagged items of
+        existing notes.
+        """
+        counts = {}
+        items = (
+            Note.objects.unscoped().filter(tags__isnull=False)
+            .values_list("owner_id", "team_id", "tags__id").annotate(note_count=Count("id")).order_by()
+        )
+        for owner_id, team_id, tag_id, note_count in items:
+            key = (get_partition(owner_id, team_id), tag_id)
+            counts[key] = counts.get(key, 0) + note_count
+        return counts
+
+    def rebuild(self):
+        """Rebuilds the stats from scratch. Returns the partitions whose stats
+        have been rebuilt.
+        """
+        with transaction.atomic():
+            partitions = set(self.values_list("partition", flat=True).distinct())
+            self.all().delete()
+            counts = self.aggregate_counts()
+            self.bulk_create([
+                TagStat(tag_id=tag_id, partition=partition, note_count=note_count)
+                for (partition, tag_id), note_count in counts.items()
+            ])
+        return partitions | set(partition for partition, tag_id in counts)
+
+    def check_consistency(self):
+        """Returns the tags whose stats don't match the actual aggregate as
+        list of (tag id, partition, stored count, actual count).
+        """
+        actual = self.aggregate_counts()
+        stored = dict(
+            ((partition, tag_id), note_count)
+            for partition, tag_id, note_count in self.filter(note_count__gt=0).values_list(
+                "partition", "tag_id", "note_count"
+            )
+        )
+
+        return [
+            (tag_id, partition, stored.get((partition, tag_id), 0), actual.get((partition, tag_id), 0))
+            for partition, tag_id in sorted(set(actual) | set(stored))
+            if stored.get((partition, tag_id), 0) != actual.get((partition, tag_id), 0)
+        ]
+
+
+class TagStat(models.Model):
+    """The number of notes per tag and partition (see
+    ``notes.scoping.get_partition``).
+
+    The stats are updated incrementally by the signal handlers within
+    ``notes.signals``. Use the ``rebuild_tag_stats`` management command to
+    rebuild or check them.
+    """
+    tag = models.ForeignKey(Tag, related_name="note_stats")
+    partition = models.CharField(max_length=30, blank=True, default="")
+    note_count = models.PositiveIntegerField(default=0, db_index=True)
+
+    objects = TagStatManager()
+
+    class Meta:
+        unique_together = [
+            ["partition", "tag"],
+        ]
+        index_together = [
+            ["partition", "note_count"],
+        ]
+
+    def __unicode__(self):
+        return "{} - {} - {}".format(self.tag_id, self.partition, self.note_count)
+
+
+def get_default_owner():
+    """Returns the user who owns notes which are created without an owner
+    and team, i.e. the first superuser, like migration 0015 does for the
+    notes which existed before notes had owners. Returns None if there is
+    no superuser.
+    """
+    return get_user_model().objects.filter(is_superuser=True).order_by("id").first()
+
+
+def delete_rows(model, pks, batch_size=500):
+    """Deletes the rows of ``model`` with the primary keys ``pks`` by one
+    DELETE per ``batch_size`` rows.
+
+    Unlike ``QuerySet.delete`` no objects are collected and no signals are
+    sent, so the caller has to take care of related rows, the tag stats,
+    indexes and caches, which it does once for all rows.
+    """
+    pks = list(pks)
+    using = router.db_for_write(model)
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        for i in range(0, len(pks), batch_size):
+            chunk = pks[i:i + batch_size]
+            cursor.execute(
+                "DELETE FROM {} WHERE {} IN ({})".format(
+                    connection.ops.quote_name(model._meta.db_table),
+                    connection.ops.quote_name(model._meta.pk.column),
+                    ", ".join(["%s"] * len(chunk)),
+                ),
+                chunk,
+            )
+
+
+def bulk_create_notes(notes):
+    """Creates ``notes`` in bulk and sets their ids. Returns the notes.
+
+    Databases which return the ids of inserted rows set them within
+    ``bulk_create``. On other ones the rows of the batch are found by a
+    marker within their titles, which is replaced by the real titles
+    afterwards, so notes inserted concurrently aren't mistaken for them.
+    """
+    notes = list(notes)
+    if not notes:
+        return notes
+
+    if connections[router.db_for_write(Note)].features.can_return_ids_from_bulk_insert:
+        Note.objects.bulk_create(notes)
+        return notes
+
+    last_id = Note.objects.unscoped().order_by("-id").values_list("id", flat=True).first() or 0
+    marker = uuid.uuid4().hex
+    titles = [note.title for note in notes]
+    for position, note in enumerate(notes):
+        note.title = "{}:{}".format(marker, position)
+    Note.objects.bulk_create(notes)
+
+    created = Note.objects.unscoped().filter(id__gt=last_id, title__startswith=marker + ":")
+    for note_id, title in created.values_list("id", "title"):
+        notes[int(title.split(":")[1])].id = note_id
+
+    for i in range(0, len(notes), 200):
+        batch = notes[i:i + 200]
+        Note.objects.unscoped().filter(pk__in=[note.id for note in batch]).update(title=Case(
+            *[When(pk=note.id, then=Value(title)) for note, title in zip(batch, titles[i:i + 200])],
+            output_field=models.CharField()
+        ))
+    for note, title in zip(notes, titles):
+        note.title = title
+
+    return notes
+
+
+def get_tagged_items():
+    """Returns the tagged items of all notes.
+    """
+    return TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Note))
+
+
+def get_tag_names(note_ids=None):
+    """Returns the tag names of notes as dict note id -> list of tag names.
+
+    Uses a single query. If ``note_ids`` is given only the tags of these notes
+    are returned.
+    """
+    items = get_tagged_items()
+    if note_ids is not None:
+        items = items.filter(object_id__in=note_ids)
+
+    tag_names = {}
+    for note_id, name in items.values_list("object_id", "tag__name").order_by("tag__name"):
+        tag_names.setdefault(note_id, []).append(name)
+
+    return tag_names
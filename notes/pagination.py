@@ -0,0 +1,115 @@
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import json
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from notes.cache import get_cache
+from notes.cache import get_notes_version
+from notes.routers import primary
+from notes.scoping import get_current_scope
+
+# The ordering of keyset pages. It is backed by the (modified, id) index of
+# notes.
+KEYSET_ORDERING = ("-modified", "-id")
+
+
+def get_signature(*values):
+    """Returns a short signature of the passed filter values.
+    """
+    return hashlib.md5(json.dumps(values, default=str).encode("utf-8")).hexdigest()
+
+
+def count(queryset, signature):
+    """Returns the number of rows of ``queryset``.
+
+    The count is cached per filter ``signature`` until notes are changed. If
+    ``NOTES_ESTIMATED_COUNT_THRESHOLD`` is set and the database estimates more
+    rows than that, the estimate is returned instead of the exact count.
+    """
+    cache = get_cache()
+    key = "notes:count:{}:{}".format(get_notes_version(get_current_scope()), signature)
+
+    result = cache.get(key)
+    if result is None:
+        threshold = getattr(settings, "NOTES_ESTIMATED_COUNT_THRESHOLD", None)
+        if threshold is not None:
+            with primary():
+                estimate = estimate_count(queryset)
+            if estimate is not None and estimate > threshold:
+                result = estimate
+
+        if result is None:
+            with primary():
+                result = queryset.count()
+
+        cache.set(key, result)
+
+    return result
+
+
+def estimate_count(queryset):
+    """Returns the number of rows of ``queryset`` as estimated by the query
+    planner, or None if the database can't estimate it.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+
+    return plan[0]["Plan"]["Plan Rows"]
+
+
+class KeysetPaginator(object):
+    """Pages through a queryset by a (modified, id) cursor instead of OFFSET.
+
+    Tables ask for rows by offsets. Hence the paginator remembers the cursor
+    behind every page it has delivered within ``cursors`` (a dict offset ->
+    cursor, which can be stored within the session) and continues from the
+    nearest known cursor before the requested offset. Only the rows between
+    that cursor and the offset are skipped, which is none when paging
+    forward.
+
+    ``load`` turns a sliced queryset into the list of rows, which need the
+    attributes ``modified`` and ``id``.
+    """
+    def __init__(self, queryset, cursors=None, load=list):
+        self.queryset = queryset.order_by(*KEYSET_ORDERING)
+        self.cursors = cursors if cursors is not None else {}
+        self.load = load
+
+    def get_page(self, start, end):
+        offset, cursor = self._nearest_cursor(start)
+
+        queryset = self.queryset
+        if cursor is not None:
+            modified = parse_datetime(cursor[0])
+            queryset = queryset.filter(
+                Q(modified__lt=modified) | Q(modified=modified, id__lt=cursor[1])
+            )
+
+        rows = self.load(queryset[start - offset:end - offset])
+        if rows:
+            last = rows[-1]
+            self.cursors[str(start + len(rows))] = [last.modified.isoformat(), last.id]
+
+        return rows
+
+    def _nearest_cursor(self, start):
+        offset, cursor = 0, None
+        for position, value in self.cursors.items():
+            position = int(position)
+            if offset < position <= start:
+                offset, cursor = position, value
+        return offset, cursor
@@ -0,0 +1,83 @@
+from __future__ import print_function, unicode_literals
+
+import threading
+
+from django.utils import translation
+
+from cba import components
+
+
+class PrebuiltMarkup(object):
+    """Keeps the markup of static components per process, see
+    ``StaticComponent``.
+
+    Entries are keyed by the component id and the language, so they never
+    become stale.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render):
+        """Returns the markup under ``key``, which is built by ``render`` if
+        it isn't kept yet.
+        """
+        with self._lock:
+            markup = self._entries.get(key)
+            if markup is not None:
+                self.hits += 1
+                return markup
+
+        # Rendered without the lock, concurrent misses render the same markup
+        markup = render()
+        with self._lock:
+            self._entries[key] = markup
+            self.misses += 1
+        return markup
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the hit and miss counters.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+            }
+
+
+prebuilt = PrebuiltMarkup()
+
+
+class StaticComponent(object):
+    """Mixin for components whose markup doesn't depend on the request, the
+    user or the database.
+
+    The components are still built per request through their constructors,
+    so their handlers work as usual, but they are rendered only once per
+    process and language. They and their children need fixed ids, as the
+    ids are part of the markup.
+    """
+    def is_static(self):
+        """Returns whether the component shows its initial state, i.e.
+        whether the kept markup may be sent.
+        """
+        return True
+
+    def render(self):
+        if not self.is_static():
+            return super(StaticComponent, self).render()
+
+        key = "{}:{}".format(self.id, translation.get_language())
+        return prebuilt.get(key, super(StaticComponent, self).render)
+
+
+class StaticHTML(StaticComponent, components.HTML):
+    """A ``components.HTML`` with a static content.
+    """
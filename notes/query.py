@@ -0,0 +1,278 @@
+from __future__ import print_function, unicode_literals
+
+import threading
+import uuid
+from contextlib import contextmanager
+
+from django.db.models import Count
+
+from cba import utils
+
+from notes import pagination
+from notes.cache import get_notes_version
+from notes.facets import tag_index
+from notes.models import File
+from notes.models import Note
+from notes.models import get_tag_names
+from notes.pagination import KeysetPaginator
+from notes.scoping import get_current_scope
+from notes.scoping import scoped
+from notes.search import note_search
+
+# Tag selections up to this size are passed to the database as list of ids,
+# larger ones are filtered by joins.
+MAX_SELECTION_IDS = 900
+
+# The number of rows the notes table shows at once. The first page is loaded
+# with this size, so the current note and the table share it.
+FIRST_PAGE_SIZE = 50
+
+_local = threading.local()
+
+
+def get_selected_tags():
+    """Returns the ids of the selected tags and the selection mode ("and" or
+    "or") of the current session.
+    """
+    tag_ids = [int(tag_id) for tag_id in utils.get_from_session("selected-tag-ids") or []]
+    mode = utils.get_from_session("tag-mode") or "and"
+    return tag_ids, mode
+
+
+def get_search_session_key():
+    """Returns the key of the search session of the current session.
+    """
+    key = utils.get_from_session("search-session-key")
+    if key is None:
+        key = uuid.uuid4().hex
+        utils.set_to_session("search-session-key", key)
+    return key
+
+
+@contextmanager
+def request_scope(user=None):
+    """Shares the ``NoteQuery`` objects returned by ``get_note_query`` and
+    the values of ``get_request_cache`` within the block, which should span
+    a request.
+
+    If ``user`` (or a function returning the user) is given, the notes are
+    restricted to the ones visible to the user, see ``notes.scoping``.
+    """
+    _local.queries = {}
+    _local.values = {}
+    try:
+        if user is None:
+            yield
+        else:
+            with scoped(user):
+                yield
+    finally:
+        _local.queries = None
+        _local.values = None
+
+
+def get_request_cache():
+    """Returns a dict which lives as long as the current ``request_scope``,
+    or None outside of a request scope.
+    """
+    return getattr(_local, "values", None)
+
+
+def get_note_query():
+    """Returns the ``NoteQuery`` of the filter of the current session.
+
+    Within a ``request_scope`` the same object is returned as long as neither
+    the filter nor the notes have been changed.
+    """
+    tag_ids, mode = get_selected_tags()
+    search = utils.get_from_session("search")
+    scope = get_current_scope()
+
+    queries = getattr(_local, "queries", None)
+    if queries is None:
+        return NoteQuery(tag_ids, mode, search, scope)
+
+    key = (get_notes_version(scope), tuple(tag_ids), mode, search, scope.key if scope is not None else None)
+    if key not in queries:
+        queries[key] = NoteQuery(tag_ids, mode, search, scope)
+    return queries[key]
+
+
+class NoteRow(object):
+    """A note as shown within the notes table.
+
+    Holds only the listed fields, the text of the note is never loaded for
+    it. Use ``load_rows`` to create them.
+    """
+    __slots__ = ("id", "title", "modified", "tags", "file_count")
+
+    def __init__(self, id, title, modified, tags=(), file_count=0):
+        self.id = id
+        self.title = title
+        self.modified = modified
+        self.tags = tags
+        self.file_count = file_count
+
+
+def load_rows(queryset):
+    """Returns the notes of ``queryset`` as list of ``NoteRow``.
+
+    Takes three queries: the listed fields, the tag names and the file
+    counts of all notes.
+    """
+    rows = [NoteRow(*values) for values in queryset.values_list("id", "title", "modified")]
+    if not rows:
+        return rows
+
+    note_ids = [row.id for row in rows]
+    tag_names = get_tag_names(note_ids)
+    file_counts = dict(
+        File.objects.filter(note_id__in=note_ids).values_list("note_id").annotate(count=Count("id")).order_by()
+    )
+
+    for row in rows:
+        row.tags = tag_names.get(row.id, [])
+        row.file_count = file_counts.get(row.id, 0)
+
+    return rows
+
+
+class NoteQuery(object):
+    """The notes filtered by the selected tags and the search term.
+
+    The filter is built once and the loaded pages are kept, so the detail
+    view and the table of a request share them. Tag selections are taken from
+    ``notes.facets.tag_index`` and search results are intersected with them
+    in memory, hence in these cases counts and membership tests don't need
+    the database.
+
+    If there is a search term the notes are ordered by relevance, otherwise
+    the last modified note comes first.
+
+    Only notes within ``scope`` (a ``notes.scoping.Scope``) are matched; the
+    querysets are restricted to it by the manager of notes already.
+    """
+    def __init__(self, tag_ids, mode, search, scope=None):
+        self.tag_ids = tag_ids
+        self.mode = mode
+        self.search = search
+        self.scope = scope
+        self.signature = pagination.get_signature(tag_ids, mode, search, scope.key if scope is not None else None)
+
+        if tag_ids:
+            self.selection = tag_index.select(tag_ids, mode)
+            if scope is not None:
+                self.selection = self.selection & tag_index.visible(scope.partitions)
+        else:
+            self.selection = None
+
+        # The ordered ids of the matching notes if there is a search term.
+        # The search returns at most ``note_search.limit`` notes, ``truncated``
+        # tells whether more notes match.
+        if search:
+            note_ids = note_search.search(search, session_key=get_search_session_key())
+            self.truncated = len(note_ids) >= note_search.limit
+            if self.selection is not None:
+                note_ids = [note_id for note_id in note_ids if note_id in self.selection]
+            self.note_ids = note_ids
+        else:
+            self.note_ids = None
+            self.truncated = False
+
+        self._queryset = None
+        self._pages = {}
+
+    @property
+    def queryset(self):
+        """The filtered and ordered notes as queryset.
+        """
+        if self._queryset is None:
+            self._queryset = self._build_queryset()
+        return self._queryset
+
+    def count(self):
+        """Returns the number of matching notes.
+        """
+        if self.note_ids is not None:
+            return len(self.note_ids)
+        if self.selection is not None:
+            return len(self.selection)
+        return pagination.count(self.queryset, self.signature)
+
+    def contains(self, note_id):
+        """Returns True if the note with ``note_id`` matches the filter.
+        """
+        note_id = int(note_id)
+        if self.note_ids is not None:
+            return note_id in self.note_ids
+        if self.selection is not None:
+            return note_id in self.selection
+
+        for rows in self._pages.values():
+            if any(row.id == note_id for row in rows):
+                return True
+        return self.queryset.filter(pk=note_id).exists()
+
+    def first(self):
+        """Returns the first matching note as ``NoteRow`` or None.
+        """
+        rows = self.get_page(0, FIRST_PAGE_SIZE, keyset=True)
+        return rows[0] if rows else None
+
+    def get_page(self, start, end, keyset=False):
+        """Returns the notes from ``start`` to ``end`` as ``NoteRow``.
+
+        Pages which are within an already loaded page are taken from it.
+        With ``keyset=True`` pages are fetched by a (modified, id) cursor
+        instead of OFFSET, see ``notes.pagination.KeysetPaginator``.
+        """
+        for (loaded_start, loaded_end), rows in self._pages.items():
+            exhausted = len(rows) < loaded_end - loaded_start
+            if loaded_start <= start and (end <= loaded_end or exhausted):
+                return rows[start - loaded_start:end - loaded_start]
+
+        if self.note_ids is not None:
+            # Search results are limited and ordered by relevance, so the
+            # ids of the page are known already.
+            note_ids = self.note_ids[start:end]
+            notes = dict((row.id, row) for row in load_rows(Note.objects.filter(pk__in=note_ids)))
+            rows = [notes[note_id] for note_id in note_ids if note_id in notes]
+        elif keyset:
+            rows = self._get_keyset_page(start, end)
+        else:
+            rows = load_rows(self.queryset[start:end])
+
+        self._pages[(start, end)] = rows
+        return rows
+
+    def _build_queryset(self):
+        if self.note_ids is not None:
+            # The order by relevance is kept by ``note_ids``, which the
+            # pages, counts and lookups of search results are taken from.
+            return Note.objects.filter(pk__in=self.note_ids).order_by(*pagination.KEYSET_ORDERING)
+
+        if self.selection is None:
+            notes = Note.objects.all()
+        elif len(self.selection) <= MAX_SELECTION_IDS:
+            notes = Note.objects.filter(pk__in=list(self.selection))
+        elif self.mode == "and":
+            notes = Note.objects.all()
+            for tag_id in self.tag_ids:
+                notes = notes.filter(tags__id=tag_id)
+        else:
+            notes = Note.objects.filter(tags__id__in=self.tag_ids).distinct()
+
+        return notes.order_by(*pagination.KEYSET_ORDERING)
+
+    def _get_keyset_page(self, start, end):
+        # The cursors are only valid as long as neither the filter nor the
+        # notes have been changed.
+        signature = "{}:{}".format(get_notes_version(self.scope), self.signature)
+        state = utils.get_from_session("notes-cursors")
+        if not state or state["signature"] != signature:
+            state = {"signature": signature, "cursors": {}}
+
+        rows = KeysetPaginator(self.queryset, state["cursors"], load_rows).get_page(start, end)
+        utils.set_to_session("notes-cursors", state)
+
+        return rows
@@ -0,0 +1,110 @@
+from __future__ import print_function, unicode_literals
+
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+
+try:
+    from PIL import Image
+    from PIL import ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+from notes.cache import render_cache
+from notes.models import File
+
+# The derived renditions of images as (field name, maximal width).
+RENDITIONS = (
+    ("thumbnail", 200),
+    ("medium", 800),
+)
+
+# The errors of decoding broken, unknown or too large images
+if Image is not None:
+    DECODE_ERRORS = (IOError, OSError, getattr(Image, "DecompressionBombError", IOError))
+else:
+    DECODE_ERRORS = (IOError, OSError)
+
+# The EXIF orientation tag
+ORIENTATION = 0x0112
+
+
+def exif_transpose(image):
+    """Returns ``image`` turned upright according to its EXIF orientation.
+    Pillow < 6 lacks ``ImageOps.exif_transpose``, hence the fallback.
+    """
+    if hasattr(ImageOps, "exif_transpose"):
+        return ImageOps.exif_transpose(image)
+
+    try:
+        orientation = (image._getexif() or {}).get(ORIENTATION)
+    except Exception:
+        # No or broken EXIF data
+        return image
+
+    method = {
+        2: Image.FLIP_LEFT_RIGHT,
+        3: Image.ROTATE_180,
+        4: Image.FLIP_TOP_BOTTOM,
+        5: Image.TRANSPOSE,
+        6: Image.ROTATE_270,
+        7: Image.TRANSVERSE,
+        8: Image.ROTATE_90,
+    }.get(orientation)
+    if method is None:
+        return image
+    return image.transpose(method)
+
+
+def create_renditions(file):
+    """Creates the renditions of ``file`` next to the original.
+
+    The renditions are turned upright according to the EXIF orientation of
+    the image. Returns True if the renditions have been created and False if
+    Pillow is not installed or the file is not an image (or too large to
+    decode safely).
+    """
+    if Image is None:
+        return False
+
+    try:
+        file.file.open("rb")
+        try:
+            image = Image.open(file.file)
+            image.load()
+            image = exif_transpose(image)
+        finally:
+            file.file.close()
+    except DECODE_ERRORS:
+        return False
+
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    root, ext = os.path.splitext(file.file.name)
+    values = {}
+    for name, width in RENDITIONS:
+        rendition = image.copy()
+        rendition.thumbnail((width, width * 4))
+
+        content = BytesIO()
+        rendition.save(content, "JPEG", quality=85)
+
+        current = getattr(file, name)
+        if current:
+            current.delete(save=False)
+
+        values[name] = file.file.storage.save(
+            "{}.{}.jpg".format(root, name), ContentFile(content.getvalue())
+        )
+
+    # Update instead of save, in order not to trigger the signals again.
+    File.objects.filter(pk=file.pk).update(**values)
+    for name, value in values.items():
+        setattr(file, name, value)
+
+    if file.note_id:
+        render_cache.invalidate(file.note_id)
+
+    return True
@@ -0,0 +1,103 @@
+from __future__ import print_function, unicode_literals
+
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+# The apps whose reads are sent to the replicas. Tags are read together with
+# notes, so they are taken from the same database.
+ROUTED_APPS = ("notes", "taggit")
+
+_local = threading.local()
+
+
+def get_read_databases():
+    """Returns the aliases of the replicas, taken from the
+    ``NOTES_READ_DATABASES`` setting.
+    """
+    return list(getattr(settings, "NOTES_READ_DATABASES", []))
+
+
+class RequestState(object):
+    """The routing state of a request: the replica it reads from and whether
+    it is pinned to the primary.
+    """
+    def __init__(self, pinned=False):
+        replicas = get_read_databases()
+        self.replica = random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+        self.pinned = pinned
+        self.wrote = False
+
+
+@contextmanager
+def request_routing(pinned=False):
+    """Sends the reads of the notes app within the block to a replica, unless
+    it is ``pinned`` to the primary or writes to it. Yields the
+    ``RequestState``, whose ``wrote`` tells if the block has written.
+
+    Outside of this block (background jobs, management commands) everything
+    is read from the primary.
+    """
+    previous = getattr(_local, "state", None)
+    _local.state = state = RequestState(pinned)
+    try:
+        yield state
+    finally:
+        _local.state = previous
+
+
+@contextmanager
+def primary():
+    """Reads from the primary within the block.
+
+    Used to fill caches which are keyed by a version bumped on the primary,
+    so a lagging replica doesn't store old data under the new version.
+    """
+    state = getattr(_local, "state", None)
+    if state is None:
+        yield
+        return
+
+    pinned = state.pinned
+    state.pinned = True
+    try:
+        yield
+    finally:
+        state.pinned = pinned or state.wrote
+
+
+class NotesRouter(object):
+    """Routes the reads of the notes app within requests to the replicas
+    named by ``NOTES_READ_DATABASES``, see ``notes.middleware``. Writes always
+    go to the primary (the default database).
+
+    A request reads from one replica only. After the first write it reads
+    from the primary, so it sees its own changes.
+    """
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label not in ROUTED_APPS:
+            return None
+
+        state = getattr(_local, "state", None)
+        if state is None or state.pinned:
+            return DEFAULT_DB_ALIAS
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label not in ROUTED_APPS:
+            return None
+
+        state = getattr(_local, "state", None)
+        if state is not None:
+            state.pinned = state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same data as the primary
+        databases = set([DEFAULT_DB_ALIAS] + get_read_databases())
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
@@ -0,0 +1,103 @@
+from __future__ import print_function, unicode_literals
+
+import threading
+from contextlib import contextmanager
+
+from django.db.models import Q
+
+_local = threading.local()
+
+
+def get_partition(owner_id, team_id):
+    """Returns the key of the partition a note belongs to: the team if the
+    note is shared with one, otherwise its owner.
+
+    Tag stats, the tag index and the search index are kept per partition.
+    Notes without owner and team belong to the partition "".
+    """
+    if team_id:
+        return "team:{}".format(team_id)
+    if owner_id:
+        return "user:{}".format(owner_id)
+    return ""
+
+
+def filter_partitions(queryset, partitions):
+    """Restricts ``queryset`` of notes to the ones within ``partitions``.
+    """
+    q = Q(pk__in=[])
+    for partition in partitions:
+        kind, _, key = partition.partition(":")
+        if kind == "team":
+            q |= Q(team_id=int(key))
+        elif kind == "user":
+            q |= Q(owner_id=int(key), team__isnull=True)
+        else:
+            q |= Q(owner__isnull=True, team__isnull=True)
+    return queryset.filter(q)
+
+
+class Scope(object):
+    """The notes a user sees: the own notes which aren't shared with a team
+    and the notes of the teams (groups) of the user.
+    """
+    def __init__(self, user_id, team_ids=()):
+        self.user_id = user_id
+        self.team_ids = sorted(team_ids)
+
+        self.partitions = ["team:{}".format(team_id) for team_id in self.team_ids]
+        if user_id:
+            self.partitions.insert(0, "user:{}".format(user_id))
+
+        # Identifies the scope within cache keys and signatures
+        self.key = ",".join(self.partitions)
+
+    @classmethod
+    def for_user(cls, user):
+        if user.is_anonymous():
+            return cls(None)
+        return cls(user.pk, user.groups.values_list("id", flat=True))
+
+    def filter(self, queryset):
+        """Restricts ``queryset`` of notes to this scope.
+        """
+        q = Q(pk__in=[])
+        if self.user_id:
+            q |= Q(owner_id=self.user_id, team__isnull=True)
+        if self.team_ids:
+            q |= Q(team_id__in=self.team_ids)
+        return queryset.filter(q)
+
+
+@contextmanager
+def scoped(user):
+    """Restricts the notes to the ones visible to ``user`` within the block.
+
+    ``user`` may be a function returning the user, as the user of a request
+    changes when logging in. Scopes can be nested, ``scoped(None)`` lifts the
+    restriction.
+    """
+    previous = getattr(_local, "user", None), getattr(_local, "scopes", None)
+    _local.user = user
+    _local.scopes = {}
+    try:
+        yield
+    finally:
+        _local.user, _local.scopes = previous
+
+
+def get_current_scope():
+    """Returns the ``Scope`` of the current block (see ``scoped``) or None if
+    the notes aren't restricted.
+    """
+    user = getattr(_local, "user", None)
+    if callable(user):
+        user = user()
+    if user is None:
+        return None
+
+    # The teams are loaded once per user and block
+    scope = _local.scopes.get(user.pk)
+    if scope is None:
+        scope = _local.scopes[user.pk] = Scope.for_user(user)
+    return scope
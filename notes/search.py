@@ -0,0 +1,577 @@
+from __future__ import print_function, unicode_literals
+
+import bisect
+import math
+import re
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connections
+from django.db import router
+
+from notes.cache import VersionedIndex
+from notes.cache import get_notes_version
+from notes.models import Note
+from notes.models import get_tag_names
+from notes.routers import primary
+from notes.scoping import filter_partitions
+from notes.scoping import get_current_scope
+from notes.scoping import get_partition
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# Weights of the indexed fields, used for ranking.
+TITLE_WEIGHT = 10
+TAGS_WEIGHT = 5
+TEXT_WEIGHT = 1
+
+
+def tokenize(text):
+    """Splits the given text into lower case word tokens.
+    """
+    if not text:
+        return []
+    return [token.lower() for token in TOKEN_RE.findall(text)]
+
+
+def get_documents(note_ids):
+    """Returns the partition and the searchable fields of the passed notes
+    as dict note id -> (partition, title, text, tags). Takes two queries per
+    500 notes.
+    """
+    note_ids = list(note_ids)
+    documents = {}
+    for i in range(0, len(note_ids), 500):
+        chunk = note_ids[i:i + 500]
+        tag_names = get_tag_names(chunk)
+        notes = Note.objects.unscoped().filter(pk__in=chunk).values_list("id", "owner_id", "team_id", "title", "text")
+        for note_id, owner_id, team_id, title, text in notes:
+            documents[note_id] = (
+                get_partition(owner_id, team_id), title, text or "", " ".join(tag_names.get(note_id, [])),
+            )
+    return documents
+
+
+def get_token_weights(title, text, tags):
+    """Returns the weight of every token of a document as dict token ->
+    weight.
+    """
+    weights = {}
+    for field, weight in ((title, TITLE_WEIGHT), (tags, TAGS_WEIGHT), (text, TEXT_WEIGHT)):
+        for token in tokenize(field):
+            weights[token] = weights.get(token, 0) + weight
+    return weights
+
+
+class BaseSearchBackend(object):
+    """Base class of all search backends.
+
+    A backend keeps a tokenized index of all notes and returns the ids of the
+    notes matching a query, ranked by relevance. Every token of the query
+    matches as prefix, so search-as-you-type finds partially typed words.
+
+    The index of a ``shared`` backend is stored within the database, so it
+    can be updated by any process.
+
+    If a ``notes.scoping.Scope`` is passed to ``search`` only the notes
+    within it are returned.
+    """
+    shared = False
+
+    def remove_note(self, note_id):
+        raise NotImplementedError
+
+    def index_notes(self, note_ids):
+        """Updates the index of the notes with ``note_ids`` by a constant
+        number of queries.
+        """
+        raise NotImplementedError
+
+    def rebuild(self):
+        raise NotImplementedError
+
+    def search(self, query, limit, scope=None):
+        raise NotImplementedError
+
+    def get_tokens(self, note_ids):
+        """Returns the indexed tokens of the passed notes as dict note id ->
+        dict token -> weight.
+        """
+        raise NotImplementedError
+
+
+class PythonSearchBackend(BaseSearchBackend, VersionedIndex):
+    """Pure Python in-memory inverted index.
+
+    The index is built lazily from the database on first use and refreshed
+    with the notes changed within committed transactions (see
+    ``notes.cache.notes_changed``). It lives in the memory of the current
+    process, the partitions changed by another process are reloaded, see
+    ``notes.cache.VersionedIndex``.
+    """
+    def __init__(self):
+        super(PythonSearchBackend, self).__init__()
+        self._postings = {}
+        self._documents = {}
+        self._partitions = {}
+        self._partition_notes = {}
+        self._vocabulary = []
+
+    def index_notes(self, note_ids):
+        with self._lock:
+            if self._loaded:
+                for note_id, document in get_documents(note_ids).items():
+                    self._index(note_id, *document)
+
+    def remove_note(self, note_id):
+        with self._lock:
+            if self._loaded:
+                self._remove(note_id)
+
+    def rebuild(self):
+        with self._lock:
+            self._loaded = False
+            self.ensure_current()
+
+    def load(self):
+        with self._lock:
+            self._postings = {}
+            self._documents = {}
+            self._partitions = {}
+            self._partition_notes = {}
+            self._vocabulary = []
+
+            tag_names = get_tag_names()
+            notes = Note.objects.unscoped().values_list("id", "owner_id", "team_id", "title", "text")
+            for note_id, owner_id, team_id, title, text in notes.iterator():
+                self._index(
+                    note_id, get_partition(owner_id, team_id), title, text, " ".join(tag_names.get(note_id, []))
+                )
+
+            self._loaded = True
+
+    def load_partitions(self, partitions):
+        with self._lock:
+            for partition in partitions:
+                for note_id in list(self._partition_notes.get(partition, ())):
+                    self._remove(note_id)
+
+            note_ids = filter_partitions(Note.objects.unscoped(), partitions).values_list("id", flat=True)
+            for note_id, document in get_documents(note_ids).items():
+                self._index(note_id, *document)
+
+    def refresh(self, note_ids, partitions, tag_ids):
+        with self._lock:
+            if self._loaded:
+                documents = get_documents(note_ids)
+                for note_id in note_ids:
+                    if note_id in documents:
+                        self._index(note_id, *documents[note_id])
+                    else:
+                        self._remove(note_id)
+
+    def search(self, query, limit, scope=None):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        self.ensure_current()
+        with self._lock:
+            total = len(self._documents) or 1
+            scores = None
+            for token in set(tokens):
+                matches = {}
+                for expanded in self._expand(token):
+                    postings = self._postings[expanded]
+                    idf = math.log(1.0 + total / float(len(postings)))
+                    for note_id, weight in postings.items():
+                        matches[note_id] = matches.get(note_id, 0) + weight * idf
+
+                if scores is None:
+                    if scope is not None:
+                        partitions = set(scope.partitions)
+                        matches = dict(
+                            (note_id, score) for note_id, score in matches.items()
+                            if self._partitions[note_id] in partitions
+                        )
+                    scores = matches
+                else:
+                    scores = dict(
+                        (note_id, score + matches[note_id])
+                        for note_id, score in scores.items() if note_id in matches
+                    )
+
+                if not scores:
+                    return []
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+        return [note_id for note_id, score in ranked[:limit]]
+
+    def get_tokens(self, note_ids):
+        self.ensure_current()
+        with self._lock:
+            return dict(
+                (note_id, dict((token, self._postings[token][note_id]) for token in self._documents[note_id]))
+                for note_id in note_ids if note_id in self._documents
+            )
+
+    def _expand(self, prefix):
+        """Returns all tokens of the vocabulary starting with ``prefix``.
+        """
+        position = bisect.bisect_left(self._vocabulary, prefix)
+        tokens = []
+        while position < len(self._vocabulary) and self._vocabulary[position].startswith(prefix):
+            tokens.append(self._vocabulary[position])
+            position += 1
+        return tokens
+
+    def _index(self, note_id, partition, title, text, tags):
+        self._remove(note_id)
+        self._partitions[note_id] = partition
+        self._partition_notes.setdefault(partition, set()).add(note_id)
+
+        weights = get_token_weights(title, text, tags)
+        for token, weight in weights.items():
+            if token not in self._postings:
+                self._postings[token] = {}
+                bisect.insort(self._vocabulary, token)
+            self._postings[token][note_id] = weight
+
+        self._documents[note_id] = frozenset(weights)
+
+    def _remove(self, note_id):
+        partition = self._partitions.pop(note_id, None)
+        if partition is not None:
+            notes = self._partition_notes[partition]
+            notes.discard(note_id)
+            if not notes:
+                del self._partition_notes[partition]
+        for token in self._documents.pop(note_id, ()):
+            postings = self._postings[token]
+            postings.pop(note_id, None)
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+
+
+class FTS5SearchBackend(BaseSearchBackend):
+    """Search backend based on a SQLite FTS5 virtual table.
+
+    The table is created by migration 0016 and written on the primary only.
+    The rowid of an entry is the id of the note.
+    """
+    table = "notes_note_fts"
+    shared = True
+
+    @staticmethod
+    def is_available(connection):
+        if connection.vendor != "sqlite":
+            return False
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+            return bool(cursor.fetchone()[0])
+
+    def remove_note(self, note_id):
+        using = router.db_for_write(Note)
+
+        with connections[using].cursor() as cursor:
+            cursor.execute("DELETE FROM {} WHERE rowid = %s".format(self.table), [note_id])
+
+    def index_notes(self, note_ids):
+        using = router.db_for_write(Note)
+
+        documents = get_documents(note_ids)
+        with connections[using].cursor() as cursor:
+            for note_id, (partition, title, text, tags) in documents.items():
+                cursor.execute("DELETE FROM {} WHERE rowid = %s".format(self.table), [note_id])
+                cursor.execute(
+                    "INSERT INTO {} (rowid, title, text, tags) VALUES (%s, %s, %s, %s)".format(self.table),
+                    [note_id, title, text, tags],
+                )
+
+    def rebuild(self):
+        using = router.db_for_write(Note)
+        tag_names = get_tag_names()
+
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(title, text, tags)".format(self.table)
+            )
+            cursor.execute("DELETE FROM {}".format(self.table))
+            notes = Note.objects.unscoped().using(using).values_list("id", "title", "text")
+            for note_id, title, text in notes.iterator():
+                cursor.execute(
+                    "INSERT INTO {} (rowid, title, text, tags) VALUES (%s, %s, %s, %s)".format(self.table),
+                    [note_id, title, text, " ".join(tag_names.get(note_id, []))],
+                )
+
+    def search(self, query, limit, scope=None):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        if scope is not None and not scope.partitions:
+            return []
+
+        using = router.db_for_read(Note)
+
+        # Every token is quoted, so FTS5 operators within the query are taken
+        # literally; the trailing * makes it a prefix query.
+        expression = " ".join('"{}"*'.format(token) for token in tokens)
+
+        # The unary + keeps SQLite from passing the rowids to FTS5, which
+        # would evaluate the query once per note of the scope.
+        condition, params = "", []
+        if scope is not None:
+            notes = scope.filter(Note.objects.unscoped().using(using)).values("id")
+            sql, params = notes.query.sql_with_params()
+            condition = "AND +rowid IN ({}) ".format(sql)
+
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                "SELECT rowid FROM {table} WHERE {table} MATCH %s {condition}"
+                "ORDER BY bm25({table}, {title}, {text}, {tags}) LIMIT %s".format(
+                    table=self.table, condition=condition, title=TITLE_WEIGHT, text=TEXT_WEIGHT, tags=TAGS_WEIGHT,
+                ),
+                [expression] + list(params) + [limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def get_tokens(self, note_ids):
+        using = router.db_for_read(Note)
+
+        note_ids = list(note_ids)
+        tokens = {}
+        with connections[using].cursor() as cursor:
+            for i in range(0, len(note_ids), 500):
+                chunk = note_ids[i:i + 500]
+                cursor.execute(
+                    "SELECT rowid, title, text, tags FROM {} WHERE rowid IN ({})".format(
+                        self.table, ", ".join(["%s"] * len(chunk))
+                    ),
+                    chunk,
+                )
+                for note_id, title, text, tags in cursor.fetchall():
+                    tokens[note_id] = get_token_weights(title, text, tags)
+        return tokens
+
+
+def match_prefix(document, prefix):
+    """Returns the summed weight of all tokens of ``document`` (a tuple of
+    sorted tokens and their weights) starting with ``prefix``.
+    """
+    tokens, weights = document
+    position = bisect.bisect_left(tokens, prefix)
+    score = 0
+    while position < len(tokens) and tokens[position].startswith(prefix):
+        score += weights[position]
+        position += 1
+    return score
+
+
+class SearchResult(object):
+    """The result of a query within a search session.
+
+    ``documents`` holds the tokens of the matching notes. They are loaded when
+    the result is narrowed the first time and passed on to the narrowed
+    results.
+    """
+    __slots__ = ("tokens", "note_ids", "limit", "version", "documents")
+
+    def __init__(self, tokens, note_ids, limit, version, documents=None):
+        self.tokens = tokens
+        self.note_ids = note_ids
+        self.limit = limit
+        self.version = version
+        self.documents = documents
+
+    @property
+    def complete(self):
+        return len(self.note_ids) < self.limit
+
+    def covers(self, tokens):
+        """Returns True if the result of a query with ``tokens`` is a subset
+        of this result, i.e. if every token of this query is a prefix of a
+        token of the other one and this result hasn't been truncated.
+        """
+        return self.complete and all(
+            any(token.startswith(previous) for token in tokens) for previous in self.tokens
+        )
+
+    def narrow(self, tokens, backend):
+        """Returns the result of a query with ``tokens`` by filtering this
+        result in memory, see ``covers``.
+
+        The notes are ranked by the weights of their matching tokens, ties
+        keep their previous order.
+        """
+        if self.documents is None:
+            self.documents = {}
+            for note_id, weights in backend.get_tokens(self.note_ids).items():
+                sorted_tokens = tuple(sorted(weights))
+                self.documents[note_id] = (sorted_tokens, tuple(weights[token] for token in sorted_tokens))
+
+        scores = {}
+        for note_id in self.note_ids:
+            document = self.documents.get(note_id)
+            if document is None:
+                continue
+
+            score = 0
+            for token in set(tokens):
+                token_score = match_prefix(document, token)
+                if not token_score:
+                    break
+                score += token_score
+            else:
+                scores[note_id] = score
+
+        note_ids = sorted(scores, key=lambda note_id: -scores[note_id])
+        return SearchResult(tokens, note_ids, self.limit, self.version, self.documents)
+
+
+class SearchSessions(object):
+    """Keeps the last search result per search session, within the memory of
+    the current process.
+
+    Search-as-you-type sends a request per pause of typing. If a query
+    extends the previous one, its result is narrowed from the cached result
+    instead of searching again, see ``SearchResult``. Results are only
+    reused as long as the notes and the scope haven't been changed.
+
+    At most ``NOTES_SEARCH_SESSIONS`` sessions are kept (default 1000), the
+    least recently used one is dropped first.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self.searches = 0
+        self.narrowed = 0
+        self.hits = 0
+
+    @property
+    def size(self):
+        return getattr(settings, "NOTES_SEARCH_SESSIONS", 1000)
+
+    def search(self, key, query, limit, backend, scope=None):
+        tokens = tuple(tokenize(query))
+        if not tokens:
+            return []
+
+        # Results are reused within the same scope only
+        version = (get_notes_version(scope), scope.key if scope is not None else None)
+        with self._lock:
+            previous = self._sessions.get(key)
+            if previous is not None:
+                self._put(key, previous)
+
+        if previous is not None and previous.version == version:
+            if previous.tokens == tokens and (previous.complete or previous.limit >= limit):
+                with self._lock:
+                    self.hits += 1
+                return previous.note_ids[:limit]
+
+            if previous.covers(tokens):
+                with primary():
+                    result = previous.narrow(tokens, backend)
+                with self._lock:
+                    self.narrowed += 1
+                    self._put(key, result)
+                return result.note_ids[:limit]
+
+        with primary():
+            note_ids = backend.search(query, limit, scope)
+        result = SearchResult(tokens, note_ids, limit, version)
+        with self._lock:
+            self.searches += 1
+            self._put(key, result)
+        return result.note_ids
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "searches": self.searches,
+                "narrowed": self.narrowed,
+                "hits": self.hits,
+                "sessions": len(self._sessions),
+            }
+
+    def _put(self, key, result):
+        # Stores the result of the session, must be called with the lock
+        # held.
+        self._sessions.pop(key, None)
+        self._sessions[key] = result
+        while len(self._sessions) > self.size:
+            self._sessions.popitem(last=False)
+
+
+class NoteSearch(object):
+    """Full-text search over notes.
+
+    The backend is taken from the ``NOTES_SEARCH_BACKEND`` setting, which is
+    one of ``"auto"`` (default), ``"fts5"`` or ``"python"``. With ``"auto"``
+    FTS5 is used if the notes are stored within a SQLite database which
+    supports it, otherwise the pure Python backend.
+    """
+    def __init__(self, backend=None):
+        self._backend = backend
+        self._lock = threading.Lock()
+        self.sessions = SearchSessions()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = self._create_backend()
+        return self._backend
+
+    @property
+    def limit(self):
+        return getattr(settings, "NOTES_SEARCH_LIMIT", 1000)
+
+    def remove(self, note_id):
+        self.backend.remove_note(note_id)
+
+    def index_notes(self, note_ids):
+        self.backend.index_notes(note_ids)
+
+    def rebuild(self):
+        self.backend.rebuild()
+        self.sessions.clear()
+
+    def search(self, query, limit=None, session_key=None):
+        """Returns the ids of the notes matching ``query``, best match first.
+        Only notes within the current scope are returned, see
+        ``notes.scoping``.
+
+        If ``session_key`` is given, the result is cached for the search
+        session and narrowed for following queries, see ``SearchSessions``.
+        """
+        scope = get_current_scope()
+        if session_key is None:
+            return self.backend.search(query, limit or self.limit, scope)
+        return self.sessions.search(session_key, query, limit or self.limit, self.backend, scope)
+
+    def _create_backend(self):
+        name = getattr(settings, "NOTES_SEARCH_BACKEND", "auto")
+        if name == "auto":
+            if FTS5SearchBackend.is_available(connections[router.db_for_write(Note)]):
+                name = "fts5"
+            else:
+                name = "python"
+
+        if name == "fts5":
+            return FTS5SearchBackend()
+        elif name == "python":
+            return PythonSearchBackend()
+        else:
+            raise ValueError("Unknown search backend: {}".format(name))
+
+
+note_search = NoteSearch()
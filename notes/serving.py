@@ -0,0 +1,121 @@
+from __future__ import print_function, unicode_literals
+
+import mimetypes
+import re
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date
+from django.utils.http import quote_etag
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header, size):
+    """Returns the (start, end) offsets (end exclusive) of a single byte
+    range header or None if there is none or it consists of several ranges,
+    which are answered by the whole file.
+
+    Raises ValueError if the range can't be satisfied.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+
+    if not start:
+        # The last bytes of the file
+        start = max(size - int(end), 0)
+        end = size
+    else:
+        start = int(start)
+        end = min(int(end) + 1, size) if end else size
+
+    if start >= size or start >= end:
+        raise ValueError("Unsatisfiable range: {}".format(header))
+
+    return start, end
+
+
+class RangeFile(object):
+    """Reads ``length`` bytes of ``file`` starting at ``start``.
+    """
+    def __init__(self, file, start, length):
+        self.file = file
+        self.remaining = length
+        self.file.seek(start)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def serve_file(request, name, etag, last_modified=None):
+    """Returns a response with the file ``name`` of the default storage.
+
+    Answers conditional requests by ``etag`` and ``last_modified`` (a
+    timestamp) with 304 and single byte ranges with 206. Whole files are
+    passed to the WSGI server as file, so it can send them by sendfile. With
+    ``NOTES_SENDFILE_HEADER`` the file is left to the web server altogether.
+    The response may be cached privately for ``NOTES_FILE_MAX_AGE`` seconds.
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        size = default_storage.size(name)
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        header = getattr(settings, "NOTES_SENDFILE_HEADER", None)
+
+        byte_range = None
+        if_range = request.META.get("HTTP_IF_RANGE")
+        if header is None and (not if_range or if_range == quote_etag(etag)):
+            try:
+                byte_range = parse_range(request.META.get("HTTP_RANGE"), size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response["Content-Range"] = "bytes */{}".format(size)
+                return response
+
+        if header is not None:
+            response = HttpResponse(content_type=content_type)
+            response[header] = get_sendfile_path(name, header)
+        elif byte_range is not None:
+            start, end = byte_range
+            response = FileResponse(
+                RangeFile(default_storage.open(name, "rb"), start, end - start),
+                status=206, content_type=content_type,
+            )
+            response["Content-Range"] = "bytes {}-{}/{}".format(start, end - 1, size)
+            response["Content-Length"] = end - start
+        else:
+            response = FileResponse(default_storage.open(name, "rb"), content_type=content_type)
+            response["Content-Length"] = size
+
+        response["Accept-Ranges"] = "bytes"
+
+    response["ETag"] = quote_etag(etag)
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified)
+    patch_cache_control(response, private=True, max_age=getattr(settings, "NOTES_FILE_MAX_AGE", 86400))
+
+    return response
+
+
+def get_sendfile_path(name, header):
+    # X-Accel-Redirect (nginx) takes an internal URI, X-Sendfile (Apache,
+    # lighttpd) the path of the file.
+    if header.lower() == "x-accel-redirect":
+        return getattr(settings, "NOTES_SENDFILE_ROOT", "/protected/") + name
+    return default_storage.path(name)
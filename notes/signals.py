@@ -0,0 +1,182 @@
+from __future__ import print_function, unicode_literals
+
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+
+from taggit.models import Tag
+from taggit.models import TaggedItem
+
+from notes.cache import notes_changed
+from notes.cache import render_cache
+from notes.jobs import enqueue
+from notes.models import File
+from notes.models import Note
+from notes.models import TagStat
+from notes.models import get_tagged_items
+from notes.renditions import Image
+from notes.routers import primary
+from notes.scoping import get_partition
+from notes.search import note_search
+from notes.storage import release_blob
+
+# Registers the jobs
+import notes.tasks  # noqa
+
+
+def index_notes(note_ids):
+    """Updates the search index of the notes with ``note_ids``, if it is
+    stored within the database, by a background job. An in-memory index is
+    refreshed once the change is committed, see ``notes_changed``.
+    """
+    if note_search.backend.shared:
+        enqueue("notes.index_notes", note_ids=list(note_ids))
+
+
+def update_tag_stats(tag_ids, amount, partition):
+    """Updates the note counts of the passed tags within ``partition``. The
+    tag stats are updated within the current transaction, so they are
+    current as soon as the change of the note is.
+    """
+    tag_ids = list(tag_ids)
+    if tag_ids:
+        TagStat.objects.add(tag_ids, amount, partition)
+
+
+def update_tag_counts(counts):
+    """Adds the amounts of ``counts``, a dict (partition, tag id) -> amount,
+    to the note counts of the tags within the current transaction.
+    """
+    counts = dict((key, amount) for key, amount in counts.items() if amount)
+    if counts:
+        TagStat.objects.add_counts(counts)
+
+
+@receiver(pre_save, sender=Note)
+def note_saving(sender, instance, raw, update_fields, **kwargs):
+    # Remembers the stored partition, so moving a note to another owner or
+    # team is detected. Takes a query unless the owner and team can't change.
+    instance._saved_partition = None
+    if raw or instance.pk is None:
+        return
+    if update_fields is not None and not set(update_fields) & set(["owner", "owner_id", "team", "team_id"]):
+        return
+
+    with primary():
+        stored = Note.objects.unscoped().filter(pk=instance.pk).values_list("owner_id", "team_id").first()
+    if stored is not None:
+        instance._saved_partition = get_partition(*stored)
+
+
+@receiver(post_save, sender=Note)
+def note_saved(sender, instance, created, **kwargs):
+    partitions = [instance.partition]
+    if not created and instance._saved_partition not in (None, instance.partition):
+        tag_ids = list(get_tagged_items().filter(object_id=instance.id).values_list("tag_id", flat=True))
+        update_tag_stats(tag_ids, -1, instance._saved_partition)
+        update_tag_stats(tag_ids, 1, instance.partition)
+        partitions.append(instance._saved_partition)
+
+    index_notes([instance.id])
+    notes_changed([instance.id], partitions)
+
+
+@receiver(pre_delete, sender=Note)
+def note_deleting(sender, instance, **kwargs):
+    # Tagged items aren't deleted together with their notes by taggit.
+    items = get_tagged_items().filter(object_id=instance.id)
+    tag_ids = list(items.values_list("tag_id", flat=True))
+    update_tag_stats(tag_ids, -1, instance.partition)
+    items.delete()
+
+
+@receiver(post_delete, sender=Note)
+def note_deleted(sender, instance, **kwargs):
+    if note_search.backend.shared:
+        enqueue("notes.remove_notes", note_ids=[instance.id])
+    notes_changed([instance.id], [instance.partition])
+
+
+@receiver(post_save, sender=File)
+@receiver(post_delete, sender=File)
+def file_changed(sender, instance, **kwargs):
+    if instance.note_id:
+        render_cache.invalidate(instance.note_id)
+
+
+@receiver(post_save, sender=File)
+def file_saved(sender, instance, created, **kwargs):
+    if created and Image is not None:
+        enqueue("notes.create_renditions", file_ids=[instance.id])
+
+
+@receiver(post_delete, sender=File)
+def file_deleted(sender, instance, **kwargs):
+    for name in ("thumbnail", "medium"):
+        rendition = getattr(instance, name)
+        if rendition:
+            rendition.delete(save=False)
+
+    if instance.blob_id:
+        release_blob(instance.blob_id)
+
+
+@receiver(m2m_changed, sender=TaggedItem)
+def note_tags_changed(sender, instance, action, pk_set, **kwargs):
+    if not isinstance(instance, Note):
+        return
+
+    if action == "pre_clear":
+        instance._cleared_tag_ids = list(instance.tags.values_list("id", flat=True))
+    elif action == "post_add":
+        update_tag_stats(pk_set, 1, instance.partition)
+    elif action == "post_remove":
+        update_tag_stats(pk_set, -1, instance.partition)
+    elif action == "post_clear":
+        update_tag_stats(getattr(instance, "_cleared_tag_ids", []), -1, instance.partition)
+
+    if action in ("post_add", "post_remove", "post_clear"):
+        index_notes([instance.id])
+        notes_changed([instance.id], [instance.partition])
+
+
+def get_tagged_notes(tag_id):
+    """Returns the ids and the partitions of the notes tagged with the tag
+    with ``tag_id``.
+    """
+    notes = Note.objects.unscoped().filter(tags__id=tag_id).values_list("id", "owner_id", "team_id")
+    note_ids = []
+    partitions = set()
+    for note_id, owner_id, team_id in notes:
+        note_ids.append(note_id)
+        partitions.add(get_partition(owner_id, team_id))
+    return note_ids, partitions
+
+
+@receiver(post_save, sender=Tag)
+def tag_saved(sender, instance, created, **kwargs):
+    if created:
+        notes_changed(tag_ids=[instance.id])
+        return
+
+    # A renamed tag changes the indexed text and the HTML of all notes
+    # tagged with it.
+    note_ids, partitions = get_tagged_notes(instance.id)
+    index_notes(note_ids)
+    notes_changed(note_ids, partitions, [instance.id])
+
+
+@receiver(pre_delete, sender=Tag)
+def tag_deleting(sender, instance, **kwargs):
+    # The tagged items are deleted together with the tag
+    instance._tagged_notes = get_tagged_notes(instance.id)
+
+
+@receiver(post_delete, sender=Tag)
+def tag_deleted(sender, instance, **kwargs):
+    note_ids, partitions = getattr(instance, "_tagged_notes", ([], set()))
+    index_notes(note_ids)
+    notes_changed(note_ids, partitions, [instance.id])
@@ -0,0 +1,127 @@
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import os
+import uuid
+from collections import Counter
+
+from django.core.files.storage import default_storage
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import F
+
+from notes.cache import render_cache
+from notes.jobs import enqueue
+from notes.models import Blob
+from notes.models import File
+from notes.models import delete_rows
+from notes.renditions import Image
+
+
+def hash_upload(upload):
+    """Returns the SHA-256 and the size of ``upload``, which is read chunk by
+    chunk and rewound afterwards.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    for chunk in upload.chunks():
+        sha256.update(chunk)
+        size += len(chunk)
+    upload.seek(0)
+    return sha256.hexdigest(), size
+
+
+def store_upload(upload):
+    """Returns the blob with the content of ``upload``, whose reference count
+    is incremented.
+
+    The upload is hashed before it is stored, independent of how the storage
+    reads it, and only stored if there is no blob with the same content yet.
+    """
+    sha256, size = hash_upload(upload)
+
+    while True:
+        with transaction.atomic():
+            # Locks the blob, so release_blobs either has deleted it already
+            # or sees the incremented count.
+            blob = Blob.objects.select_for_update().filter(sha256=sha256).first()
+            if blob is not None:
+                if Blob.objects.filter(pk=blob.pk).update(ref_count=F("ref_count") + 1):
+                    return blob
+
+        name = default_storage.save(
+            "blobs/{}/{}".format(uuid.uuid4().hex, os.path.basename(upload.name)), upload
+        )
+        try:
+            with transaction.atomic():
+                return Blob.objects.create(sha256=sha256, file=name, size=size, ref_count=1)
+        except IntegrityError:
+            # Uploaded concurrently, the other blob is used
+            default_storage.delete(name)
+            upload.seek(0)
+
+
+def attach_files(note, uploads):
+    """Stores the passed uploads and attaches them to ``note``. The files are
+    created in bulk.
+    """
+    blobs = [store_upload(upload) for upload in uploads]
+    if not blobs:
+        return
+
+    File.objects.bulk_create([File(note=note, blob=blob, file=blob.file.name) for blob in blobs])
+
+    # bulk_create doesn't send post_save
+    render_cache.invalidate(note.id)
+    if Image is not None:
+        file_ids = list(File.objects.filter(note=note, blob__in=blobs).values_list("id", flat=True))
+        enqueue("notes.create_renditions", file_ids=file_ids)
+
+
+def release_blob(blob_id):
+    """Decrements the reference count of the blob with ``blob_id`` and
+    deletes it, including its content, if it isn't used anymore.
+    """
+    release_blobs([blob_id])
+
+
+def release_blobs(blob_ids):
+    """Decrements the reference counts of the passed blobs (once per
+    occurrence of their id) and deletes the ones which aren't used anymore.
+    """
+    amounts = Counter(blob_ids)
+    if not amounts:
+        return
+
+    with transaction.atomic():
+        # One update per distinct amount, which is mostly 1
+        by_amount = {}
+        for blob_id, amount in amounts.items():
+            by_amount.setdefault(amount, []).append(blob_id)
+        for amount, ids in by_amount.items():
+            Blob.objects.filter(pk__in=ids).update(ref_count=F("ref_count") - amount)
+
+        blobs = list(Blob.objects.select_for_update().filter(pk__in=list(amounts), ref_count=0))
+        if blobs:
+            names = [blob.file.name for blob in blobs]
+            Blob.objects.filter(pk__in=[blob.pk for blob in blobs]).delete()
+            transaction.on_commit(lambda: [default_storage.delete(name) for name in names])
+
+
+def delete_files(file_ids):
+    """Deletes the files with ``file_ids`` together with their renditions
+    and releases their blobs.
+
+    Takes a constant number of queries, as the files are deleted without
+    sending signals.
+    """
+    rows = list(File.objects.filter(pk__in=file_ids).values_list("id", "blob_id", "thumbnail", "medium"))
+    if not rows:
+        return
+
+    with transaction.atomic():
+        delete_rows(File, [row[0] for row in rows])
+        release_blobs([blob_id for file_id, blob_id, thumbnail, medium in rows if blob_id])
+
+        renditions = [name for row in rows for name in row[2:] if name]
+        transaction.on_commit(lambda: [default_storage.delete(name) for name in renditions])
@@ -0,0 +1,258 @@
+from __future__ import print_function, unicode_literals
+
+import bisect
+import heapq
+import sys
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models.signals import m2m_changed
+from django.utils import six
+
+from taggit.models import Tag
+from taggit.models import TaggedItem
+
+from notes.cache import VersionedIndex
+from notes.cache import notes_changed
+from notes.models import Note
+from notes.models import TagStat
+from notes.models import get_tagged_items
+from notes.scoping import get_current_scope
+
+
+def get_or_create_tags(names):
+    """Returns the tags with the passed names. Missing tags are created
+    within one batch.
+    """
+    names = set(names)
+    tags = list(Tag.objects.filter(name__in=names))
+
+    missing = names - set(tag.name for tag in tags)
+    if missing:
+        try:
+            with transaction.atomic():
+                Tag.objects.bulk_create([Tag(name=name, slug=Tag().slugify(name)) for name in missing])
+        except IntegrityError:
+            # Either created concurrently or the slug is taken, which is
+            # resolved by taggit's Tag.save.
+            for name in missing:
+                Tag.objects.get_or_create(name=name)
+
+        created = list(Tag.objects.filter(name__in=missing))
+        notes_changed(tag_ids=[tag.id for tag in created])
+        tags.extend(created)
+
+    return tags
+
+
+def sync_tags(note, names):
+    """Sets the tags of ``note`` to the passed tag names.
+
+    Only the difference to the current tags is written: tagged items are
+    added and removed in bulk and the tag signals are sent once per
+    direction. Nothing is written if the tags haven't changed.
+
+    Returns the names of the added and of the removed tags.
+    """
+    names = set(name.strip() for name in names if name and name.strip())
+    items = get_tagged_items().filter(object_id=note.id)
+    current = dict(items.values_list("tag__name", "tag_id"))
+
+    added = names - set(current)
+    removed = set(current) - names
+
+    if removed:
+        tag_ids = set(current[name] for name in removed)
+        _send(note, "pre_remove", tag_ids)
+        items.filter(tag_id__in=tag_ids).delete()
+        _send(note, "post_remove", tag_ids)
+
+    if added:
+        tags = get_or_create_tags(added)
+        tag_ids = set(tag.id for tag in tags)
+        content_type = ContentType.objects.get_for_model(Note)
+        _send(note, "pre_add", tag_ids)
+        TaggedItem.objects.bulk_create([
+            TaggedItem(tag=tag, content_type=content_type, object_id=note.id) for tag in tags
+        ])
+        _send(note, "post_add", tag_ids)
+
+    return added, removed
+
+
+def _send(note, action, tag_ids):
+    m2m_changed.send(
+        sender=TaggedItem, action=action, instance=note, reverse=False,
+        model=Tag, pk_set=tag_ids, using=note._state.db,
+    )
+
+
+def get_prefix_successor(prefix):
+    """Returns the smallest string which is greater than all strings starting
+    with ``prefix``, or None if there is none.
+    """
+    while prefix:
+        last = ord(prefix[-1])
+        if last < sys.maxunicode:
+            return prefix[:-1] + six.unichr(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+class TagCompleter(VersionedIndex):
+    """In-memory prefix index of the tag names for autocompletion.
+
+    Holds the lower case tag names in a sorted list, so the tags starting
+    with a prefix are found by bisection, and the note count per tag and
+    partition (see ``notes.scoping``), which ranks them. It is loaded lazily
+    with two queries and afterwards updated incrementally, by the tags and
+    partitions changed within committed transactions (see
+    ``notes.cache.notes_changed``).
+
+    Within a scope only the tags used by the notes of the scope are
+    completed, ranked by their use within it.
+
+    The partitions changed by another process are reloaded, see
+    ``notes.cache.VersionedIndex``.
+    """
+    def __init__(self):
+        super(TagCompleter, self).__init__()
+        self._keys = []
+        self._names = {}
+        self._counts = {}
+        self._totals = {}
+
+    def load(self):
+        with self._lock:
+            self._names = dict(Tag.objects.values_list("id", "name"))
+            self._counts = {}
+            self._totals = {}
+            for partition, tag_id, note_count in TagStat.objects.values_list("partition", "tag_id", "note_count"):
+                self._counts.setdefault(partition, {})[tag_id] = note_count
+                self._totals[tag_id] = self._totals.get(tag_id, 0) + note_count
+            self._keys = sorted((name.lower(), tag_id) for tag_id, name in self._names.items())
+            self._loaded = True
+
+    def load_partitions(self, partitions):
+        with self._lock:
+            self._reload_tags(self._reload_counts(partitions))
+
+    def refresh(self, note_ids, partitions, tag_ids):
+        with self._lock:
+            if self._loaded:
+                self._reload_counts(partitions)
+                self._reload_tags(tag_ids)
+
+    def _reload_counts(self, partitions):
+        # Replaces the note counts of ``partitions`` by the stored ones and
+        # returns the ids of their tags. Must be called with the lock held.
+        for partition in partitions:
+            for tag_id, note_count in self._counts.pop(partition, {}).items():
+                self._totals[tag_id] = self._totals.get(tag_id, 0) - note_count
+
+        tag_ids = set()
+        stats = TagStat.objects.filter(partition__in=list(partitions))
+        for partition, tag_id, note_count in stats.values_list("partition", "tag_id", "note_count"):
+            self._counts.setdefault(partition, {})[tag_id] = note_count
+            self._totals[tag_id] = self._totals.get(tag_id, 0) + note_count
+            tag_ids.add(tag_id)
+        return tag_ids
+
+    def _reload_tags(self, tag_ids):
+        # Replaces the names of the tags with ``tag_ids`` by the stored ones.
+        # Must be called with the lock held.
+        tag_ids = sorted(tag_ids)
+        for i in range(0, len(tag_ids), 500):
+            chunk = tag_ids[i:i + 500]
+            names = dict(Tag.objects.filter(pk__in=chunk).values_list("id", "name"))
+            for tag_id in chunk:
+                if tag_id in names:
+                    if self._names.get(tag_id) != names[tag_id]:
+                        self.add_tag(tag_id, names[tag_id])
+                else:
+                    self.remove_tag(tag_id)
+
+    def clear(self):
+        """Drops the index. It is loaded again on next use.
+        """
+        with self._lock:
+            self._loaded = False
+            self._keys = []
+            self._names = {}
+            self._counts = {}
+            self._totals = {}
+
+    def add_tag(self, tag_id, name):
+        """Adds a new tag or renames an existing one.
+        """
+        with self._lock:
+            if self._loaded:
+                self.remove_tag(tag_id)
+                self._names[tag_id] = name
+                bisect.insort(self._keys, (name.lower(), tag_id))
+
+    def remove_tag(self, tag_id):
+        with self._lock:
+            if self._loaded and tag_id in self._names:
+                key = (self._names.pop(tag_id).lower(), tag_id)
+                del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def exists(self, name):
+        """Returns True if there is a tag named ``name`` (case-insensitive)
+        which is visible within the current scope.
+        """
+        name = name.strip().lower()
+        self.ensure_current()
+        with self._lock:
+            counts = self._get_counts()
+            position = bisect.bisect_left(self._keys, (name, ))
+            while position < len(self._keys) and self._keys[position][0] == name:
+                if counts is None or counts.get(self._keys[position][1], 0) > 0:
+                    return True
+                position += 1
+            return False
+
+    def complete(self, prefix, limit=10):
+        """Returns the ``limit`` most used tags whose names start with
+        ``prefix`` (case-insensitive) as list of (id, name, note count).
+        """
+        prefix = prefix.strip().lower()
+        successor = get_prefix_successor(prefix)
+        self.ensure_current()
+        with self._lock:
+            start = bisect.bisect_left(self._keys, (prefix, ))
+            if successor is None:
+                end = len(self._keys)
+            else:
+                end = bisect.bisect_left(self._keys, (successor, ))
+            keys = self._keys[start:end]
+
+            counts = self._get_counts()
+            if counts is None:
+                counts = self._totals
+            else:
+                keys = [key for key in keys if counts.get(key[1], 0) > 0]
+
+            keys = heapq.nsmallest(limit, keys, key=lambda key: (-counts.get(key[1], 0), key))
+
+            return [(tag_id, self._names[tag_id], counts.get(tag_id, 0)) for name, tag_id in keys]
+
+    def _get_counts(self):
+        # Returns the note counts per tag within the current scope or None
+        # if there is no scope. Must be called with the lock held.
+        scope = get_current_scope()
+        if scope is None:
+            return None
+
+        if len(scope.partitions) == 1:
+            return self._counts.get(scope.partitions[0], {})
+
+        counts = {}
+        for partition in scope.partitions:
+            for tag_id, count in self._counts.get(partition, {}).items():
+                counts[tag_id] = counts.get(tag_id, 0) + count
+        return counts
+
+
+tag_completer = TagCompleter()
@@ -0,0 +1,33 @@
+from __future__ import print_function, unicode_literals
+
+from notes.jobs import register
+from notes.models import File
+from notes.renditions import create_renditions
+from notes.search import note_search
+from notes.storage import delete_files
+
+
+@register("notes.index_notes")
+def index_notes(note_ids):
+    """Updates the search index of the passed notes.
+    """
+    note_search.index_notes(note_ids)
+
+
+@register("notes.remove_notes")
+def remove_notes(note_ids):
+    """Removes the passed notes from the search index.
+    """
+    for note_id in note_ids:
+        note_search.remove(note_id)
+
+
+@register("notes.delete_files")
+def delete_note_files(file_ids):
+    delete_files(file_ids)
+
+
+@register("notes.create_renditions")
+def create_file_renditions(file_ids):
+    for file in File.objects.filter(pk__in=file_ids):
+        create_renditions(file)
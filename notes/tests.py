@@ -0,0 +1,414 @@
+from __future__ import print_function, unicode_literals
+
+import calendar
+import datetime
+import os
+import random
+import shutil
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.test import RequestFactory
+from django.test import TestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import http_date
+
+from cba import utils
+
+from notes.bulk import delete_notes
+from notes.bulk import tag_notes
+from notes.bulk import untag_notes
+from notes.cache import get_cache
+from notes.components.note_display import NotesTableDataProvider
+from notes.corpus import WORDS
+from notes.markup import BlockRenderer
+from notes.markup import render_full
+from notes.middleware import PIN_KEY
+from notes.middleware import PrimaryPinMiddleware
+from notes.models import Blob
+from notes.models import File
+from notes.models import Note
+from notes.models import TagStat
+from notes.models import get_tag_names
+from notes.models import get_tagged_items
+from notes.query import request_scope
+from notes.routers import request_routing
+from notes.scoping import Scope
+from notes.scoping import scoped
+from notes.search import FTS5SearchBackend
+from notes.search import PythonSearchBackend
+from notes.serving import serve_file
+from notes.storage import attach_files
+from notes.storage import delete_files
+from notes.tagging import sync_tags
+from notes.transfer import NoteExporter
+from notes.transfer import NoteImporter
+from notes.transfer import read_jsonl
+from notes.transfer import read_markdown
+
+
+class MediaRootMixin(object):
+    """Stores the files of a test within a temporary directory.
+    """
+    def setUp(self):
+        super(MediaRootMixin, self).setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+
+        media_root = override_settings(MEDIA_ROOT=self.media_root)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+
+class NotesTableDataProviderTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user("owner", password="owner")
+        for i in range(60):
+            note = Note.objects.create(title="Note {}".format(i), text="Text {}".format(i), owner=cls.user)
+            note.tags.add("tag-{}".format(i % 3), "tag-{}".format(i % 7))
+
+    def setUp(self):
+        # The session of CBA is only available within requests
+        self.session = {}
+        get_from_session, set_to_session = utils.get_from_session, utils.set_to_session
+        utils.get_from_session = lambda key, *args: self.session.get(key)
+        utils.set_to_session = lambda key, value, *args: self.session.__setitem__(key, value)
+        self.addCleanup(setattr, utils, "get_from_session", get_from_session)
+        self.addCleanup(setattr, utils, "set_to_session", set_to_session)
+
+    def get_rows(self, end):
+        # A new request, whose versions and counts aren't cached yet
+        get_cache().clear()
+        with request_scope(self.user):
+            return NotesTableDataProvider(paging="keyset").get_rows(0, end)
+
+    def test_get_rows_queries(self):
+        """The number of queries doesn't depend on the number of rows.
+        """
+        # Fills the process-wide caches, e.g. of the content types
+        self.get_rows(1)
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(len(self.get_rows(5)), 5)
+
+        with self.assertNumQueries(len(context)):
+            self.assertEqual(len(self.get_rows(50)), 50)
+
+
+class BlockRendererTestCase(TestCase):
+    # Builds the pieces of random markdown documents
+    PIECES = [
+        lambda r: " ".join(r.choice(WORDS) for i in range(r.randint(1, 12))),
+        lambda r: "{} {}".format("#" * r.randint(1, 3), r.choice(WORDS)),
+        lambda r: "\n".join("{} {}".format(r.choice("*-+"), r.choice(WORDS)) for i in range(r.randint(1, 3))),
+        lambda r: "\n".join("{}. {}".format(i + 1, r.choice(WORDS)) for i in range(r.randint(1, 3))),
+        lambda r: "- {}\n\n    {}".format(r.choice(WORDS), r.choice(WORDS)),
+        lambda r: "    " + r.choice(WORDS),
+        lambda r: "  " + r.choice(WORDS),
+        lambda r: "> " + r.choice(WORDS),
+        lambda r: "```\n{}\n\n{}\n```".format(r.choice(WORDS), r.choice(WORDS)),
+        lambda r: "*{}* and **{}**  ".format(r.choice(WORDS), r.choice(WORDS)),
+        lambda r: "---",
+    ]
+    SEPARATORS = ["\n", "\n\n", "\n\n\n", "\n  \n", "\n \t\n\n"]
+
+    def get_document(self, randomizer):
+        pieces = [
+            randomizer.choice(self.PIECES)(randomizer) + randomizer.choice(self.SEPARATORS)
+            for i in range(randomizer.randint(1, 8))
+        ]
+        return "".join(pieces)
+
+    def test_render(self):
+        """Rendering block by block gives the same HTML as rendering the
+        whole document.
+        """
+        randomizer = random.Random(42)
+        for i in range(500):
+            raw = self.get_document(randomizer)
+            if randomizer.random() < 0.5:
+                raw = raw.rstrip("\n")
+            self.assertEqual(BlockRenderer().render("markdown", raw), render_full("markdown", raw), raw)
+
+
+class BulkTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = get_user_model().objects.create_user("owner", password="owner")
+        cls.other = get_user_model().objects.create_user("other", password="other")
+        for user in (cls.owner, cls.other):
+            for i in range(6):
+                note = Note.objects.create(title="Note {}".format(i), text="Text {}".format(i), owner=user)
+                note.tags.add("common", "tag-{}".format(i % 2))
+
+    def get_tags(self, user):
+        note_ids = Note.objects.unscoped().filter(owner=user).values_list("id", flat=True)
+        return sorted(get_tagged_items().filter(object_id__in=list(note_ids)).values_list("object_id", "tag__name"))
+
+    def test_bulk_actions(self):
+        """Bulk actions change only the notes of the scope and keep the tag
+        stats consistent.
+        """
+        other_tags = self.get_tags(self.other)
+        # The selection contains the notes of both users
+        note_ids = list(Note.objects.unscoped().values_list("id", flat=True))
+        owner_note_ids = list(Note.objects.unscoped().filter(owner=self.owner).values_list("id", flat=True))
+
+        with scoped(self.owner):
+            added = tag_notes(note_ids, ["new", "common"])
+            self.assertEqual(sorted(added), sorted((note_id, added[0][1]) for note_id in owner_note_ids))
+            self.assertEqual(TagStat.objects.check_consistency(), [])
+
+            removed = untag_notes(note_ids, ["tag-0", "tag-1"])
+            self.assertEqual(sorted(note_id for note_id, tag_id in removed), sorted(owner_note_ids))
+            self.assertEqual(TagStat.objects.check_consistency(), [])
+
+            self.assertEqual(sorted(delete_notes(note_ids)), sorted(owner_note_ids))
+            self.assertEqual(TagStat.objects.check_consistency(), [])
+
+        self.assertFalse(Note.objects.unscoped().filter(owner=self.owner).exists())
+        self.assertEqual(Note.objects.unscoped().filter(owner=self.other).count(), 6)
+        self.assertEqual(self.get_tags(self.other), other_tags)
+
+
+@override_settings(DATABASE_ROUTERS=["notes.routers.NotesRouter"], NOTES_READ_DATABASES=["replica"])
+class RoutingTestCase(TestCase):
+    # The replica is only named by the router, QuerySet.db tells where a
+    # query would be sent without running it.
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user("owner", password="owner")
+
+    def test_request(self):
+        """Requests read from the replica until they write, writes go to the
+        primary.
+        """
+        with request_routing() as state:
+            self.assertEqual(Note.objects.unscoped().all().db, "replica")
+            note = Note.objects.create(title="Note", text="Text", owner=self.user)
+            self.assertEqual(note._state.db, "default")
+            self.assertTrue(state.wrote)
+            self.assertEqual(Note.objects.unscoped().all().db, "default")
+
+        # Outside of requests everything is read from the primary
+        self.assertEqual(Note.objects.unscoped().all().db, "default")
+
+    def test_session_pinned(self):
+        """The session reads from the primary after a request has written.
+        """
+        databases = []
+
+        def write(request):
+            Note.objects.create(title="Note", text="Text", owner=self.user)
+            return None
+
+        def read(request):
+            databases.append(Note.objects.unscoped().all().db)
+            return None
+
+        request = RequestFactory().get("/")
+        request.session = {}
+        PrimaryPinMiddleware(read)(request)
+        self.assertNotIn(PIN_KEY, request.session)
+
+        PrimaryPinMiddleware(write)(request)
+        self.assertIn(PIN_KEY, request.session)
+        PrimaryPinMiddleware(read)(request)
+
+        self.assertEqual(databases, ["replica", "default"])
+
+
+class SearchTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = get_user_model().objects.create_user("owner", password="owner")
+        cls.other = get_user_model().objects.create_user("other", password="other")
+
+        # The same word within the title, the tags and the text
+        cls.in_text = Note.objects.create(title="Plums", text="Apples and pears", owner=cls.owner)
+        cls.in_title = Note.objects.create(title="Apples", text="Plums and pears", owner=cls.owner)
+        cls.in_tags = Note.objects.create(title="Pears", text="Figs and pears", owner=cls.owner)
+        cls.in_tags.tags.add("apples")
+        cls.other_note = Note.objects.create(title="Apples", text="Apples and pears", owner=cls.other)
+        Note.objects.create(title="Figs", text="Plums", owner=cls.owner)
+
+    def get_backends(self):
+        backends = [PythonSearchBackend()]
+        if FTS5SearchBackend.is_available(connection):
+            backend = FTS5SearchBackend()
+            backend.rebuild()
+            backends.append(backend)
+        return backends
+
+    def test_ranking(self):
+        """Matches within the title rank before the ones within the tags and
+        the text. Every word matches as prefix.
+        """
+        scope = Scope(self.owner.pk)
+        for backend in self.get_backends():
+            self.assertEqual(
+                backend.search("appl", 10, scope),
+                [self.in_title.id, self.in_tags.id, self.in_text.id],
+                backend,
+            )
+            # All words must match
+            self.assertEqual(
+                sorted(backend.search("appl plu", 10, scope)), sorted([self.in_title.id, self.in_text.id]), backend,
+            )
+            self.assertEqual(backend.search("appl", 2, scope), [self.in_title.id, self.in_tags.id], backend)
+            self.assertEqual(backend.search("kiwi", 10, scope), [], backend)
+
+    def test_scoping(self):
+        """Only the notes of the scope are found.
+        """
+        for backend in self.get_backends():
+            self.assertEqual(backend.search("apples", 10, Scope(self.other.pk)), [self.other_note.id], backend)
+            self.assertEqual(len(backend.search("apples", 10)), 4, backend)
+            self.assertEqual(backend.search("apples", 10, Scope(None)), [], backend)
+
+
+class SyncTagsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = get_user_model().objects.create_user("owner", password="owner")
+        cls.note = Note.objects.create(title="Note", text="Text", owner=user)
+        cls.note.tags.add("a", "b")
+
+    def test_unchanged(self):
+        """Unchanged tags are only read.
+        """
+        with self.assertNumQueries(1):
+            self.assertEqual(sync_tags(self.note, ["b", " a ", ""]), (set(), set()))
+
+    def test_changed(self):
+        added, removed = sync_tags(self.note, ["b", "c"])
+        self.assertEqual((added, removed), ({"c"}, {"a"}))
+        self.assertEqual(sorted(get_tag_names([self.note.id])[self.note.id]), ["b", "c"])
+
+
+class BlobTestCase(MediaRootMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = get_user_model().objects.create_user("owner", password="owner")
+        cls.notes = [Note.objects.create(title="Note", text="Text", owner=user) for i in range(2)]
+
+    def test_release(self):
+        """Files with the same content share a blob, which is deleted with
+        the last of them.
+        """
+        for note in self.notes:
+            attach_files(note, [ContentFile(b"content", name="a.txt")])
+
+        blob = Blob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(File.objects.filter(blob=blob).count(), 2)
+
+        delete_files([self.notes[0].file_set.get().id])
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+
+        # Deleting a single file releases the blob by the post_delete signal
+        self.notes[1].file_set.get().delete()
+        self.assertFalse(Blob.objects.exists())
+
+
+class ServeFileTestCase(MediaRootMixin, TestCase):
+    def setUp(self):
+        super(ServeFileTestCase, self).setUp()
+        self.name = default_storage.save("file.txt", ContentFile(b"0123456789"))
+        self.last_modified = calendar.timegm(datetime.datetime(2020, 1, 1).utctimetuple())
+
+    def serve(self, **headers):
+        request = RequestFactory().get("/", **headers)
+        response = serve_file(request, self.name, "etag", self.last_modified)
+        if response.streaming:
+            self.addCleanup(response.close)
+        return response
+
+    def get_content(self, response):
+        return b"".join(response.streaming_content)
+
+    def test_whole_file(self):
+        response = self.serve()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], '"etag"')
+        self.assertEqual(self.get_content(response), b"0123456789")
+
+    def test_not_modified(self):
+        """Conditional requests are answered by 304 if the file hasn't
+        changed.
+        """
+        self.assertEqual(self.serve(HTTP_IF_NONE_MATCH='"etag"').status_code, 304)
+        self.assertEqual(self.serve(HTTP_IF_MODIFIED_SINCE=http_date(self.last_modified)).status_code, 304)
+        self.assertEqual(self.serve(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_range(self):
+        """Single byte ranges are answered by 206, unless the file has
+        changed according to If-Range.
+        """
+        response = self.serve(HTTP_RANGE="bytes=2-5")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 2-5/10")
+        self.assertEqual(self.get_content(response), b"2345")
+
+        response = self.serve(HTTP_RANGE="bytes=-3", HTTP_IF_RANGE='"etag"')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.get_content(response), b"789")
+
+        response = self.serve(HTTP_RANGE="bytes=2-5", HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_content(response), b"0123456789")
+
+        self.assertEqual(self.serve(HTTP_RANGE="bytes=10-").status_code, 416)
+
+
+class TransferTestCase(MediaRootMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user("owner", password="owner")
+
+    def setUp(self):
+        super(TransferTestCase, self).setUp()
+        date = timezone.make_aware(datetime.datetime(2020, 1, 2, 3, 4, 5))
+        for i in range(3):
+            note = Note.objects.create(title="Note {}".format(i), text="# Text {}\n\nMore".format(i), owner=self.user)
+            note.tags.add("common", "tag-{}".format(i))
+            Note.objects.unscoped().filter(pk=note.pk).update(created=date, modified=date)
+        attach_files(note, [ContentFile(b"content", name="a.txt")])
+
+    def get_notes(self):
+        tag_names = get_tag_names()
+        return sorted(
+            (
+                note.title, note.text.raw, note.text.rendered, note.created, note.modified,
+                sorted(tag_names.get(note.id, [])),
+                [file.file.read() for file in note.file_set.all()],
+            )
+            for note in Note.objects.unscoped().filter(owner=self.user)
+        )
+
+    def round_trip(self, output, format, read):
+        notes = self.get_notes()
+        self.assertEqual(NoteExporter(output, format=format, chunk_size=2).run(), 3)
+
+        delete_files(list(File.objects.values_list("id", flat=True)))
+        Note.objects.unscoped().all().delete()
+
+        self.assertEqual(NoteImporter(batch_size=2, workers=1, owner_id=self.user.pk).run(read(output)), 3)
+        self.assertEqual(self.get_notes(), notes)
+        self.assertEqual(TagStat.objects.check_consistency(), [])
+
+    def test_jsonl(self):
+        """Notes exported as JSONL are imported with their tags, dates and
+        files.
+        """
+        self.round_trip(os.path.join(self.media_root, "notes.jsonl"), "jsonl", read_jsonl)
+
+    def test_markdown(self):
+        self.round_trip(os.path.join(self.media_root, "export"), "markdown", read_markdown)
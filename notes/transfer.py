@@ -0,0 +1,413 @@
+from __future__ import print_function, unicode_literals
+
+import base64
+import io
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.files import File as DjangoFile
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.text import slugify
+
+from taggit.models import TaggedItem
+
+from notes.bulk import rebuild_indexes
+from notes.models import File
+from notes.models import Note
+from notes.models import bulk_create_notes
+from notes.models import get_tag_names
+from notes.storage import attach_files
+from notes.tagging import get_or_create_tags
+
+FORMATS = ("jsonl", "markdown")
+
+
+def parse_front_matter(content):
+    """Splits a markdown document into its front matter (a dict) and the
+    body.
+
+    The front matter is a block of ``key: value`` lines between two ``---``
+    lines at the start of the document. Values are JSON strings or lists
+    (as written by ``format_front_matter``) or, if they aren't valid JSON,
+    plain text. Plain values within brackets are lists of comma separated
+    items.
+    """
+    lines = content.split("\n")
+    if not lines or lines[0].strip() != "---":
+        return {}, content
+
+    meta = {}
+    for i, line in enumerate(lines[1:], 1):
+        if line.strip() == "---":
+            return meta, "\n".join(lines[i + 1:]).lstrip("\n")
+
+        key, sep, value = line.partition(":")
+        if not sep:
+            continue
+
+        meta[key.strip()] = parse_front_matter_value(value.strip())
+
+    # No closing line, hence it is no front matter
+    return {}, content
+
+
+def parse_front_matter_value(value):
+    if value.startswith(("\"", "[")):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+
+    if value.startswith("[") and value.endswith("]"):
+        return [item.strip() for item in value[1:-1].split(",") if item.strip()]
+    return value
+
+
+def format_front_matter(meta, body):
+    """Returns ``body`` with the front matter of ``meta``. The values are
+    written as JSON, so commas, colons and brackets within them are kept.
+    """
+    lines = ["---"]
+    for key, value in meta.items():
+        lines.append("{}: {}".format(key, json.dumps(value, ensure_ascii=False)))
+    lines.append("---")
+    return "\n".join(lines) + "\n\n" + body
+
+
+def read_jsonl(path):
+    """Yields the notes of a JSONL file as dicts.
+
+    Every line is an object with ``title``, ``text`` and optionally ``tags``,
+    ``created``, ``modified`` and ``files``. Files are objects with a
+    ``name`` and either the base64 encoded ``data`` or a ``path`` relative
+    to the JSONL file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with io.open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+
+            document = json.loads(line)
+            files = []
+            for entry in document.get("files", []):
+                if "data" in entry:
+                    files.append(ContentFile(base64.b64decode(entry["data"]), name=entry["name"]))
+                else:
+                    files.append(os.path.join(directory, entry["path"]))
+            document["files"] = files
+            yield document
+
+
+def read_markdown(directory):
+    """Yields the notes of all ``.md`` files below ``directory`` as dicts.
+
+    The front matter may contain ``title`` (default: the file name),
+    ``tags``, ``created``, ``modified`` and ``files``, whose paths are
+    relative to the markdown file.
+    """
+    for root, dirs, names in os.walk(directory):
+        dirs.sort()
+        for name in sorted(names):
+            if not name.endswith(".md"):
+                continue
+
+            path = os.path.join(root, name)
+            with io.open(path, encoding="utf-8") as f:
+                meta, body = parse_front_matter(f.read())
+
+            tags = meta.get("tags", [])
+            if not isinstance(tags, list):
+                tags = [tag.strip() for tag in tags.split(",") if tag.strip()]
+
+            files = meta.get("files", [])
+            if not isinstance(files, list):
+                files = [files]
+
+            yield {
+                "title": meta.get("title") or os.path.splitext(name)[0],
+                "text": body,
+                "tags": tags,
+                "created": meta.get("created"),
+                "modified": meta.get("modified"),
+                "files": [os.path.join(root, file_path) for file_path in files],
+            }
+
+
+def render_markup(markup_type, raw):
+    """Renders ``raw`` like the text field of notes does. Runs within the
+    worker processes of the importer.
+    """
+    return Note._meta.get_field("text").markup_choices_dict[markup_type](raw)
+
+
+@contextmanager
+def prerendered(renderings):
+    """Makes the text field of notes use ``renderings`` (a dict raw text ->
+    HTML) instead of rendering markdown again, and keeps the passed creation
+    and modification dates. Only meant for bulk imports.
+    """
+    field = Note._meta.get_field("text")
+    markup_choices = dict(field.markup_choices_dict)
+    date_fields = [Note._meta.get_field("created"), Note._meta.get_field("modified")]
+    dates = [(date_field.auto_now, date_field.auto_now_add) for date_field in date_fields]
+
+    for markup_type, render in markup_choices.items():
+        field.markup_choices_dict[markup_type] = (
+            lambda raw, render=render: renderings[raw] if raw in renderings else render(raw)
+        )
+    for date_field in date_fields:
+        date_field.auto_now = date_field.auto_now_add = False
+
+    try:
+        yield
+    finally:
+        field.markup_choices_dict.update(markup_choices)
+        for date_field, (auto_now, auto_now_add) in zip(date_fields, dates):
+            date_field.auto_now = auto_now
+            date_field.auto_now_add = auto_now_add
+
+
+class NoteImporter(object):
+    """Imports notes in batches.
+
+    Notes, tagged items and files of a batch are created in bulk within one
+    transaction, their markdown is rendered by a pool of ``workers``
+    processes. The tag stats, tag index and search index are rebuilt once at
+    the end, as bulk inserts don't send signals. The notes are given to the
+    user with ``owner_id``.
+    """
+    def __init__(self, batch_size=500, workers=None, owner_id=None):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.owner_id = owner_id
+
+    def run(self, documents, stdout=None):
+        """Imports the passed note dicts and returns the number of created
+        notes.
+        """
+        created = 0
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            batch = []
+            for document in documents:
+                batch.append(document)
+                if len(batch) >= self.batch_size:
+                    created += self.import_batch(batch, pool)
+                    batch = []
+                    if stdout is not None:
+                        stdout.write("{} notes".format(created))
+
+            if batch:
+                created += self.import_batch(batch, pool)
+
+        rebuild_indexes()
+
+        if stdout is not None:
+            stdout.write("Imported {} notes".format(created))
+
+        return created
+
+    def import_batch(self, documents, pool):
+        markup_type = Note._meta.get_field("text").default_markup_type
+        texts = [document.get("text") or "" for document in documents]
+        renderings = dict(zip(texts, pool.map(render_markup, [markup_type] * len(texts), texts, chunksize=16)))
+
+        now = timezone.now()
+        with transaction.atomic():
+            with prerendered(renderings):
+                notes = bulk_create_notes([
+                    Note(
+                        title=(document.get("title") or "")[:50],
+                        text=text,
+                        created=self._parse_date(document.get("created")) or now,
+                        modified=self._parse_date(document.get("modified")) or now,
+                        owner_id=self.owner_id,
+                    )
+                    for document, text in zip(documents, texts)
+                ])
+
+            tags = dict((tag.name, tag) for tag in get_or_create_tags(
+                set(name for document in documents for name in document.get("tags", []))
+            ))
+            content_type = ContentType.objects.get_for_model(Note)
+            TaggedItem.objects.bulk_create([
+                TaggedItem(tag=tags[name], content_type=content_type, object_id=note.id)
+                for note, document in zip(notes, documents) for name in set(document.get("tags", []))
+            ])
+
+            for note, document in zip(notes, documents):
+                if document.get("files"):
+                    files = [self._open(file) for file in document["files"]]
+                    try:
+                        attach_files(note, files)
+                    finally:
+                        for file in files:
+                            file.close()
+
+        return len(notes)
+
+    def _open(self, file):
+        if isinstance(file, DjangoFile):
+            return file
+        return DjangoFile(open(file, "rb"), name=os.path.basename(file))
+
+    def _parse_date(self, value):
+        if not value:
+            return None
+        date = parse_datetime(value)
+        if date is not None and timezone.is_naive(date):
+            date = timezone.make_aware(date)
+        return date
+
+
+class NoteExporter(object):
+    """Exports notes as JSONL file or as directory of markdown files.
+
+    The files of the notes are copied chunk by chunk into a directory next to
+    the JSONL file (``<output>-files``) or the markdown file, so they are
+    never held in memory as a whole. The notes are read in chunks ordered by
+    id, so the memory use doesn't depend on the number of notes. After every chunk the id of the last
+    exported note (and for JSONL the size of the output) is written to a
+    checkpoint file, from which an interrupted export is resumed.
+    """
+    def __init__(self, output, format="jsonl", chunk_size=500):
+        if format not in FORMATS:
+            raise ValueError("Unknown format: {}".format(format))
+
+        self.output = output
+        self.format = format
+        self.chunk_size = chunk_size
+
+    @property
+    def checkpoint_path(self):
+        if self.format == "jsonl":
+            return self.output + ".checkpoint"
+        return os.path.join(self.output, ".checkpoint")
+
+    def run(self, resume=False, stdout=None):
+        """Exports all notes and returns the number of exported notes.
+        """
+        checkpoint = self._read_checkpoint() if resume else None
+        last_id = checkpoint["last_id"] if checkpoint else 0
+
+        if self.format == "jsonl":
+            out = io.open(self.output, "r+b" if checkpoint else "wb")
+            out.seek(checkpoint["offset"] if checkpoint else 0)
+            out.truncate()
+        else:
+            if not os.path.isdir(self.output):
+                os.makedirs(self.output)
+            out = None
+
+        exported = 0
+        try:
+            while True:
+                notes = list(
+                    Note.objects.unscoped().filter(id__gt=last_id).order_by("id").values_list(
+                        "id", "title", "text", "created", "modified"
+                    )[:self.chunk_size]
+                )
+                if not notes:
+                    break
+
+                note_ids = [note[0] for note in notes]
+                tag_names = get_tag_names(note_ids)
+                files = {}
+                for file in File.objects.filter(note_id__in=note_ids).order_by("id"):
+                    files.setdefault(file.note_id, []).append(file)
+
+                for note_id, title, text, created, modified in notes:
+                    document = {
+                        "title": title,
+                        "text": text,
+                        "tags": tag_names.get(note_id, []),
+                        "created": created.isoformat(),
+                        "modified": modified.isoformat(),
+                    }
+                    if self.format == "jsonl":
+                        self._write_jsonl(out, note_id, document, files.get(note_id, []))
+                    else:
+                        self._write_markdown(note_id, document, files.get(note_id, []))
+
+                last_id = note_ids[-1]
+                exported += len(notes)
+                if out is not None:
+                    out.flush()
+                self._write_checkpoint(last_id, out.tell() if out is not None else None)
+
+                if stdout is not None:
+                    stdout.write("{} notes".format(exported))
+        finally:
+            if out is not None:
+                out.close()
+
+        # Nothing has been exported if there are no notes
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        return exported
+
+    def _write_jsonl(self, out, note_id, document, files):
+        directory = os.path.dirname(os.path.abspath(self.output))
+        files_directory = "{}-files".format(os.path.basename(self.output))
+
+        document["files"] = []
+        for file in files:
+            path = os.path.join(files_directory, str(note_id), os.path.basename(file.file.name))
+            self._copy_file(file, os.path.join(directory, path))
+            document["files"].append({
+                "name": os.path.basename(file.file.name),
+                "path": path,
+            })
+        out.write(json.dumps(document).encode("utf-8") + b"\n")
+
+    def _write_markdown(self, note_id, document, files):
+        name = "{}-{}".format(note_id, slugify(document["title"]) or "note")
+        paths = []
+        for file in files:
+            path = os.path.join("{}-files".format(name), os.path.basename(file.file.name))
+            self._copy_file(file, os.path.join(self.output, path))
+            paths.append(path)
+
+        meta = [
+            ("title", document["title"]),
+            ("tags", document["tags"]),
+            ("created", document["created"]),
+            ("modified", document["modified"]),
+        ]
+        if paths:
+            meta.append(("files", paths))
+
+        with io.open(os.path.join(self.output, name + ".md"), "w", encoding="utf-8") as f:
+            f.write(format_front_matter(OrderedDict(meta), document["text"]))
+
+    def _copy_file(self, file, target):
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+
+        file.file.open("rb")
+        try:
+            with open(target, "wb") as f:
+                for chunk in file.file.chunks():
+                    f.write(chunk)
+        finally:
+            file.file.close()
+
+    def _read_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_checkpoint(self, last_id, offset):
+        path = self.checkpoint_path + ".tmp"
+        with open(path, "w") as f:
+            json.dump({"last_id": last_id, "offset": offset}, f)
+        os.rename(path, self.checkpoint_path)
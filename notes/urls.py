@@ -0,0 +1,9 @@
+from django.conf.urls import url
+
+from notes import views
+
+urlpatterns = [
+    url(r"^metrics/$", views.metrics, name="notes_metrics"),
+    url(r"^files/(?P<file_id>\d+)/$", views.note_file, name="notes_file"),
+    url(r"^files/(?P<file_id>\d+)/(?P<rendition>thumbnail|medium)/$", views.note_file, name="notes_file_rendition"),
+]
@@ -1,53 +1,152 @@
 from __future__ import print_function, unicode_literals
 
+import calendar
+import hashlib
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.core.files.storage import default_storage
+from django.http import Http404
+from django.http import JsonResponse
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from cba import components
 from cba import layouts
 from cba.base import CBAView
 
+from notes.cache import render_cache
 from notes.components.login import Login
 from notes.components.main_menu import MainMenu
 from notes.components.note_display import NoteDisplay
 from notes.components.tag_explorer import TagExplorer
+from notes.instrumentation import is_enabled
+from notes.instrumentation import registry
+from notes.markup import block_renderer
+from notes.models import File
+from notes.models import Note
+from notes.prebuilt import StaticHTML
+from notes.prebuilt import prebuilt
+from notes.query import request_scope
+from notes.search import note_search
+from notes.serving import serve_file
 
 
-class NotesRoot(components.Group):
-    def init_components(self):
-        if self.get_request().user.is_anonymous():
-            self.initial_components = [
-                Login(id="login-form"),
-            ]
-        else:
-            self.initial_components = [
-                MainMenu(id="menu", css_class="large inverted margin-bottom-large"),
-                layouts.Grid(
+def get_root_components(user):
+    """Returns the components of the root for ``user``.
+
+    The login form, the menu and the header of the tag explorer are static
+    components, whose markup is kept per process, see ``notes.prebuilt``.
+    """
+    if user.is_anonymous():
+        return [
+            Login(id="login-form"),
+        ]
+
+    return [
+        MainMenu(id="menu", css_class="large inverted margin-bottom-large"),
+        layouts.Grid(
+            initial_components=[
+                layouts.Column(
+                    width=13,
                     initial_components=[
-                        layouts.Column(
-                            width=13,
+                        components.Group(
+                            id="main",
+                            css_class="ui container",
                             initial_components=[
-                                components.Group(
-                                    id="main",
-                                    css_class="ui container",
-                                    initial_components=[
-                                        NoteDisplay(id="note-view")
-                                    ],
-                                ),
+                                NoteDisplay(id="note-view")
                             ],
                         ),
-                        layouts.Column(
-                            width=3,
-                            initial_components=[
-                                components.HTML(content=_("Tag Explorer"), tag="div", css_class="ui sub header"),
-                                TagExplorer(
-                                    id="tag-explorer",
-                                ),
-                            ],
+                    ],
+                ),
+                layouts.Column(
+                    width=3,
+                    initial_components=[
+                        StaticHTML(
+                            id="tag-explorer-header",
+                            content=_("Tag Explorer"),
+                            tag="div",
+                            css_class="ui sub header",
                         ),
-                    ]
+                        TagExplorer(
+                            id="tag-explorer",
+                        ),
+                    ],
                 ),
             ]
+        ),
+    ]
+
+
+class NotesRoot(components.Group):
+    def init_components(self):
+        self.initial_components = get_root_components(self.get_request().user)
 
 
 class NotesView(CBAView):
     root = NotesRoot
+
+    def dispatch(self, request, *args, **kwargs):
+        # The user changes when logging in
+        with request_scope(lambda: request.user):
+            if not is_enabled():
+                return super(NotesView, self).dispatch(request, *args, **kwargs)
+
+            registry.start_request()
+            response = super(NotesView, self).dispatch(request, *args, **kwargs)
+
+        if response.streaming:
+            registry.finish_request(0)
+        else:
+            registry.finish_request(len(response.content))
+        return response
+
+
+def metrics(request):
+    """Returns the handler metrics of the current process as JSON.
+
+    Only available for staff users and requests from ``INTERNAL_IPS``.
+    """
+    if not (request.user.is_staff or request.META.get("REMOTE_ADDR") in settings.INTERNAL_IPS):
+        raise PermissionDenied
+
+    return JsonResponse({
+        "handlers": registry.snapshot(),
+        "render_cache": render_cache.stats(),
+        "block_renderer": block_renderer.stats(),
+        "prebuilt": prebuilt.stats(),
+        "search_sessions": note_search.sessions.stats(),
+    })
+
+
+def get_timestamp(value):
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return calendar.timegm(value.utctimetuple())
+
+
+def note_file(request, file_id, rendition=None):
+    """Serves a file of a note or one of its renditions, see
+    ``notes.serving.serve_file``.
+
+    The ETag is the SHA-256 of the content of the file.
+    """
+    with request_scope(lambda: request.user):
+        file = File.objects.select_related("blob").filter(pk=file_id, note__in=Note.objects.values("id")).first()
+
+    if file is None:
+        raise Http404
+
+    field = getattr(file, rendition or "file")
+    if not field:
+        raise Http404
+
+    last_modified = get_timestamp(default_storage.get_modified_time(field.name))
+    if file.blob is not None:
+        etag = file.blob.sha256
+    else:
+        etag = hashlib.md5("{}:{}".format(field.name, last_modified).encode("utf-8")).hexdigest()
+    if rendition is not None:
+        etag = "{}-{}".format(etag, rendition)
+
+    return serve_file(request, field.name, etag, last_modified)
@@ -35,5 +35,9 @@ setup(name='cba-notes',
           'django-taggit',
           'django-markupfield',
           'Markdown',
+          'futures; python_version < "3"',
       ],
+      extras_require={
+          'thumbnails': ['Pillow'],
+      },
 )